@@ -0,0 +1,222 @@
+"""Share one model between threads or coroutines, through a command queue.
+
+The Fortran library keeps its state in global variables, so it can only be
+used by one thread at a time. The :class:`AsyncSubgridWrapper` owns the
+wrapper in one dedicated model thread. Its methods put a command on a single
+queue and return a future right away::
+
+    subgrid = AsyncSubgridWrapper(mdu='/full/path/model.mdu')
+    subgrid.start()
+    subgrid.update(-1)
+    s1 = subgrid.get_nd('s1').result()
+
+The futures are ``concurrent.futures.Future`` instances (on python 2 only
+with the ``futures`` backport, otherwise a :class:`SimpleFuture` with
+``result()``, ``exception()`` and ``add_done_callback()``). On python 3 you
+can await them with ``asyncio``::
+
+    s1 = await asyncio.wrap_future(subgrid.get_nd('s1'))
+
+ctypes releases the GIL during the library calls, so other threads and the
+event loop keep running while the model thread is in ``update``.
+
+Reads are coalesced: all ``get_nd(name)`` calls made while the model doesn't
+change get the same future and thus share one read. The arrays are
+read-only for that reason.
+
+"""
+from __future__ import print_function
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from python_subgrid.remote import REMOTE_METHODS
+from python_subgrid.wrapper import FUNCTIONS
+from python_subgrid.wrapper import SubgridWrapper
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    Future = None
+
+logger = logging.getLogger(__name__)
+
+# Methods that don't change the model: they don't invalidate coalesced reads.
+READ_METHODS = set([
+    'get_var_type',
+    'get_var_rank',
+    'get_var_shape',
+    'inq_compound',
+    'inq_compound_field',
+] + [function['name'] for function in FUNCTIONS
+     if not (function.get('resizes') or function.get('mutates'))])
+
+
+class SimpleFuture(object):
+    """The parts of ``concurrent.futures.Future`` that we need.
+
+    Used when ``concurrent.futures`` isn't available (python 2 without the
+    ``futures`` backport).
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def set_running_or_notify_cancel(self):
+        return True
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """Call ``callback(future)`` when done, in the model thread."""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("No result within {} seconds".format(timeout))
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+if Future is None:
+    Future = SimpleFuture
+
+
+class AsyncSubgridWrapper(object):
+    """:class:`python_subgrid.wrapper.SubgridWrapper` in a model thread.
+
+    The wrapper's methods (see ``REMOTE_METHODS``) and :meth:`get_nd` are
+    called in the model thread, in the order in which they were called. They
+    return a future for the result.
+    """
+
+    def __init__(self, mdu=None, call_mode='safe'):
+        self.subgrid = SubgridWrapper(mdu=mdu, call_mode=call_mode)
+        self.queue = queue.Queue()
+        self.thread = None
+        # Futures of the reads that are still valid, per variable.
+        self._reads = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the model thread and the wrapper in it, wait for them."""
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.submit('start').result()
+
+    def stop(self):
+        """Stop the wrapper, wait for the commands before it and the thread.
+        """
+        try:
+            self.submit('stop').result()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, name, *args, **kwargs):
+        """Queue a call of wrapper method ``name``, return its future."""
+        future = Future()
+        with self._lock:
+            if name not in READ_METHODS:
+                # The model changes, later reads can't share earlier ones.
+                self._reads.clear()
+            self.queue.put((future, name, args, kwargs))
+        return future
+
+    def get_nd(self, name):
+        """Return a future for a (read-only) copy of variable ``name``.
+
+        Reads of the same variable share a future until the model changes.
+        """
+        with self._lock:
+            future = self._reads.get(name)
+            if future is None:
+                future = self._reads[name] = Future()
+                self.queue.put((future, '_read', (name, ), {}))
+        return future
+
+    def _read(self, name):
+        array = self.subgrid.get_nd(name)
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+        return array
+
+    def _run(self):
+        """Run the commands from the queue, in the model thread."""
+        while True:
+            command = self.queue.get()
+            if command is None:
+                break
+            future, name, args, kwargs = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            if name == '_read':
+                method = self._read
+            else:
+                method = getattr(self.subgrid, name)
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                logger.debug("%s failed in the model thread", name,
+                             exc_info=True)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stop()
+
+
+def async_method(name):
+    """Return a method that queues a call of ``name``."""
+    def method(self, *args, **kwargs):
+        return self.submit(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Queue ``{}``, return a future for the result.".format(
+        name)
+    return method
+
+
+for _name in REMOTE_METHODS:
+    setattr(AsyncSubgridWrapper, _name, async_method(_name))
@@ -0,0 +1,1448 @@
+"""Benchmarks for the overhead of the wrapper around the Fortran library.
+
+The benchmarks are installed as the ``benchmark_subgrid`` script, pass it
+the benchmark name and optionally the path to a model's ``*.mdu`` file::
+
+    bin/benchmark_subgrid get_nd --mdu /full/path/model.mdu --variables s1 dps
+
+Without ``--mdu`` they use the stub library (see
+:mod:`python_subgrid.stub`). The ``ensemble`` benchmark uses the
+functional test scenarios if they are available, the ``changes``
+benchmark runs on a synthetic grid.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+import contextlib
+import ctypes
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+
+import numpy as np
+
+from python_subgrid import radar
+from python_subgrid import stub
+from python_subgrid.asynchronous import AsyncSubgridWrapper
+from python_subgrid.changes import DeltaEncoder
+from python_subgrid.changes import Frame
+from python_subgrid.ensemble import Ensemble
+from python_subgrid.ensemble import Job
+from python_subgrid.pipeline import Pipeline
+from python_subgrid.recorder import OutputRecorder
+from python_subgrid.remote import RemoteSubgridWrapper
+from python_subgrid.render import DepthRenderer
+from python_subgrid.template import TemplatePool
+from python_subgrid.wrapper import CALL_MODES
+from python_subgrid.wrapper import FUNCTIONS
+from python_subgrid.wrapper import SubgridWrapper
+from python_subgrid.wrapper import structs2pandas
+
+# Functions that (re)start the library or the model aren't benchmarked.
+LIFECYCLE_FUNCTIONS = ['startup', 'shutdown', 'loadmodel', 'finalizemodel']
+SAMPLE_VALUES = {
+    ctypes.c_double: 1.0,
+    ctypes.c_int: 1,
+}
+
+
+@contextlib.contextmanager
+def stub_environment(**values):
+    """Set environment variables (like ``SUBGRID_STUB_NX``) for a block.
+
+    The stub library reads them when it loads a model.
+    """
+    previous = dict((name, os.environ.get(name)) for name in values)
+    os.environ.update((name, str(value)) for (name, value) in values.items())
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def best_time(func, number=1000, repeat=3):
+    """Return the best time per call of ``func`` in seconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def sample_arguments(function):
+    """Return python arguments for a function from ``FUNCTIONS``."""
+    args = []
+    for argtype in function['argtypes']:
+        if argtype is ctypes.c_char_p:
+            args.append('benchmark')
+        else:
+            args.append(SAMPLE_VALUES[argtype._type_])
+    return args
+
+
+def benchmark_calls(mdu, number=10000):
+    """Return calls per second per function from ``FUNCTIONS``.
+
+    The ``raw`` numbers are for calling the ctypes functions on the library
+    with prepared pointers, the other numbers are for the wrapper functions
+    in the ``safe`` and ``fast`` call modes.
+    """
+    results = {}
+    for call_mode in CALL_MODES:
+        with SubgridWrapper(mdu=mdu, call_mode=call_mode) as subgrid:
+            for function in FUNCTIONS:
+                name = function['name']
+                if name in LIFECYCLE_FUNCTIONS:
+                    continue
+                args = sample_arguments(function)
+                wrapper_function = getattr(subgrid, name)
+                library_function = getattr(subgrid.library, name)
+                raw_args = [arg if isinstance(arg, str) else
+                            ctypes.byref(argtype._type_(arg))
+                            for (arg, argtype) in zip(args,
+                                                      function['argtypes'])]
+                result = results.setdefault(name, {})
+                result[call_mode] = 1 / best_time(
+                    lambda: wrapper_function(*args), number=number)
+                result['raw'] = 1 / best_time(
+                    lambda: library_function(*raw_args), number=number)
+    return results
+
+
+def benchmark_instruments(mdu, number=10000, trace=None):
+    """Return ``update`` calls per second with and without instrumentation.
+
+    Per call mode: ``off`` is before instrumenting, ``on`` while
+    instrumenting and ``after`` after instrumenting has been turned off
+    again. ``stats`` are the statistics of the safe mode run, the trace of
+    that run is written to file ``trace`` if you pass it.
+    """
+    results = {}
+    for call_mode in CALL_MODES:
+        with SubgridWrapper(mdu=mdu, call_mode=call_mode) as subgrid:
+            subgrid.initmodel()
+            result = results[call_mode] = {}
+
+            def update():
+                subgrid.update(-1)
+            result['off'] = 1 / best_time(update, number=number)
+            with subgrid.measure(trace=trace is not None) as instruments:
+                result['on'] = 1 / best_time(update, number=number)
+                subgrid.get_nd('s1')
+                subgrid.get_nd('pumps')
+            result['after'] = 1 / best_time(update, number=number)
+            if call_mode == 'safe':
+                results['stats'] = instruments.stats()
+                if trace is not None:
+                    instruments.write_chrome_trace(trace)
+    return results
+
+
+def benchmark_logging(mdu, lines=10, steps=2000):
+    """Return timesteps per second with the library logging a lot.
+
+    The stub library logs ``lines`` debug messages per timestep (the real
+    library logs what it logs). ``quiet`` has no log lines, ``direct`` logs
+    every line through python's logging, ``filtered`` buffers the info
+    messages and up (so the debug lines are dropped in the callback) and
+    ``buffered`` buffers all messages.
+    """
+    modes = [('quiet', 0, None), ('direct', lines, None),
+             ('filtered', lines, logging.INFO),
+             ('buffered', lines, logging.DEBUG)]
+    results = {}
+    for mode, loglines, level in modes:
+        with stub_environment(SUBGRID_STUB_LOGLINES=loglines):
+            with SubgridWrapper(mdu=mdu) as subgrid:
+                subgrid.initmodel()
+                if level is not None:
+                    subgrid.buffer_log(level=level)
+                start = time.time()
+                subgrid.run_steps(steps)
+                results[mode] = steps / (time.time() - start)
+                subgrid.buffer_log(False)
+    return results
+
+
+def benchmark_steps(subgrid, n=1000, every=10, variables=('s1', )):
+    """Return timesteps per second for python loops and ``run_steps``.
+
+    ``loop`` calls ``update`` from python and ``get_nd`` every ``every``
+    steps, ``run_steps`` does the same with the wrapper's timestep loop.
+    """
+    def loop():
+        for i in range(1, n + 1):
+            subgrid.update(-1)
+            if i % every == 0:
+                for name in variables:
+                    subgrid.get_nd(name)
+
+    def run_steps():
+        subgrid.run_steps(n, every=every, variables=variables)
+
+    return {
+        'loop': n / best_time(loop, number=1),
+        'run_steps': n / best_time(run_steps, number=1),
+    }
+
+
+def benchmark_pipeline(subgrid, steps=100, passes=10,
+                       variables=('s1', 'u1')):
+    """Return timesteps per second of a serial and of a pipelined loop.
+
+    After every timestep a hook sorts copies of ``variables`` ``passes``
+    times, as heavy post-processing. ``serial`` runs it as the callback of
+    the wrapper's ``run_steps``, ``pipelined`` in a :class:`Pipeline`. The
+    pipeline's statistics are included.
+    """
+    def hook(step, t, buffers):
+        for i in range(passes):
+            for name in variables:
+                np.sort(buffers[name])
+
+    start = time.time()
+    subgrid.run_steps(steps, variables=variables, callback=hook)
+    serial = steps / (time.time() - start)
+    pipeline = Pipeline(subgrid, variables, hooks=[hook])
+    start = time.time()
+    pipeline.run_steps(steps)
+    pipelined = steps / (time.time() - start)
+    result = dict(pipeline.stats)
+    result.update({'serial': serial, 'pipelined': pipelined})
+    return result
+
+
+def benchmark_recorder(subgrid, variables, n=1000, every=10, slots=2,
+                       store=None):
+    """Return timesteps per second with and without an output recorder.
+
+    The statistics of the recorder (bytes written, time spent writing,
+    number of stalls and the time spent in them) are included.
+    """
+    start = time.time()
+    subgrid.run_steps(n)
+    without = n / (time.time() - start)
+    directory = tempfile.mkdtemp(prefix='subgrid_recorder')
+    try:
+        recorder = OutputRecorder(subgrid, os.path.join(directory, 'output'),
+                                  variables, every=every, slots=slots,
+                                  store=store)
+        start = time.time()
+        with recorder:
+            recorder.run_steps(n)
+        with_recorder = n / (time.time() - start)
+    finally:
+        shutil.rmtree(directory)
+    result = dict(recorder.stats)
+    result.update({'without': without, 'with': with_recorder})
+    return result
+
+
+def benchmark_async(mdu, clients=8, requests=100, every=10,
+                    variables=('s1', )):
+    """Return ``get_nd`` requests per second from concurrent clients.
+
+    ``clients`` threads each do ``requests`` reads through one
+    :class:`AsyncSubgridWrapper`, while another thread calls ``update``
+    after every ``every`` reads. ``coalesced`` uses ``get_nd``, which shares
+    reads, ``separate`` queues every read on its own.
+    """
+    results = {}
+    with AsyncSubgridWrapper(mdu=mdu) as subgrid:
+        subgrid.initmodel().result()
+        for kind in ['separate', 'coalesced']:
+            if kind == 'coalesced':
+                read = subgrid.get_nd
+            else:
+                def read(name):
+                    return subgrid.submit('get_nd', name)
+
+            def client():
+                for i in range(requests):
+                    for name in variables:
+                        read(name).result()
+
+            def updater():
+                for i in range(requests // every):
+                    subgrid.update(-1).result()
+
+            threads = [threading.Thread(target=client)
+                       for i in range(clients)]
+            threads.append(threading.Thread(target=updater))
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results[kind] = (clients * requests * len(variables) /
+                             (time.time() - start))
+    return results
+
+
+def benchmark_events(subgrid, steps=10, edits=50, squares=5):
+    """Return the time per timestep for interactive edits and the savings.
+
+    Every timestep gets ``edits`` brush strokes: an absolute ``changebathy``
+    on one of ``squares`` squares, a ``dropinstantrain`` and a ``discharge``
+    with a changing value. ``direct`` calls the library for every edit,
+    ``deferred`` uses :meth:`SubgridWrapper.defer_events`. ``stats`` are the
+    calls received and saved per function.
+    """
+    def run():
+        for step in range(steps):
+            for i in range(edits):
+                offset = 10.0 * (i % squares)
+                subgrid.changebathy(20.0 + offset, 20.0, 10.0, float(i), 1)
+                subgrid.dropinstantrain(20.0 + offset, 20.0, 10.0, 1.0)
+                subgrid.discharge(30.0, 30.0, 'benchmark', 1, float(i))
+            subgrid.update(-1)
+
+    start = time.time()
+    run()
+    direct = (time.time() - start) / steps
+    subgrid.defer_events()
+    start = time.time()
+    run()
+    deferred = (time.time() - start) / steps
+    stats = subgrid.defer_events(False)
+    return {'direct': direct, 'deferred': deferred, 'stats': stats}
+
+
+def benchmark_water_levels(subgrid, n=100000, number=3):
+    """Return water level queries per second, one by one and vectorized.
+
+    ``loop`` calls the library's ``getwaterlevel`` per point, ``vectorized``
+    is ``get_water_levels`` for all ``n`` (random) points at once. ``index``
+    is the time it takes to build the cell index, once per grid.
+    """
+    start = time.time()
+    subgrid._clear_var_cache()
+    index = subgrid.grid_index().cells
+    index_time = time.time() - start
+    random = np.random.RandomState(0)
+    xs = random.uniform(index.xmin.min(), index.xmax.max(), n)
+    ys = random.uniform(index.ymin.min(), index.ymax.max(), n)
+    getwaterlevel = subgrid.library.getwaterlevel
+    level = ctypes.c_double()
+    level_p = ctypes.byref(level)
+
+    def loop():
+        for x, y in zip(xs, ys):
+            getwaterlevel(ctypes.byref(ctypes.c_double(x)),
+                          ctypes.byref(ctypes.c_double(y)), level_p)
+
+    def vectorized():
+        subgrid.get_water_levels(xs, ys)
+
+    return {
+        'index': index_time,
+        'loop': n / best_time(loop, number=1, repeat=number),
+        'vectorized': n / best_time(vectorized, number=1, repeat=number),
+    }
+
+
+def benchmark_grid(subgrid, n=10000, number=3):
+    """Return spatial queries per second, brute force and with the index.
+
+    ``nearest_link`` and ``bbox`` (a box around every point, a tenth of the
+    grid's size) are timed for ``n`` random points, against numpy over all
+    links and cells. The brute force versions do at most 1000 points.
+    """
+    start = time.time()
+    subgrid._clear_var_cache()
+    index = subgrid.grid_index()
+    index_time = time.time() - start
+    cells = index.cells
+    random = np.random.RandomState(0)
+    xs = random.uniform(cells.xmin.min(), cells.xmax.max(), n)
+    ys = random.uniform(cells.ymin.min(), cells.ymax.max(), n)
+    half = (cells.xmax.max() - cells.xmin.min()) / 20
+    link_x = index.links.xs
+    link_y = index.links.ys
+    brute = min(n, 1000)
+
+    def nearest_brute():
+        for x, y in zip(xs[:brute], ys[:brute]):
+            np.argmin(np.hypot(link_x - x, link_y - y))
+
+    def nearest_index():
+        index.nearest_link(xs, ys)
+
+    def bbox_brute():
+        for x, y in zip(xs[:brute], ys[:brute]):
+            np.flatnonzero((cells.xmax > x - half) & (cells.xmin < x + half) &
+                           (cells.ymax > y - half) & (cells.ymin < y + half))
+
+    def bbox_index():
+        for x, y in zip(xs, ys):
+            index.cells_in_bbox(x - half, y - half, x + half, y + half)
+
+    result = {'index': index_time}
+    for name, function, points in [('nearest_brute', nearest_brute, brute),
+                                   ('nearest_index', nearest_index, n),
+                                   ('bbox_brute', bbox_brute, brute),
+                                   ('bbox_index', bbox_index, n)]:
+        result[name] = points / best_time(function, number=1, repeat=number)
+    return result
+
+
+def benchmark_radar(subgrid, shape=(500, 500), number=3):
+    """Return the seconds per radar frame, regridded from scratch and cached.
+
+    ``scratch`` computes the weights for every frame, ``cached`` uses the
+    weights computed once, ``apply`` adds the rain to the model as well
+    (with ``dropinstantrain``) and ``direct`` writes it into the water
+    levels.
+    ``weights`` and ``load`` are the times to compute the weights and to
+    load them from the disk cache.
+    """
+    cells = subgrid.grid_index().cells
+    extent = (cells.xmin.min(), cells.xmax.max(),
+              cells.ymin.min(), cells.ymax.max())
+    grid = radar.RadarGrid.from_extent(extent, shape)
+    frame = np.random.RandomState(0).uniform(0, 10, shape)
+    bounds = (cells.xmin, cells.xmax, cells.ymin, cells.ymax)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        weights = radar.cached_weights(grid, *bounds, cache_dir=cache_dir)
+        weights_time = time.time() - start
+        load_time = best_time(
+            lambda: radar.cached_weights(grid, *bounds, cache_dir=cache_dir),
+            number=1, repeat=number)
+        rainfall = radar.RainfallIngestor(subgrid, grid, cache_dir=cache_dir,
+                                          read_frame=lambda source: frame)
+        direct = radar.RainfallIngestor(subgrid, grid, cache_dir=cache_dir,
+                                        read_frame=lambda source: frame,
+                                        balance=False)
+
+        def scratch():
+            radar.regrid(radar.radar_weights(grid, *bounds), frame,
+                         len(cells))
+
+        def cached():
+            radar.regrid(weights, frame, len(cells))
+
+        return {
+            'weights': weights_time,
+            'load': load_time,
+            'scratch': best_time(scratch, number=1, repeat=number),
+            'cached': best_time(cached, number=1, repeat=number),
+            'apply': best_time(lambda: rainfall.apply(frame), number=1,
+                               repeat=number),
+            'direct': best_time(lambda: direct.apply(frame), number=1,
+                                repeat=number),
+        }
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def benchmark_render(subgrid, size=256, tiles=20, number=3):
+    """Return the seconds per depth tile of ``size`` pixels per zoom level.
+
+    ``tiles`` has per pyramid level the seconds per tile, for tiles spread
+    over the grid. ``full`` is the depth of every pixel of the model, how
+    it is done without a renderer. ``build`` is the time to build the
+    renderer, ``changebathy`` the time of a ``changebathy`` plus bringing
+    the renderer up to date.
+    """
+    renderer = DepthRenderer(subgrid)
+    start = time.time()
+    renderer.build()
+    build_time = time.time() - start
+    columns, rows = renderer.cells[0].shape
+    random = np.random.RandomState(0)
+    results = {'build': build_time, 'tiles': {}}
+    for level in range(len(renderer.dps)):
+        extent = size * renderer.dx * 2 ** level
+        xs = renderer.x0 + random.uniform(0, columns * renderer.dx, tiles)
+        ys = renderer.y0 + random.uniform(0, rows * renderer.dx, tiles)
+
+        def render():
+            for x, y in zip(xs, ys):
+                renderer.render(x, y, x + extent, y + extent, width=size,
+                                height=size)
+        results['tiles'][level] = best_time(render, number=1,
+                                            repeat=number) / tiles
+    dps = subgrid._array('dps')
+
+    def full():
+        subgrid._array('s1')[renderer.cells[0]] - dps
+    results['full'] = best_time(full, number=1, repeat=number)
+    x = renderer.x0 + columns * renderer.dx / 2
+    y = renderer.y0 + rows * renderer.dx / 2
+
+    def changebathy():
+        subgrid.changebathy(x, y, 50.0, -1.0, 1)
+        renderer.sync()
+    results['changebathy'] = best_time(changebathy, number=1, repeat=number)
+    return results
+
+
+def benchmark_derived(subgrid, handlers=3, steps=20):
+    """Return the seconds per step of derived quantities for ``handlers``.
+
+    Every handler wants the depth, the wet cells and the volume of every
+    step. ``recompute`` computes them per handler from copies of ``s1`` and
+    ``dps`` (but with the bottom levels and the pixels per cell prepared
+    once), ``cached`` asks the wrapper's derived quantities.
+    """
+    bottom = subgrid.get_derived('bottom')
+    cells = subgrid.derived.get('_pixel_cells')
+    order = subgrid.derived.get('_pixel_groups').order
+    n2d = len(bottom)
+    area = float(subgrid.get_nd('dxp')) ** 2
+
+    def recompute():
+        s1 = subgrid.get_nd('s1')
+        dps = subgrid.get_nd('dps').ravel(order='F')[order]
+        depth = np.maximum(s1[:n2d] - bottom, 0.0)
+        depth > 0
+        np.bincount(cells, np.fmax(s1[cells] - dps, 0.0), minlength=n2d) * area
+
+    def cached():
+        for name in ('depth', 'wet', 'volume'):
+            subgrid.get_derived(name, view=True)
+
+    results = {}
+    for mode, handler in (('recompute', recompute), ('cached', cached)):
+        start = time.time()
+        for step in range(steps):
+            subgrid.update(-1)
+            for i in range(handlers):
+                handler()
+        results[mode] = (time.time() - start) / steps
+    start = time.time()
+    for step in range(steps):
+        subgrid.update(-1)
+    update_time = (time.time() - start) / steps
+    # Without the time of the update itself.
+    return dict((mode, seconds - update_time)
+                for (mode, seconds) in results.items())
+
+
+def flood(size, steps):
+    """Yield ``steps`` water level arrays of a flood on a ``size`` square.
+
+    The flood spreads from the center. Levels change most near the front,
+    behind it they level off and in front of it the cells stay dry: a
+    small fraction of the cells changes per step, like in a real model.
+    """
+    x, y = np.meshgrid(np.arange(size), np.arange(size))
+    distance = np.hypot(x - size / 2, y - size / 2).ravel()
+    bottom = np.random.RandomState(0).uniform(0.0, 0.05, size * size)
+    for step in range(1, steps + 1):
+        radius = size * 0.6 * step / steps
+        # One meter deep, rising over a band of a twentieth of the grid.
+        depth = np.clip((radius - distance) / (size * 0.05), 0.0, 1.0)
+        yield bottom + depth
+
+
+def benchmark_changes(size=1000, steps=100, tolerance=0.001, quantum=None,
+                      keyframe_every=50):
+    """Return the bytes and seconds per step of a flood's change stream.
+
+    ``full`` is sending the whole array as float64, ``delta`` is the
+    stream of a :class:`python_subgrid.changes.DeltaEncoder`.
+    """
+    encoder = DeltaEncoder(tolerance, keyframe_every=keyframe_every,
+                           quantum=quantum)
+    full_bytes = delta_bytes = changed = 0
+    full_seconds = encode_seconds = decode_seconds = 0.0
+    client = None
+    for levels in flood(size, steps):
+        start = time.time()
+        levels.tobytes()
+        full_seconds += time.time() - start
+        full_bytes += levels.nbytes
+        start = time.time()
+        frame = encoder.encode(levels)
+        data = frame.encode()
+        encode_seconds += time.time() - start
+        start = time.time()
+        client = Frame.decode(data).apply(client)
+        decode_seconds += time.time() - start
+        delta_bytes += len(data)
+        if not frame.keyframe:
+            changed += len(frame.values)
+    error = np.abs(client - levels).max()
+    return {
+        'changed': changed / (steps * levels.size),
+        'full_bytes': full_bytes / steps,
+        'delta_bytes': delta_bytes / steps,
+        'full': full_seconds / steps,
+        'encode': encode_seconds / steps,
+        'decode': decode_seconds / steps,
+        'error': error,
+    }
+
+
+def benchmark_ensemble(mdus, processes, jobs=16, steps=100,
+                       variables=('s1', )):
+    """Return jobs per second per number of worker processes.
+
+    The jobs are spread over the models in ``mdus``. Every ensemble first
+    runs one job per worker, so that loading the models isn't measured.
+    """
+    jobs = [Job(mdus[i % len(mdus)], steps=steps, variables=variables)
+            for i in range(jobs)]
+    results = {}
+    for n in range(1, processes + 1):
+        with Ensemble(processes=n) as ensemble:
+            ensemble.run(jobs[:n])
+            start = time.time()
+            ensemble.run(jobs)
+            results[n] = len(jobs) / (time.time() - start)
+    return results
+
+
+def resident_memory():
+    """Return the resident memory of this process in bytes (Linux only)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def benchmark_instances(mdu, threads, steps=100, work=1000):
+    """Return timesteps per second and memory per instance per number of
+    threads.
+
+    Every thread runs its own model, in a wrapper with a private copy of the
+    library. The stub library does ``work`` loop iterations per cell per
+    timestep, so that the timesteps take time outside python.
+    """
+    results = {}
+    for n in range(1, threads + 1):
+        before = resident_memory()
+        with stub_environment(SUBGRID_STUB_WORK=work):
+            wrappers = [SubgridWrapper(mdu=mdu, private_library=True)
+                        for i in range(n)]
+            # Loading a model changes the working directory, one at a time.
+            for subgrid in wrappers:
+                subgrid.start()
+                subgrid.initmodel()
+        after = resident_memory()
+        try:
+            workers = [threading.Thread(target=subgrid.run_steps,
+                                        args=(steps, ))
+                       for subgrid in wrappers]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            steps_per_second = n * steps / (time.time() - start)
+        finally:
+            for subgrid in wrappers:
+                subgrid.stop()
+        memory = None
+        if before is not None:
+            memory = (after - before) / n
+        results[n] = (steps_per_second, memory)
+    return results
+
+
+def benchmark_remote(mdu, variables=('dps', ), number=1000):
+    """Return call latency and ``get_nd`` bandwidth in and out of process.
+
+    ``latency`` is the time for a call that does next to nothing in the
+    library (``get_var_rank``), the bandwidth is in bytes per second for
+    ``get_nd`` copies and views. The ``local`` numbers are for the
+    :class:`SubgridWrapper`, the ``remote`` ones for the
+    :class:`RemoteSubgridWrapper`.
+    """
+    results = {}
+    for kind, wrapper in [('local', SubgridWrapper),
+                          ('remote', RemoteSubgridWrapper)]:
+        with wrapper(mdu=mdu) as subgrid:
+            subgrid.initmodel()
+            result = results[kind] = {
+                'latency': best_time(lambda: subgrid.get_var_rank('s1'),
+                                     number=number),
+            }
+            for name in variables:
+                nbytes = subgrid.get_nd(name).nbytes
+                result[name] = {
+                    'copy': nbytes / best_time(lambda: subgrid.get_nd(name),
+                                               number=number // 10 or 1),
+                    'view': nbytes / best_time(
+                        lambda: subgrid.get_nd(name, view=True),
+                        number=number // 10 or 1),
+                }
+    return results
+
+
+def benchmark_template(mdu, number=10):
+    """Return the time to the first ``update`` of a new model in seconds.
+
+    ``cold`` loads the model in the current process, ``remote`` in a new
+    child process (:class:`RemoteSubgridWrapper`). ``forked`` gets the model
+    from a :class:`TemplatePool` that has loaded it already.
+    """
+    def cold():
+        with SubgridWrapper(mdu=mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+
+    def remote():
+        with RemoteSubgridWrapper(mdu=mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+
+    with TemplatePool(mdu) as pool:
+        def forked():
+            with pool.get() as subgrid:
+                subgrid.update(-1)
+
+        return {
+            'cold': best_time(cold, number=number),
+            'remote': best_time(remote, number=number),
+            'forked': best_time(forked, number=number),
+        }
+
+
+def benchmark_snapshot(mdu, steps=100, number=10):
+    """Return the time to get back to the state after ``steps`` timesteps.
+
+    ``replay`` loads the model again and redoes the timesteps, ``memory``
+    and ``file`` restore a snapshot in memory and in a file. ``snapshot``
+    and ``save`` are the times to take those snapshots.
+    """
+    def replay():
+        with SubgridWrapper(mdu=mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.run_steps(steps)
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'state.snapshot')
+    try:
+        with SubgridWrapper(mdu=mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.run_steps(steps)
+            snapshot = subgrid.snapshot()
+            result = {
+                'bytes': snapshot.nbytes,
+                'snapshot': best_time(subgrid.snapshot, number=number),
+                'save': best_time(lambda: subgrid.snapshot(path=path),
+                                  number=number),
+                'memory': best_time(lambda: subgrid.restore(snapshot),
+                                    number=number),
+                'file': best_time(lambda: subgrid.restore(path),
+                                  number=number),
+            }
+        result['replay'] = best_time(replay, number=1, repeat=3)
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_start_stop(mdu, number=10):
+    """Return the time of a start/stop cycle of the wrapper in seconds.
+
+    ``cycle`` starts the wrapper (loading the library and the model) and
+    stops it, ``initmodel`` does an ``initmodel`` in between.
+    """
+    def cycle():
+        with SubgridWrapper(mdu=mdu):
+            pass
+
+    def initmodel():
+        with SubgridWrapper(mdu=mdu) as subgrid:
+            subgrid.initmodel()
+
+    return {
+        'cycle': best_time(cycle, number=number),
+        'initmodel': best_time(initmodel, number=number),
+    }
+
+
+def benchmark_suite(mdu, sizes=(32, 128, 512), pumps=(10, 1000),
+                    number=100):
+    """Return the results of the wrapper overhead benchmarks on the stub.
+
+    - ``get_nd``: per stub size (``SUBGRID_STUB_NX``) and variable the
+      bytes and the seconds per ``get_nd`` call, uncached, cached, as a
+      view and into an ``out`` array.
+
+    - ``compound``: per number of pumps the rows per second that are
+      converted row by row, into a data frame and as a view.
+
+    - ``calls``: the calls per second per function, see
+      :func:`benchmark_calls`.
+
+    - ``start_stop``: see :func:`benchmark_start_stop`.
+
+    """
+    results = {'get_nd': {}, 'compound': {}}
+    for size in sizes:
+        with stub_environment(SUBGRID_STUB_NX=size):
+            with SubgridWrapper(mdu=mdu) as subgrid:
+                subgrid.initmodel()
+                names = ['s1', 'u1', 'dps']
+                timings = benchmark_get_nd(subgrid, names, number=number)
+                for name in names:
+                    out = np.empty_like(subgrid.get_nd(name))
+                    timings[name].update({
+                        'bytes': out.nbytes,
+                        'view': best_time(
+                            lambda: subgrid.get_nd(name, view=True),
+                            number=number),
+                        'out': best_time(
+                            lambda: subgrid.get_nd(name, out=out),
+                            number=number),
+                    })
+                results['get_nd'][size] = timings
+    for rows in pumps:
+        with stub_environment(SUBGRID_STUB_PUMPS=rows):
+            with SubgridWrapper(mdu=mdu) as subgrid:
+                subgrid.initmodel()
+                timings = benchmark_compound(subgrid, 'pumps',
+                                             number=max(number // 10, 1))
+        results['compound'][rows] = dict(
+            (key, rows / timings[key]) for key in ('per_row', 'frame', 'view'))
+    results['calls'] = benchmark_calls(mdu, number=number * 10)
+    results['start_stop'] = benchmark_start_stop(mdu)
+    return results
+
+
+def functional_test_mdus():
+    """Return the mdus of the functional test scenarios that are available.
+    """
+    from python_subgrid.tests.test_functional import scenario_basedir
+    from python_subgrid.tests.test_functional import scenarios
+    mdus = [os.path.join(scenario_basedir, scenario['path'],
+                         scenario['mdu_filename'])
+            for scenario in scenarios.values()]
+    return sorted(mdu for mdu in mdus if os.path.exists(mdu))
+
+
+def benchmark_get_nd(subgrid, names, number=1000):
+    """Return ``get_nd`` latency per variable with and without variable cache.
+
+    Clearing the cache before every call gives the latency of the old
+    behaviour, where the rank, shape and type were looked up for every call.
+    """
+    results = {}
+    for name in names:
+        def uncached():
+            subgrid._clear_var_cache()
+            subgrid.get_nd(name)
+
+        def cached():
+            subgrid.get_nd(name)
+
+        results[name] = {
+            'uncached': best_time(uncached, number=number),
+            'cached': best_time(cached, number=number),
+        }
+    return results
+
+
+def benchmark_variables(subgrid, names, number=10000):
+    """Return per variable the latency of ``get_nd`` and of its descriptor.
+
+    ``get_nd`` and ``read`` copy into a preallocated array (``out``),
+    ``get_nd_view`` and ``view`` return a view.
+    """
+    results = {}
+    for name in names:
+        variable = subgrid.variables[name]
+        out = np.empty(variable.shape, dtype=variable.dtype, order='F')
+        results[name] = {
+            'get_nd': best_time(lambda: subgrid.get_nd(name, out=out),
+                                number=number),
+            'read': best_time(lambda: variable.read(out=out), number=number),
+            'get_nd_view': best_time(lambda: subgrid.get_nd(name, view=True),
+                                     number=number),
+            'view': best_time(variable.view, number=number),
+        }
+    return results
+
+
+def benchmark_compound(subgrid, name, number=100):
+    """Return the time to read a compound variable in several ways.
+
+    ``per_row`` is the old conversion of the ctypes structures to a data
+    frame, row by row. ``frame`` is the data frame that ``get_nd`` builds from
+    the structured array and ``view`` is the structured array itself.
+    """
+    info = subgrid._var_info(name)
+    data = info.ctype()
+    subgrid.library.get_var(name, ctypes.byref(data))
+
+    def per_row():
+        structs2pandas(data.contents)
+
+    def frame():
+        subgrid.get_nd(name)
+
+    def view():
+        subgrid.get_nd(name, view=True)
+
+    return {
+        'rows': info.shape[0] if info.shape else 1,
+        'per_row': best_time(per_row, number=number),
+        'frame': best_time(frame, number=number),
+        'view': best_time(view, number=number),
+    }
+
+
+def benchmark_structure_fields(subgrid, name, field, number=10):
+    """Return the number of structures updated per second.
+
+    ``single`` calls ``set_structure_field`` per structure, ``setter`` and
+    ``direct`` set all structures with one ``set_structure_fields`` call,
+    through the library's setter and straight into memory respectively.
+    """
+    ids = [id_.strip() for id_ in subgrid.get_nd(name, view=True)['id']]
+    values = subgrid.get_nd(name)[field].values
+
+    def single():
+        for id_, value in zip(ids, values):
+            subgrid.set_structure_field(name, id_, field, value)
+
+    def setter():
+        subgrid.set_structure_fields(name, ids, {field: values}, direct=False)
+
+    def direct():
+        subgrid.set_structure_fields(name, ids, {field: values})
+
+    return {
+        'structures': len(ids),
+        'single': len(ids) / best_time(single, number=number),
+        'setter': len(ids) / best_time(setter, number=number),
+        'direct': len(ids) / best_time(direct, number=number),
+    }
+
+
+def model_or_stub(args):
+    """Return the mdu passed on the command line or build the stub library.
+    """
+    if args.mdu:
+        return os.path.abspath(args.mdu)
+    directory = stub.build()
+    os.environ['SUBGRID_PATH'] = directory
+    return stub.mdu(directory)
+
+
+def run_calls(args):
+    results = benchmark_calls(model_or_stub(args), number=args.number)
+    print("{:20} {:>12} {:>12} {:>12}".format('calls/s', 'raw', 'safe',
+                                              'fast'))
+    for name, result in sorted(results.items()):
+        print("{:20} {:12.0f} {:12.0f} {:12.0f}".format(
+            name, result['raw'], result['safe'], result['fast']))
+
+
+def run_instruments(args):
+    results = benchmark_instruments(model_or_stub(args), number=args.number,
+                                    trace=args.trace)
+    for call_mode in CALL_MODES:
+        result = results[call_mode]
+        print("{}: {:.0f} updates/s off, {:.0f} instrumented, {:.0f} "
+              "turned off again".format(call_mode, result['off'],
+                                        result['on'], result['after']))
+    stats = results['stats']
+    print("{:10} {:24} {:>8} {:>10} {:>10}".format(
+        'category', 'function', 'calls', 'mean us', 'self us'))
+    for category in ('native', 'python'):
+        for name, call_stats in sorted(stats[category].items()):
+            print("{:10} {:24} {:8} {:10.2f} {:10.2f}".format(
+                category, name, call_stats['calls'], call_stats['mean'] * 1e6,
+                call_stats['self_seconds'] / call_stats['calls'] * 1e6))
+    for name, nbytes in sorted(stats['bytes'].items()):
+        print("get_nd({}): {} bytes copied, {} allocated".format(
+            name, nbytes['copied'], nbytes['allocated']))
+
+
+def run_logging(args):
+    # Like an application that shows info messages and up.
+    logging.basicConfig(level=logging.INFO)
+    results = benchmark_logging(model_or_stub(args), lines=args.lines,
+                                steps=args.steps)
+    for mode in ('quiet', 'direct', 'filtered', 'buffered'):
+        print("{:10} {:10.0f} steps/s".format(mode, results[mode]))
+
+
+def run_steps(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_steps(subgrid, n=args.steps, every=args.every,
+                                 variables=args.variables)
+    print("{:.0f} steps/s python loop, {:.0f} steps/s run_steps".format(
+        result['loop'], result['run_steps']))
+
+
+def run_async(args):
+    results = benchmark_async(model_or_stub(args), clients=args.clients,
+                              requests=args.requests, every=args.every,
+                              variables=args.variables)
+    print("{:.0f} reads/s separate, {:.0f} reads/s coalesced".format(
+        results['separate'], results['coalesced']))
+
+
+def run_pipeline(args):
+    with stub_environment(SUBGRID_STUB_NX=args.nx,
+                          SUBGRID_STUB_WORK=args.work):
+        with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+            subgrid.initmodel()
+            result = benchmark_pipeline(subgrid, steps=args.steps,
+                                        passes=args.passes,
+                                        variables=args.variables)
+    print("{:.1f} steps/s serial, {:.1f} steps/s pipelined, speedup "
+          "{:.2f}".format(result['serial'], result['pipelined'],
+                          result['pipelined'] / result['serial']))
+    print("pipelined: {:.3f} s in hooks, {:.3f} s waiting for the "
+          "library".format(result['hook_seconds'], result['wait_seconds']))
+
+
+def run_recorder(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_recorder(subgrid, args.variables, n=args.steps,
+                                    every=args.every, slots=args.slots,
+                                    store=args.store)
+    print("{:.0f} steps/s without, {:.0f} steps/s with recorder".format(
+        result['without'], result['with']))
+    print("{} records, {:.1f} MB, {:.1f} MB/s written, {} stalls "
+          "({:.3f} s)".format(result['records'],
+                              result['bytes'] / 1e6,
+                              result['bytes'] / 1e6 / result['write_seconds']
+                              if result['write_seconds'] else 0.0,
+                              result['stalls'],
+                              result['stall_seconds']))
+
+
+def run_events(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_events(subgrid, steps=args.steps,
+                                  edits=args.edits)
+    print("{:.2f} ms per step direct, {:.2f} ms per step deferred".format(
+        result['direct'] * 1e3, result['deferred'] * 1e3))
+    for name, stats in sorted(result['stats'].items()):
+        print("{:16} {:6} calls, {:6} saved".format(name, stats['received'],
+                                                    stats['saved']))
+
+
+def run_water_levels(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_water_levels(subgrid, n=args.points)
+    print("{} points: {:.0f} points/s one by one, {:.0f} points/s "
+          "vectorized, index built in {:.1f} ms".format(
+              args.points, result['loop'], result['vectorized'],
+              result['index'] * 1e3))
+
+
+def run_grid(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_grid(subgrid, n=args.points)
+    print("Index built in {:.1f} ms".format(result['index'] * 1e3))
+    for query in ('nearest', 'bbox'):
+        print("{:8} {:10.0f} points/s brute force, {:10.0f} points/s "
+              "indexed".format(query, result[query + '_brute'],
+                               result[query + '_index']))
+
+
+def run_radar(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_radar(subgrid, shape=(args.rows, args.columns))
+    print("Weights computed in {:.1f} ms, loaded in {:.1f} ms".format(
+        result['weights'] * 1e3, result['load'] * 1e3))
+    print("{:.2f} ms per frame from scratch, {:.2f} ms cached, {:.2f} ms "
+          "including adding the rain, {:.2f} ms writing it into the water "
+          "levels".format(result['scratch'] * 1e3, result['cached'] * 1e3,
+                          result['apply'] * 1e3, result['direct'] * 1e3))
+
+
+def run_derived(args):
+    with stub_environment(SUBGRID_STUB_NX=args.nx):
+        with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+            subgrid.initmodel()
+            result = benchmark_derived(subgrid, handlers=args.handlers,
+                                       steps=args.steps)
+    print("{} handlers: {:.2f} ms per step recomputing, {:.2f} ms "
+          "cached".format(args.handlers, result['recompute'] * 1e3,
+                          result['cached'] * 1e3))
+
+
+def run_render(args):
+    with stub_environment(SUBGRID_STUB_NX=args.nx):
+        with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            result = benchmark_render(subgrid, size=args.size,
+                                      tiles=args.tiles)
+    print("Renderer built in {:.1f} ms, a changebathy and update take "
+          "{:.2f} ms".format(result['build'] * 1e3,
+                             result['changebathy'] * 1e3))
+    print("Depth of every pixel: {:.1f} ms".format(result['full'] * 1e3))
+    for level, seconds in sorted(result['tiles'].items()):
+        print("Level {}: {:.2f} ms per {} pixel tile".format(
+            level, seconds * 1e3, args.size))
+
+
+def run_changes(args):
+    result = benchmark_changes(size=args.size, steps=args.steps,
+                               tolerance=args.tolerance, quantum=args.quantum,
+                               keyframe_every=args.keyframe_every)
+    print("{:.1%} of the cells changed per step".format(result['changed']))
+    print("{:.0f} bytes per step in full, {:.0f} as a change stream "
+          "({:.1%})".format(result['full_bytes'], result['delta_bytes'],
+                            result['delta_bytes'] / result['full_bytes']))
+    print("{:.2f} ms per step to encode, {:.2f} ms to decode, max error "
+          "{:.2g}".format(result['encode'] * 1e3, result['decode'] * 1e3,
+                          result['error']))
+
+
+def run_ensemble(args):
+    if args.mdu:
+        mdus = [os.path.abspath(mdu) for mdu in args.mdu]
+    else:
+        mdus = functional_test_mdus()
+    if not mdus:
+        args.mdu = None
+        mdus = [model_or_stub(args)]
+    results = benchmark_ensemble(mdus, args.processes, jobs=args.jobs,
+                                 steps=args.steps)
+    for processes, jobs_per_second in sorted(results.items()):
+        print("{} processes: {:.2f} jobs/s, speedup {:.2f}".format(
+            processes, jobs_per_second, jobs_per_second / results[1]))
+
+
+def run_instances(args):
+    results = benchmark_instances(model_or_stub(args), args.threads,
+                                  steps=args.steps, work=args.work)
+    for threads, (steps_per_second, memory) in sorted(results.items()):
+        print("{} threads: {:.1f} steps/s, speedup {:.2f}, {} per "
+              "instance".format(
+                  threads, steps_per_second,
+                  steps_per_second / results[1][0],
+                  'unknown MB' if memory is None
+                  else '{:.1f} MB'.format(memory / 1e6)))
+
+
+def run_remote(args):
+    results = benchmark_remote(model_or_stub(args), variables=args.variables,
+                               number=args.number)
+    for kind, result in sorted(results.items()):
+        print("{}: {:.1f} us per call".format(kind, result['latency'] * 1e6))
+        for name in args.variables:
+            print("    get_nd({}): {:.0f} MB/s copy, {:.0f} MB/s view".format(
+                name, result[name]['copy'] / 1e6, result[name]['view'] / 1e6))
+
+
+def run_template(args):
+    result = benchmark_template(model_or_stub(args), number=args.number)
+    print("time to first update: {:.1f} ms cold, {:.1f} ms cold in a child "
+          "process, {:.1f} ms forked from a template".format(
+              result['cold'] * 1e3, result['remote'] * 1e3,
+              result['forked'] * 1e3))
+
+
+def run_snapshot(args):
+    result = benchmark_snapshot(model_or_stub(args), steps=args.steps,
+                                number=args.number)
+    print("{} bytes: snapshot {:.3f} ms, to a file {:.3f} ms".format(
+        result['bytes'], result['snapshot'] * 1e3, result['save'] * 1e3))
+    print("back to step {}: {:.1f} ms reload and replay, {:.3f} ms restore, "
+          "{:.3f} ms restore from a file".format(
+              args.steps, result['replay'] * 1e3, result['memory'] * 1e3,
+              result['file'] * 1e3))
+
+
+def run_get_nd(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        results = benchmark_get_nd(subgrid, args.variables,
+                                   number=args.number)
+    for name, result in sorted(results.items()):
+        print("get_nd({}): {:.1f} us uncached, {:.1f} us cached".format(
+            name, result['uncached'] * 1e6, result['cached'] * 1e6))
+
+
+def run_variables(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        results = benchmark_variables(subgrid, args.variables,
+                                      number=args.number)
+        count = len(subgrid.variables)
+        total = subgrid.variables.nbytes
+    print("{} variables, {:.1f} MB".format(count, total / 1e6))
+    for name, result in sorted(results.items()):
+        print("{}: copy {:.1f} us with get_nd, {:.1f} us with the "
+              "descriptor; view {:.1f} us, {:.1f} us".format(
+                  name, result['get_nd'] * 1e6, result['read'] * 1e6,
+                  result['get_nd_view'] * 1e6, result['view'] * 1e6))
+
+
+def run_suite(args):
+    directory = None
+    if args.mdu:
+        mdu = os.path.abspath(args.mdu)
+    else:
+        directory = stub.build()
+        os.environ['SUBGRID_PATH'] = directory
+        mdu = stub.mdu(directory)
+    try:
+        results = benchmark_suite(mdu, sizes=args.sizes, pumps=args.pumps,
+                                  number=args.number)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    results['time'] = time.time()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+def run_compound(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_compound(subgrid, args.variable,
+                                    number=args.number)
+    print("{} ({} rows): {:.1f} ms per row, {:.1f} ms data frame, "
+          "{:.1f} us view".format(args.variable,
+                                  result['rows'],
+                                  result['per_row'] * 1e3,
+                                  result['frame'] * 1e3,
+                                  result['view'] * 1e6))
+
+
+def run_structure_fields(args):
+    with SubgridWrapper(mdu=model_or_stub(args)) as subgrid:
+        subgrid.initmodel()
+        result = benchmark_structure_fields(subgrid, args.variable,
+                                            args.field, number=args.number)
+    print("{}.{} ({} structures): {:.0f}/s one by one, {:.0f}/s bulk "
+          "setter, {:.0f}/s bulk direct".format(args.variable,
+                                                args.field,
+                                                result['structures'],
+                                                result['single'],
+                                                result['setter'],
+                                                result['direct']))
+
+
+def main():
+    """Run one of the benchmarks, see ``--help``."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers()
+
+    calls = subparsers.add_parser('calls', help="function call overhead")
+    calls.add_argument('--mdu', help="model to use instead of the stub")
+    calls.add_argument('--number', type=int, default=10000)
+    calls.set_defaults(func=run_calls)
+
+    instruments = subparsers.add_parser(
+        'instruments', help="overhead and output of the instrumentation")
+    instruments.add_argument('--mdu', help="model to use instead of the stub")
+    instruments.add_argument('--number', type=int, default=10000)
+    instruments.add_argument('--trace', help="write a chrome trace here")
+    instruments.set_defaults(func=run_instruments)
+
+    logging_ = subparsers.add_parser(
+        'logging', help="timesteps with verbose library logging")
+    logging_.add_argument('--mdu', help="model to use instead of the stub")
+    logging_.add_argument('--lines', type=int, default=10,
+                          help="debug lines per timestep (stub only)")
+    logging_.add_argument('--steps', type=int, default=2000)
+    logging_.set_defaults(func=run_logging)
+
+    steps = subparsers.add_parser('steps', help="timestep loop overhead")
+    steps.add_argument('--mdu', help="model to use instead of the stub")
+    steps.add_argument('--steps', type=int, default=10000)
+    steps.add_argument('--every', type=int, default=10)
+    steps.add_argument('--variables', nargs='+', default=['s1'])
+    steps.set_defaults(func=run_steps)
+
+    async_ = subparsers.add_parser(
+        'async', help="concurrent reads through the model thread")
+    async_.add_argument('--mdu', help="model to use instead of the stub")
+    async_.add_argument('--clients', type=int, default=8)
+    async_.add_argument('--requests', type=int, default=100)
+    async_.add_argument('--every', type=int, default=10)
+    async_.add_argument('--variables', nargs='+', default=['s1'])
+    async_.set_defaults(func=run_async)
+
+    pipeline = subparsers.add_parser(
+        'pipeline', help="timesteps overlapped with post-processing")
+    pipeline.add_argument('--mdu', help="model to use instead of the stub")
+    pipeline.add_argument('--steps', type=int, default=100)
+    pipeline.add_argument('--passes', type=int, default=3,
+                          help="sorts of every variable per step")
+    pipeline.add_argument('--variables', nargs='+', default=['s1', 'u1'])
+    pipeline.add_argument('--nx', type=int, default=256,
+                          help="size of the stub model")
+    pipeline.add_argument('--work', type=int, default=50,
+                          help="stub loop iterations per cell per step")
+    pipeline.set_defaults(func=run_pipeline)
+
+    recorder = subparsers.add_parser('recorder',
+                                     help="output recorder throughput")
+    recorder.add_argument('--mdu', help="model to use instead of the stub")
+    recorder.add_argument('--steps', type=int, default=1000)
+    recorder.add_argument('--every', type=int, default=10)
+    recorder.add_argument('--variables', nargs='+', default=['s1', 'dps'])
+    recorder.add_argument('--slots', type=int, default=2)
+    recorder.add_argument('--store', choices=['hdf5', 'raw'])
+    recorder.set_defaults(func=run_recorder)
+
+    events = subparsers.add_parser('events',
+                                   help="deferred interactive edits")
+    events.add_argument('--mdu', help="model to use instead of the stub")
+    events.add_argument('--steps', type=int, default=10)
+    events.add_argument('--edits', type=int, default=50)
+    events.set_defaults(func=run_events)
+
+    water_levels = subparsers.add_parser(
+        'water_levels', help="water level queries for many points")
+    water_levels.add_argument('--mdu',
+                              help="model to use instead of the stub")
+    water_levels.add_argument('--points', type=int, default=100000)
+    water_levels.set_defaults(func=run_water_levels)
+
+    grid = subparsers.add_parser('grid',
+                                 help="spatial queries on the grid")
+    grid.add_argument('--mdu', help="model to use instead of the stub")
+    grid.add_argument('--points', type=int, default=10000)
+    grid.set_defaults(func=run_grid)
+
+    radar_ = subparsers.add_parser('radar', help="radar rainfall regridding")
+    radar_.add_argument('--mdu', help="model to use instead of the stub")
+    radar_.add_argument('--rows', type=int, default=500)
+    radar_.add_argument('--columns', type=int, default=500)
+    radar_.set_defaults(func=run_radar)
+
+    derived = subparsers.add_parser(
+        'derived', help="derived quantities, recomputed and cached")
+    derived.add_argument('--mdu', help="model to use instead of the stub")
+    derived.add_argument('--nx', type=int, default=512,
+                         help="size of the stub model (SUBGRID_STUB_NX)")
+    derived.add_argument('--handlers', type=int, default=3)
+    derived.add_argument('--steps', type=int, default=20)
+    derived.set_defaults(func=run_derived)
+
+    render = subparsers.add_parser('render', help="water depth tiles")
+    render.add_argument('--mdu', help="model to use instead of the stub")
+    render.add_argument('--nx', type=int, default=512,
+                        help="size of the stub model (SUBGRID_STUB_NX)")
+    render.add_argument('--size', type=int, default=256,
+                        help="tile width and height in pixels")
+    render.add_argument('--tiles', type=int, default=20)
+    render.set_defaults(func=run_render)
+
+    changes = subparsers.add_parser(
+        'changes', help="change stream of a synthetic flood")
+    changes.add_argument('--size', type=int, default=1000,
+                         help="cells per side of the square grid")
+    changes.add_argument('--steps', type=int, default=100)
+    changes.add_argument('--tolerance', type=float, default=0.001)
+    changes.add_argument('--quantum', type=float,
+                         help="send quantized values instead of float32")
+    changes.add_argument('--keyframe-every', type=int, default=50)
+    changes.set_defaults(func=run_changes)
+
+    ensemble = subparsers.add_parser(
+        'ensemble', help="scaling of the ensemble runner over processes")
+    ensemble.add_argument('--mdu', nargs='+',
+                          help="models to use instead of the functional "
+                          "test scenarios (or the stub, if those are missing)")
+    ensemble.add_argument('--processes', type=int,
+                          default=multiprocessing.cpu_count())
+    ensemble.add_argument('--jobs', type=int, default=16)
+    ensemble.add_argument('--steps', type=int, default=100)
+    ensemble.set_defaults(func=run_ensemble)
+
+    instances = subparsers.add_parser(
+        'instances', help="models with private libraries in threads")
+    instances.add_argument('--mdu', help="model to use instead of the stub")
+    instances.add_argument('--threads', type=int,
+                           default=multiprocessing.cpu_count())
+    instances.add_argument('--steps', type=int, default=100)
+    instances.add_argument('--work', type=int, default=1000,
+                           help="stub loop iterations per cell per step")
+    instances.set_defaults(func=run_instances)
+
+    remote = subparsers.add_parser(
+        'remote', help="overhead of running the model in a child process")
+    remote.add_argument('--mdu', help="model to use instead of the stub")
+    remote.add_argument('--variables', nargs='+', default=['dps'])
+    remote.add_argument('--number', type=int, default=1000)
+    remote.set_defaults(func=run_remote)
+
+    snapshot = subparsers.add_parser(
+        'snapshot', help="snapshot and restore, against reload and replay")
+    snapshot.add_argument('--mdu', help="model to use instead of the stub")
+    snapshot.add_argument('--steps', type=int, default=100)
+    snapshot.add_argument('--number', type=int, default=10)
+    snapshot.set_defaults(func=run_snapshot)
+
+    template = subparsers.add_parser(
+        'template', help="model startup, cold and forked from a template")
+    template.add_argument('--mdu', help="model to use instead of the stub")
+    template.add_argument('--number', type=int, default=10)
+    template.set_defaults(func=run_template)
+
+    get_nd = subparsers.add_parser('get_nd', help="get_nd latency")
+    get_nd.add_argument('--mdu', help="model to use instead of the stub")
+    get_nd.add_argument('--variables', nargs='+', default=['s1'])
+    get_nd.add_argument('--number', type=int, default=1000)
+    get_nd.set_defaults(func=run_get_nd)
+
+    variables = subparsers.add_parser(
+        'variables', help="variable descriptors against get_nd")
+    variables.add_argument('--mdu', help="model to use instead of the stub")
+    variables.add_argument('--variables', nargs='+', default=['s1', 't1'])
+    variables.add_argument('--number', type=int, default=10000)
+    variables.set_defaults(func=run_variables)
+
+    suite = subparsers.add_parser(
+        'suite', help="wrapper overhead on the stub library, as JSON")
+    suite.add_argument('--mdu', help="stub model of an already built stub")
+    suite.add_argument('--sizes', type=int, nargs='+', default=[32, 128, 512],
+                       help="stub sizes (SUBGRID_STUB_NX) for get_nd")
+    suite.add_argument('--pumps', type=int, nargs='+', default=[10, 1000],
+                       help="numbers of pumps for the compound conversion")
+    suite.add_argument('--number', type=int, default=100)
+    suite.add_argument('--output', help="write the JSON here")
+    suite.set_defaults(func=run_suite)
+
+    compound = subparsers.add_parser('compound',
+                                     help="compound variable conversion")
+    compound.add_argument('--mdu', help="model to use instead of the stub")
+    compound.add_argument('--variable', default='pumps')
+    compound.add_argument('--number', type=int, default=100)
+    compound.set_defaults(func=run_compound)
+
+    structure_fields = subparsers.add_parser(
+        'structure_fields', help="structure field update throughput")
+    structure_fields.add_argument('--mdu',
+                                  help="model to use instead of the stub")
+    structure_fields.add_argument('--variable', default='pumps')
+    structure_fields.add_argument('--field', default='capacity')
+    structure_fields.add_argument('--number', type=int, default=10)
+    structure_fields.set_defaults(func=run_structure_fields)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
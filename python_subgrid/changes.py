@@ -0,0 +1,229 @@
+"""Stream the changes of grid variables instead of the full arrays.
+
+Between two timesteps most cells of ``s1`` hardly change. A
+:class:`DeltaEncoder` keeps the array that a client has (what it sent
+before) and only sends the cells that differ more than a tolerance from
+it. The cells go as sorted runs of indices (``start, length`` pairs) plus
+their values as float32, or as integers when you pass a ``quantum``. Every
+``keyframe_every`` frames (and when the shape changes) the full array is
+sent, so new clients can join and errors can't pile up::
+
+    tracker = ChangeTracker(subgrid, {'s1': 0.001, 'u1': 0.01})
+    for i in range(100):
+        subgrid.update(-1)
+        for name, frame in tracker.extract():
+            send(name, frame.encode())
+
+A client keeps an array per variable and updates it with
+:meth:`Frame.apply`, after ``Frame.decode(data)``.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import collections
+import struct
+
+import numpy as np
+
+# Keyframe flag, value type (``'f'``: float32, ``'q'``: quantized int32),
+# step, number of dimensions, number of runs, number of values, quantum.
+HEADER = struct.Struct('<?cqBIId')
+# The quantized value of NaN (values are whole multiples of the quantum).
+QUANTIZED_NAN = np.iinfo('i4').min
+
+
+class Frame(collections.namedtuple(
+        'Frame', ['step', 'keyframe', 'shape', 'runs', 'values', 'quantum'])):
+    """The changed cells of one variable at one step.
+
+    ``runs`` is an int32 array of ``(start, length)`` rows of flat indices
+    (in the library's Fortran order). ``values`` are float32, or int32
+    multiples of ``quantum`` with ``QUANTIZED_NAN`` for NaN. A keyframe has
+    all cells as one run.
+    """
+
+    def indices(self):
+        """Return the flat indices of the changed cells."""
+        if not len(self.runs):
+            return np.empty(0, dtype='i8')
+        starts = self.runs[:, 0].astype('i8')
+        lengths = self.runs[:, 1].astype('i8')
+        # Per index its run's start, plus its position within the run.
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def decoded_values(self):
+        """Return the values as float64."""
+        if self.quantum:
+            values = self.values * self.quantum
+            values[self.values == QUANTIZED_NAN] = np.nan
+            return values
+        return self.values.astype('f8')
+
+    def apply(self, array=None):
+        """Update ``array`` (Fortran ordered) with the frame, return it.
+
+        A keyframe allocates the array if you don't pass one (or if it has
+        another shape).
+        """
+        if array is None or array.shape != self.shape:
+            if not self.keyframe:
+                raise ValueError("A delta needs the array of a keyframe")
+            array = np.empty(self.shape, dtype='f8', order='F')
+        flat = array.ravel(order='F')
+        if not np.may_share_memory(flat, array):
+            raise ValueError("The array has to be contiguous")
+        flat[self.indices()] = self.decoded_values()
+        return array
+
+    def encode(self):
+        """Return the frame as bytes."""
+        value_type = b'q' if self.quantum else b'f'
+        header = HEADER.pack(self.keyframe, value_type, self.step,
+                             len(self.shape), len(self.runs),
+                             len(self.values), self.quantum or 0.0)
+        shape = np.array(self.shape, dtype='<i8')
+        return b''.join([header, shape.tobytes(),
+                         self.runs.astype('<i4').tobytes(),
+                         self.values.astype(
+                             '<i4' if self.quantum else '<f4').tobytes()])
+
+    @classmethod
+    def decode(cls, data):
+        """Return the frame encoded in bytes ``data``."""
+        (keyframe, value_type, step, ndim, nruns, nvalues,
+         quantum) = HEADER.unpack_from(data)
+        offset = HEADER.size
+        shape = np.frombuffer(data, dtype='<i8', count=ndim, offset=offset)
+        offset += 8 * ndim
+        runs = np.frombuffer(data, dtype='<i4', count=2 * nruns,
+                             offset=offset).reshape(nruns, 2)
+        offset += 8 * nruns
+        dtype = '<i4' if value_type == b'q' else '<f4'
+        values = np.frombuffer(data, dtype=dtype, count=nvalues,
+                               offset=offset)
+        return cls(step, keyframe, tuple(int(size) for size in shape), runs,
+                   values, quantum if value_type == b'q' else None)
+
+    @property
+    def nbytes(self):
+        return (HEADER.size + 8 * len(self.shape) + self.runs.nbytes +
+                self.values.nbytes)
+
+
+def runs_of(indices):
+    """Return the ``(start, length)`` runs of sorted ``indices``."""
+    if not len(indices):
+        return np.empty((0, 2), dtype='i4')
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(indices)]])
+    return np.column_stack([indices[starts], ends - starts]).astype('i4')
+
+
+class DeltaEncoder(object):
+    """Encode successive versions of one array as :class:`Frame` objects.
+
+    Cells that differ more than ``tolerance`` from what was sent before are
+    sent. With ``quantum`` the values are sent as integer multiples of it,
+    keep ``tolerance`` at least half of ``quantum``. With ``keyframe_every``
+    0 only the first frame (and the frames after a change of shape) is a
+    keyframe.
+    """
+
+    def __init__(self, tolerance=0.0, keyframe_every=100, quantum=None):
+        self.tolerance = tolerance
+        self.keyframe_every = keyframe_every
+        self.quantum = quantum
+        self.previous = None
+        self.frames = 0
+
+    def _round(self, values):
+        """Return the values as sent (float32 or quantized) and as the
+        client will see them.
+        """
+        if self.quantum:
+            missing = np.isnan(values)
+            sent = np.round(np.where(missing, 0.0, values) /
+                            self.quantum).astype('i4')
+            sent[missing] = QUANTIZED_NAN
+            seen = sent * self.quantum
+            seen[missing] = np.nan
+            return sent, seen
+        sent = values.astype('f4')
+        return sent, sent.astype('f8')
+
+    def encode(self, array, step=None, keyframe=False):
+        """Return the frame that brings the client from the previous
+        version to ``array``.
+        """
+        if step is None:
+            step = self.frames
+        flat = np.asarray(array, dtype='f8').ravel(order='F')
+        previous = self.previous
+        keyframe = (keyframe or previous is None or
+                    previous.shape != np.shape(array) or
+                    (self.keyframe_every and
+                     self.frames % self.keyframe_every == 0))
+        if keyframe:
+            self.previous = np.empty(np.shape(array), dtype='f8', order='F')
+            sent, seen = self._round(flat)
+            self.previous.ravel(order='F')[...] = seen
+            runs = np.array([[0, len(flat)]] if len(flat) else [],
+                            dtype='i4').reshape(-1, 2)
+        else:
+            known = previous.ravel(order='F')
+            with np.errstate(invalid='ignore'):
+                unchanged = np.abs(flat - known) <= self.tolerance
+            # NaN stays NaN: unchanged as well.
+            unchanged |= np.isnan(flat) & np.isnan(known)
+            indices = np.flatnonzero(~unchanged)
+            sent, seen = self._round(flat[indices])
+            known[indices] = seen
+            runs = runs_of(indices)
+        self.frames += 1
+        return Frame(step, keyframe, tuple(int(size) for size in
+                                           np.shape(array)),
+                     runs, sent, self.quantum)
+
+
+class ChangeTracker(object):
+    """Extract the changes of variables of a started wrapper.
+
+    ``tolerances`` has the tolerance per variable, ``quantums`` optionally
+    the quantum per variable (see :class:`DeltaEncoder`).
+    """
+
+    def __init__(self, subgrid, tolerances, keyframe_every=100,
+                 quantums=None):
+        self.subgrid = subgrid
+        quantums = quantums or {}
+        self.encoders = collections.OrderedDict(
+            (name, DeltaEncoder(tolerance, keyframe_every=keyframe_every,
+                                quantum=quantums.get(name)))
+            for (name, tolerance) in sorted(tolerances.items()))
+        self.stats = collections.Counter()
+
+    def extract(self, step=None, keyframe=False, flush_events=False):
+        """Return a ``(name, frame)`` list for the current model state.
+
+        ``keyframe`` forces keyframes, for instance for a new client. The
+        deferred edits (see
+        :meth:`python_subgrid.wrapper.SubgridWrapper.defer_events`) aren't
+        in the model's state yet, with ``flush_events`` they are applied
+        first.
+        """
+        if flush_events:
+            self.subgrid.flush_events()
+        result = []
+        for name, encoder in self.encoders.items():
+            self.subgrid._check_documented(name)
+            array = self.subgrid._array(name)
+            if array is None:
+                continue
+            frame = encoder.encode(array, step=step, keyframe=keyframe)
+            self.stats['full_bytes'] += array.nbytes
+            self.stats['bytes'] += frame.nbytes
+            self.stats['keyframes' if frame.keyframe else 'deltas'] += 1
+            result.append((name, frame))
+        return result
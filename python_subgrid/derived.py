@@ -0,0 +1,351 @@
+"""Quantities derived from the model's variables, computed once per step.
+
+Water depth, volume, velocity magnitude and wet cells are computed from
+``s1``, ``u1``, ``dps`` and the grid. :meth:`DerivedVariables.get` (or
+:meth:`python_subgrid.wrapper.SubgridWrapper.get_derived`) computes a
+quantity when it is first asked for and keeps it until one of the variables
+it depends on changes::
+
+    subgrid.update(-1)
+    depth = subgrid.get_derived('depth', view=True)  # computed
+    wet = subgrid.get_derived('wet', view=True)  # uses the cached depth
+
+The state (``s1``, ``u1``, ...) changes with the wrapper's ``generation``
+(so with every ``update``), the grid and the bathymetry (the
+``STATIC_VARIABLES``) only with the calls in the wrapper's ``edits``
+(``changebathy``, ``initmodel``...). So the per-cell bottom levels survive
+the timesteps and a depth is one subtraction per step.
+
+Quantities are registered in ``DERIVED_VARIABLES`` with the :func:`derived`
+decorator, with the (raw or derived) variables they depend on. Names that
+start with an underscore are intermediate results. A quantity's function
+gets a :class:`Buffers` to compute into, so nothing is allocated in the
+steps after the first.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import collections
+
+import numpy as np
+
+from python_subgrid.grid import CellIndex
+from python_subgrid.render import NODATA
+from python_subgrid.render import cell_map
+
+# Variables that only change with the grid or the bathymetry, see the
+# wrapper's ``edits``.
+STATIC_VARIABLES = [
+    'dps',
+    'dxp',
+    'FlowElem_xcc',
+    'FlowElem_ycc',
+    'FlowElemContour_x',
+    'FlowElemContour_y',
+    'FlowLink_xu',
+    'FlowLink_yu',
+    'nFlowElem1d',
+    'nFlowElem2d',
+    'x0p',
+    'y0p',
+]
+
+Derived = collections.namedtuple('Derived', ['depends', 'compute', 'doc'])
+
+DERIVED_VARIABLES = collections.OrderedDict()
+
+
+def derived(name, depends):
+    """Register the decorated function as derived quantity ``name``.
+
+    The function is called with a :class:`Buffers` and the values of the
+    ``depends`` variables, its docstring documents the quantity.
+    """
+    def register(compute):
+        DERIVED_VARIABLES[name] = Derived(tuple(depends), compute,
+                                          compute.__doc__)
+        return compute
+    return register
+
+
+class Buffers(object):
+    """Preallocated arrays of a derived quantity, reused while their shape
+    stays the same.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self, name, shape, dtype='f8'):
+        """Return the (uninitialized) array ``name``."""
+        if np.isscalar(shape):
+            shape = (shape, )
+        array = self.arrays.get(name)
+        if (array is None or array.shape != tuple(shape) or
+                array.dtype != np.dtype(dtype)):
+            array = self.arrays[name] = np.empty(shape, dtype=dtype)
+        return array
+
+
+class Groups(object):
+    """Items grouped per cell, for reductions per cell with ``reduceat``.
+
+    ``cells`` has the cell per item (-1 for none). ``order`` has the items
+    sorted per cell, ``starts`` where the group of every cell in ``cells``
+    starts in that order and ``counts`` its size.
+    """
+
+    def __init__(self, item_cells):
+        valid = np.flatnonzero(item_cells >= 0)
+        self.order = valid[np.argsort(item_cells[valid], kind='mergesort')]
+        sorted_cells = item_cells[self.order]
+        self.starts = np.flatnonzero(np.diff(sorted_cells) != 0) + 1
+        if len(sorted_cells):
+            self.starts = np.concatenate([[0], self.starts])
+        self.cells = sorted_cells[self.starts]
+        self.counts = np.diff(np.append(self.starts, len(sorted_cells)))
+
+
+class DerivedVariables(object):
+    """Lazily computed, cached derived quantities of a started wrapper."""
+
+    def __init__(self, subgrid):
+        self.subgrid = subgrid
+        # Per quantity the key it was computed for and its value.
+        self.cache = {}
+        self.buffers = collections.defaultdict(Buffers)
+        self.stats = collections.Counter()
+
+    def key(self, name):
+        """Return what the value of variable ``name`` depends on."""
+        if name in DERIVED_VARIABLES:
+            return tuple(self.key(dependency) for dependency
+                         in DERIVED_VARIABLES[name].depends)
+        if name in STATIC_VARIABLES:
+            # Only counts the calls that change the grid or the bathymetry,
+            # not every call that reallocates arrays.
+            return self.subgrid.edit_count
+        return (self.subgrid.edit_count, self.subgrid.generation)
+
+    def get(self, name):
+        """Return the (cached) value of derived quantity ``name``.
+
+        Arrays are the quantity's own buffers, they change when the
+        quantity is computed again.
+        """
+        try:
+            variable = DERIVED_VARIABLES[name]
+        except KeyError:
+            raise ValueError("Unknown derived variable '{}', use one of "
+                             "{}".format(name, sorted(DERIVED_VARIABLES)))
+        key = self.key(name)
+        cached = self.cache.get(name)
+        if cached is not None and cached[0] == key:
+            self.stats['hits'] += 1
+            return cached[1]
+        values = []
+        for dependency in variable.depends:
+            if dependency in DERIVED_VARIABLES:
+                values.append(self.get(dependency))
+                continue
+            value = self.subgrid._array(dependency)
+            if value is None:
+                raise ValueError("Variable '{}' has no data, '{}' needs "
+                                 "it".format(dependency, name))
+            values.append(value)
+        value = variable.compute(self.buffers[name], *values)
+        self.cache[name] = (key, value)
+        self.stats['computed'] += 1
+        return value
+
+
+@derived('_pixel_groups', ['FlowElemContour_x', 'FlowElemContour_y', 'x0p',
+                           'y0p', 'dxp', 'dps'])
+def pixel_groups(buffers, contour_x, contour_y, x0p, y0p, dxp, dps):
+    """The pixels of ``dps`` (flat, in Fortran order) grouped per cell."""
+    cells = CellIndex(contour_x, contour_y)
+    pixel_cells = cell_map(cells.xmin, cells.xmax, cells.ymin, cells.ymax,
+                           float(x0p), float(y0p), float(dxp), dps.shape)
+    return Groups(pixel_cells.ravel(order='F'))
+
+
+@derived('_sorted_dps', ['_pixel_groups', 'dps'])
+def sorted_dps(buffers, groups, dps):
+    """``dps`` of the pixels in cells, grouped per cell, NaN for missing."""
+    out = buffers.get('out', len(groups.order))
+    np.take(dps.ravel(order='F'), groups.order, out=out)
+    out[out == NODATA] = np.nan
+    return out
+
+
+class Storage(object):
+    """The bathymetry of the 2d cells as storage: the volume of water a cell
+    holds at a water level and the water level for a volume.
+
+    ``levels`` has the bathymetry of the pixels with bathymetry, sorted per
+    cell (``cells``, ``starts`` and ``counts`` as in :class:`Groups`) and
+    within a cell from low to high. ``area`` is the area of a pixel.
+    """
+
+    def __init__(self, groups, dps, area):
+        pixel_cells = np.repeat(groups.cells, groups.counts)
+        valid = ~np.isnan(dps)
+        pixel_cells = pixel_cells[valid]
+        levels = dps[valid]
+        order = np.lexsort((levels, pixel_cells))
+        self.levels = levels[order]
+        self.pixel_cells = pixel_cells[order]
+        self.area = area
+        grouped = Groups(self.pixel_cells)
+        self.cells, self.starts, self.counts = (grouped.cells, grouped.starts,
+                                                grouped.counts)
+        # Per pixel how many pixels of its cell are as low or lower and the
+        # sum of their levels: the volume when the water is at its level.
+        offsets = np.repeat(self.starts, self.counts)
+        self.ranks = np.arange(len(self.levels)) - offsets + 1
+        sums = np.cumsum(self.levels)
+        if len(sums):
+            before = (sums - self.levels)[self.starts]
+            sums -= np.repeat(before, self.counts)
+        self.sums = sums
+        self.volumes = area * (self.ranks * self.levels - sums)
+
+    def volume(self, s1):
+        """Return the volume per cell in ``cells`` at water levels ``s1``."""
+        if not len(self.starts):
+            return np.empty(0)
+        depths = np.take(s1, self.pixel_cells) - self.levels
+        np.maximum(depths, 0.0, out=depths)
+        return np.add.reduceat(depths, self.starts) * self.area
+
+    def level(self, volume):
+        """Return the water level per cell in ``cells`` that holds
+        ``volume``.
+
+        The level is at least the lowest bathymetry of the cell.
+        """
+        if not len(self.starts):
+            return np.empty(0)
+        volume = np.maximum(volume, 0.0)
+        # The pixels under water are the ones whose volume at their own
+        # level is below the cell's volume, the level spreads the rest
+        # over them.
+        wet = self.volumes <= np.repeat(volume, self.counts)
+        ranks = np.add.reduceat(wet, self.starts)
+        sums = np.add.reduceat(np.where(wet, self.levels, 0.0), self.starts)
+        return (volume / self.area + sums) / ranks
+
+
+@derived('_storage', ['_pixel_groups', '_sorted_dps', 'dxp'])
+def storage(buffers, groups, dps, dxp):
+    """The :class:`Storage` of the 2d cells."""
+    return Storage(groups, dps, float(dxp) ** 2)
+
+
+@derived('area', ['_storage', 'nFlowElem2d'])
+def area(buffers, storage, n2d):
+    """Area per 2d cell of its pixels with bathymetry, that can hold water."""
+    out = buffers.get('out', int(n2d))
+    out.fill(0.0)
+    out[storage.cells] = storage.counts * storage.area
+    return out
+
+
+@derived('_pixel_cells', ['_pixel_groups'])
+def pixel_cells(buffers, groups):
+    """The cell of every pixel of ``_sorted_dps``."""
+    return np.repeat(groups.cells, groups.counts)
+
+
+@derived('bottom', ['_pixel_groups', '_sorted_dps', 'nFlowElem2d'])
+def bottom(buffers, groups, dps, n2d):
+    """Lowest bathymetry per 2d cell, NaN for cells without pixels."""
+    out = buffers.get('out', int(n2d))
+    out.fill(np.nan)
+    if len(groups.starts):
+        out[groups.cells] = np.fmin.reduceat(dps, groups.starts)
+    return out
+
+
+@derived('depth', ['s1', 'bottom'])
+def depth(buffers, s1, bottom):
+    """Water depth per 2d cell: water level minus the lowest bathymetry."""
+    out = buffers.get('out', len(bottom))
+    np.subtract(s1[:len(bottom)], bottom, out=out)
+    np.maximum(out, 0.0, out=out)
+    return out
+
+
+@derived('wet', ['depth'])
+def wet(buffers, depth):
+    """Whether a 2d cell has water."""
+    out = buffers.get('out', len(depth), dtype='bool')
+    with np.errstate(invalid='ignore'):
+        np.greater(depth, 0.0, out=out)
+    return out
+
+
+@derived('volume', ['s1', '_pixel_groups', '_pixel_cells', '_sorted_dps',
+                    'dxp', 'nFlowElem2d'])
+def volume(buffers, s1, groups, cells, dps, dxp, n2d):
+    """Water volume per 2d cell, from the depth of each of its pixels."""
+    pixels = buffers.get('pixels', len(cells))
+    np.take(s1, cells, out=pixels)
+    np.subtract(pixels, dps, out=pixels)
+    # Pixels without bathymetry (NaN) have no water.
+    np.fmax(pixels, 0.0, out=pixels)
+    out = buffers.get('out', int(n2d))
+    out.fill(0.0)
+    if len(groups.starts):
+        sums = buffers.get('sums', len(groups.starts))
+        np.add.reduceat(pixels, groups.starts, out=sums)
+        sums *= float(dxp) ** 2
+        out[groups.cells] = sums
+    return out
+
+
+@derived('_link_groups', ['FlowElemContour_x', 'FlowElemContour_y',
+                          'FlowLink_xu', 'FlowLink_yu'])
+def link_groups(buffers, contour_x, contour_y, xu, yu):
+    """The links between 2d cells in x and in y direction, grouped per
+    cell, as ``(links, groups)`` per direction.
+    """
+    cells = CellIndex(contour_x, contour_y)
+    if not len(cells):
+        empty = (np.empty(0, dtype='i8'), Groups(np.empty(0, dtype='i8')))
+        return [empty, empty]
+    result = []
+    # A link is on a vertical cell edge (flow in x direction) if there are
+    # different cells left and right of it, likewise for y.
+    eps = 1e-3 * (cells.xmax - cells.xmin).min()
+    for dx, dy in ((eps, 0.0), (0.0, eps)):
+        before = cells.lookup(xu - dx, yu - dy)
+        after = cells.lookup(xu + dx, yu + dy)
+        links = np.flatnonzero((before >= 0) & (after >= 0) &
+                               (before != after))
+        # Every link counts for the cells on both sides.
+        groups = Groups(np.concatenate([before[links], after[links]]))
+        result.append((np.concatenate([links, links])[groups.order],
+                       groups))
+    return result
+
+
+@derived('velocity', ['u1', '_link_groups', 'nFlowElem2d'])
+def velocity(buffers, u1, link_groups, n2d):
+    """Flow velocity magnitude per 2d cell, from the mean velocity of its
+    links in x and in y direction.
+    """
+    components = []
+    for direction, (links, groups) in enumerate(link_groups):
+        component = buffers.get(direction, int(n2d))
+        component.fill(0.0)
+        if len(groups.starts):
+            values = buffers.get(('values', direction), len(links))
+            np.take(u1, links, out=values)
+            means = buffers.get(('means', direction), len(groups.starts))
+            np.add.reduceat(values, groups.starts, out=means)
+            means /= groups.counts
+            component[groups.cells] = means
+        components.append(component)
+    out = buffers.get('out', int(n2d))
+    return np.hypot(components[0], components[1], out=out)
@@ -0,0 +1,221 @@
+"""Run many model jobs in parallel, one model per worker process.
+
+The Fortran library keeps its state in global memory and the wrapper changes
+the working directory, so there can only be one model per process. The
+:class:`Ensemble` starts a number of worker processes, each with its own
+:class:`python_subgrid.wrapper.SubgridWrapper`, and distributes
+:class:`Job` instances over them::
+
+    jobs = [Job(mdu, steps=100, variables=['s1'],
+                actions=[('discharge', (x, y, 'manhole', 1, value))])
+            for value in [10.0, 100.0, 1000.0]]
+    with Ensemble(processes=4) as ensemble:
+        results = ensemble.run(jobs)
+    s1 = results[0]['s1']
+
+The result arrays are passed back through shared memory instead of being
+pickled. A worker keeps its model loaded for the next job with the same
+mdu, the model is re-initialized (``initmodel``) before every job. A worker
+that crashes (a segfault in Fortran, for instance) is replaced, its job's
+result is a :class:`python_subgrid.utils.JobError`.
+
+"""
+from __future__ import print_function
+import logging
+import multiprocessing
+import os
+import select
+import traceback
+
+from python_subgrid import utils
+from python_subgrid.wrapper import SubgridWrapper
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """A model run for the :class:`Ensemble`.
+
+    The model in ``mdu`` is (re)initialized, the ``actions`` are applied,
+    ``steps`` timesteps are done and the ``variables`` are returned. Actions
+    are ``(method name, arguments)`` tuples for the wrapper, like
+    ``('dropinstantrain', (x, y, diameter, rain))``.
+    """
+
+    def __init__(self, mdu, steps=0, variables=(), actions=()):
+        self.mdu = mdu
+        self.steps = steps
+        self.variables = list(variables)
+        self.actions = list(actions)
+
+    def __repr__(self):
+        return "Job({!r}, steps={!r}, variables={!r}, actions={!r})".format(
+            self.mdu, self.steps, self.variables, self.actions)
+
+
+def run_job(subgrid, job):
+    """Run ``job`` on a started wrapper, return the shared result arrays.
+
+    The variables are copied straight into shared memory, the result is a
+    dictionary with per variable the ``(path, shape, dtype)`` to open it.
+    A variable without data raises a :class:`python_subgrid.utils.JobError`.
+    On an error the shared memory of the variables copied so far is
+    removed.
+    """
+    subgrid.initmodel()
+    for name, args in job.actions:
+        getattr(subgrid, name)(*args)
+    subgrid.run_steps(job.steps)
+    results = {}
+    try:
+        for name in job.variables:
+            subgrid._check_documented(name)
+            info = subgrid._var_info(name)
+            path, array = utils.create_shared_array(info.shape, info.dtype)
+            results[name] = (path, info.shape, info.dtype)
+            if subgrid.get_nd(name, out=array) is None:
+                msg = "Variable '{}' has no data".format(name)
+                raise utils.JobError(msg)
+            del array  # Flushes the memory map.
+    except Exception:
+        for (path, shape, dtype) in results.values():
+            if path is not None:
+                os.unlink(path)
+        raise
+    return results
+
+
+def work(conn):
+    """Run jobs received over ``conn`` until ``None`` is received."""
+    subgrid = None
+    try:
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            try:
+                if subgrid is None or subgrid.mdu != job.mdu:
+                    if subgrid is not None:
+                        subgrid.stop()
+                    subgrid = SubgridWrapper(mdu=job.mdu)
+                    subgrid.start()
+                conn.send(('ok', run_job(subgrid, job)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    finally:
+        if subgrid is not None:
+            subgrid.stop()
+
+
+class Worker(object):
+    """A worker process and our end of the pipe to it."""
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=work,
+                                               args=(child_conn, ))
+        self.process.daemon = True
+        self.process.start()
+        # Only the child has the other end now, so we notice when it dies.
+        child_conn.close()
+        # The model the worker has loaded and the job it is working on.
+        self.mdu = None
+        self.job = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+class Ensemble(object):
+    """Pool of worker processes that each run one model at a time.
+
+    ``processes`` defaults to the number of CPUs. Use it as a context
+    manager or call :meth:`start` and :meth:`stop` yourself.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.workers = []
+
+    def start(self):
+        """Start the worker processes."""
+        self.workers = [Worker() for i in range(self.processes)]
+
+    def stop(self):
+        """Stop the worker processes."""
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stop()
+
+    def _replace(self, worker):
+        worker.process.join()
+        logger.warn("Worker %s died with exit code %s, replacing it",
+                    worker.process.pid, worker.process.exitcode)
+        worker.conn.close()
+        self.workers[self.workers.index(worker)] = Worker()
+
+    def run(self, jobs):
+        """Run the jobs, return their results in the same order.
+
+        A result is a dictionary with per variable a (read-only) array on
+        shared memory or a :class:`python_subgrid.utils.JobError` if the job
+        failed.
+        """
+        pending = list(enumerate(jobs))
+        results = [None] * len(pending)
+
+        def fail(index, msg):
+            logger.error(msg)
+            results[index] = utils.JobError(msg)
+
+        while pending or any(worker.job for worker in self.workers):
+            for worker in self.workers:
+                if worker.job is not None or not pending:
+                    continue
+                # Prefer a job for the model that the worker has loaded.
+                same_model = [item for item in pending
+                              if item[1].mdu == worker.mdu]
+                index, job = (same_model or pending)[0]
+                pending.remove((index, job))
+                try:
+                    worker.conn.send(job)
+                except (IOError, OSError):
+                    pending.insert(0, (index, job))
+                    self._replace(worker)
+                    continue
+                worker.job = (index, job)
+                worker.mdu = job.mdu
+
+            busy = [worker for worker in self.workers if worker.job]
+            ready, _, _ = select.select(busy, [], [], 1.0)
+            for worker in ready:
+                index, job = worker.job
+                worker.job = None
+                try:
+                    status, result = worker.conn.recv()
+                except (EOFError, IOError, OSError):
+                    fail(index, "{} crashed its worker".format(job))
+                    self._replace(worker)
+                    continue
+                if status == 'error':
+                    fail(index, "{} failed:\n{}".format(job, result))
+                    continue
+                results[index] = dict(
+                    (name, utils.open_shared_array(*shared))
+                    for (name, shared) in result.items())
+        return results
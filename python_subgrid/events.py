@@ -0,0 +1,119 @@
+"""Buffer for the interactive edits (rain, discharges, bathymetry).
+
+Dragging a rain cloud or a bathymetry brush gives many calls between two
+timesteps. With :meth:`python_subgrid.wrapper.SubgridWrapper.defer_events`
+those calls (the functions marked ``'deferrable'`` in ``FUNCTIONS``) are
+collected in an :class:`EventBuffer` and applied in one go right before
+the next call that changes the model, normally ``update``. Edits that
+overlap are merged first:
+
+- ``discharge`` at the same manhole (``x``, ``y`` and name) of the same
+  type (``itype``): the last value is kept.
+
+- ``changebathy`` with ``bmode`` 1 (absolute): earlier edits of exactly the
+  same square (``xc``, ``yc`` and ``size``) are dropped. This saves the most,
+  every ``changebathy`` makes the library recompute its subgrid tables.
+
+- ``dropinstantrain`` with the same ``x``, ``y`` and diameter: the amounts
+  are added up, as long as there's no ``changebathy`` in between.
+
+"""
+from __future__ import print_function
+import collections
+
+ABSOLUTE = 1  # ``bmode`` of an absolute ``changebathy``.
+
+
+class EventBuffer(object):
+    """Ordered, merging buffer of deferred library calls.
+
+    ``received`` and ``saved`` count per function the calls that came in
+    and the calls that were merged away, so never go into the library.
+    """
+
+    def __init__(self):
+        self.received = collections.Counter()
+        self.saved = collections.Counter()
+        self._clear()
+
+    def _clear(self):
+        # The calls as ``[name, args]`` lists. Calls that are merged away
+        # get None as name.
+        self.calls = []
+        # The number of calls that haven't been merged away.
+        self.pending = 0
+        # Per merge key the call to merge into.
+        self.index = {}
+        # Per square the ``changebathy`` calls for it.
+        self.squares = collections.defaultdict(list)
+
+    def __len__(self):
+        return self.pending
+
+    def add(self, name, args):
+        """Buffer (or merge) a call of function ``name``, return 0.
+
+        0 is the exit code of a successful call, it is returned for
+        compatibility with the direct calls.
+        """
+        self.received[name] += 1
+        getattr(self, '_add_' + name)(list(args))
+        return 0
+
+    def _append(self, name, args):
+        call = [name, args]
+        self.calls.append(call)
+        self.pending += 1
+        return call
+
+    def _add_discharge(self, args):
+        x, y, manhole, itype, value = args
+        key = ('discharge', x, y, manhole, itype)
+        call = self.index.get(key)
+        if call is None:
+            self.index[key] = self._append('discharge', args)
+            return
+        call[1] = args
+        self.saved['discharge'] += 1
+
+    def _add_changebathy(self, args):
+        xc, yc, size, bvalue, bmode = args
+        # Rain can't be merged across bathymetry changes.
+        for key in [key for key in self.index
+                    if key[0] == 'dropinstantrain']:
+            del self.index[key]
+        square = self.squares[(xc, yc, size)]
+        if bmode == ABSOLUTE:
+            # Everything earlier at this square is overwritten anyway.
+            for call in square:
+                call[0] = None
+                self.pending -= 1
+                self.saved['changebathy'] += 1
+            del square[:]
+        square.append(self._append('changebathy', args))
+
+    def _add_dropinstantrain(self, args):
+        x, y, diameter, amount = args
+        key = ('dropinstantrain', x, y, diameter)
+        call = self.index.get(key)
+        if call is None:
+            self.index[key] = self._append('dropinstantrain', args)
+            return
+        call[1][3] += amount
+        self.saved['dropinstantrain'] += 1
+
+    def pop(self):
+        """Return the buffered ``(name, args)`` calls in order and clear."""
+        calls = [tuple(call) for call in self.calls if call[0] is not None]
+        self._clear()
+        return calls
+
+    def stats(self):
+        """Return the received and saved calls per function and in total."""
+        result = dict(
+            (name, {'received': self.received[name],
+                    'saved': self.saved[name]})
+            for name in self.received)
+        result['total'] = {'received': sum(self.received.values()),
+                           'saved': sum(self.saved.values())}
+        return result
@@ -0,0 +1,264 @@
+"""Indexes from model coordinates to the model's grid.
+
+The 2d cells (flow elements) of a subgrid model form a quadtree: square
+cells of a couple of sizes, every cell lies on the grid of its own size. The
+:class:`CellIndex` uses that to find the cells of many points at once,
+without a call into the library per point. The :class:`PointHash` finds the
+nearest of a set of points (like the links' ``FlowLink_xu`` and
+``FlowLink_yu``). The :class:`GridIndex` combines them, get it with
+:meth:`python_subgrid.wrapper.SubgridWrapper.grid_index`::
+
+    index = subgrid.grid_index()
+    cells = index.cells_at(xs, ys)
+    cells = index.cells_in_bbox(xmin, ymin, xmax, ymax)
+    cells = index.cells_in_polygon([(x1, y1), (x2, y2), (x3, y3)])
+    links = index.nearest_link(xs, ys)
+
+All queries take and return numpy arrays, cells and links are 0-based
+indexes into the cell and link variables (``s1``, ``u1`` and so on).
+
+"""
+from __future__ import division
+
+import numpy as np
+
+
+class CellIndex(object):
+    """Find the 2d cell of points, from the cell contours.
+
+    ``contour_x`` and ``contour_y`` are the ``FlowElemContour_x`` and
+    ``FlowElemContour_y`` variables: the x and y of the four corners of
+    every cell, shape ``(4, number of cells)``. A point is in a cell if
+    ``xmin <= x < xmax`` and ``ymin <= y < ymax``.
+
+    For every cell size there's a sorted array of the cells' positions on
+    the grid of that size, a lookup is a vectorized binary search per cell
+    size.
+    """
+
+    def __init__(self, contour_x, contour_y):
+        self.xmin = contour_x.min(axis=0)
+        self.xmax = contour_x.max(axis=0)
+        self.ymin = contour_y.min(axis=0)
+        self.ymax = contour_y.max(axis=0)
+        self.levels = []
+        if not len(self.xmin):
+            return
+        self.x0 = self.xmin.min()
+        self.y0 = self.ymin.min()
+        width = self.xmax.max() - self.x0
+        sizes = self.xmax - self.xmin
+        for size in np.unique(sizes):
+            cells = np.flatnonzero(sizes == size)
+            # Number of columns of the grid of this size, plus some slack.
+            columns = int(np.ceil(width / size)) + 2
+            i = np.round((self.xmin[cells] - self.x0) / size).astype('i8')
+            j = np.round((self.ymin[cells] - self.y0) / size).astype('i8')
+            keys = j * columns + i
+            order = np.argsort(keys)
+            self.levels.append((size, columns, keys[order], cells[order]))
+
+    def __len__(self):
+        return len(self.xmin)
+
+    def lookup(self, xs, ys):
+        """Return the cell (index) per point, -1 for unresolved points.
+
+        Points outside all cells are unresolved, just like points in cells
+        that aren't on the grid of their size.
+        """
+        xs = np.asarray(xs, dtype='f8')
+        shape = xs.shape
+        xs = xs.ravel()
+        ys = np.asarray(ys, dtype='f8').ravel()
+        result = np.empty(xs.shape, dtype='i8')
+        result.fill(-1)
+        for size, columns, keys, cells in self.levels:
+            todo = np.flatnonzero(result < 0)
+            if not len(todo):
+                break
+            i = np.floor((xs[todo] - self.x0) / size).astype('i8')
+            j = np.floor((ys[todo] - self.y0) / size).astype('i8')
+            wanted = j * columns + i
+            positions = np.searchsorted(keys, wanted)
+            positions[positions == len(keys)] = 0
+            found = ((keys[positions] == wanted) &
+                     (i >= 0) & (i < columns) & (j >= 0))
+            result[todo[found]] = cells[positions[found]]
+        # Rounding can put points just across a cell's edge.
+        resolved = np.flatnonzero(result >= 0)
+        cells = result[resolved]
+        x = xs[resolved]
+        y = ys[resolved]
+        outside = ((x < self.xmin[cells]) | (x >= self.xmax[cells]) |
+                   (y < self.ymin[cells]) | (y >= self.ymax[cells]))
+        result[resolved[outside]] = -1
+        return result.reshape(shape)
+
+
+class PointHash(object):
+    """Find the nearest of a set of points, with a uniform grid of buckets.
+
+    The bucket size is chosen so that there are about ``per_bucket`` points
+    per bucket if the points are spread evenly. A query searches the
+    buckets in rings around the point until no unsearched bucket can have
+    a nearer point.
+    """
+
+    def __init__(self, xs, ys, per_bucket=4):
+        self.xs = np.asarray(xs, dtype='f8').ravel()
+        self.ys = np.asarray(ys, dtype='f8').ravel()
+        if not len(self.xs):
+            return
+        self.x0 = self.xs.min()
+        self.y0 = self.ys.min()
+        width = max(self.xs.max() - self.x0, self.ys.max() - self.y0)
+        buckets = max(len(self.xs) / per_bucket, 1)
+        self.size = max(width / np.sqrt(buckets), 1e-9)
+        self.rows = int(np.floor((self.ys.max() - self.y0) / self.size)) + 1
+        self.columns = int(np.floor((self.xs.max() - self.x0) /
+                                    self.size)) + 1
+        i, j = self._bucket(self.xs, self.ys)
+        keys = j * self.columns + i
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.xs)
+
+    def _bucket(self, xs, ys):
+        i = np.floor((xs - self.x0) / self.size).astype('i8')
+        j = np.floor((ys - self.y0) / self.size).astype('i8')
+        return i, j
+
+    def nearest(self, xs, ys):
+        """Return the index of the nearest point per query point.
+
+        -1 is returned if there are no points at all.
+        """
+        xs = np.asarray(xs, dtype='f8')
+        shape = xs.shape
+        xs = xs.ravel()
+        ys = np.asarray(ys, dtype='f8').ravel()
+        result = np.empty(xs.shape, dtype='i8')
+        result.fill(-1)
+        if not len(self):
+            return result.reshape(shape)
+        best = np.empty(xs.shape, dtype='f8')
+        best.fill(np.inf)
+        # Points outside the grid start at the nearest bucket in the grid.
+        i, j = self._bucket(xs, ys)
+        i = np.clip(i, 0, self.columns - 1)
+        j = np.clip(j, 0, self.rows - 1)
+        todo = np.arange(len(xs))
+        ring = 0
+        while len(todo):
+            for di, dj in ring_offsets(ring):
+                bi = i[todo] + di
+                bj = j[todo] + dj
+                valid = ((bi >= 0) & (bi < self.columns) &
+                         (bj >= 0) & (bj < self.rows))
+                queries = todo[valid]
+                keys = bj[valid] * self.columns + bi[valid]
+                starts = np.searchsorted(self.keys, keys, side='left')
+                ends = np.searchsorted(self.keys, keys, side='right')
+                offset = 0
+                while True:
+                    has = starts + offset < ends
+                    if not has.any():
+                        break
+                    candidates = self.order[starts[has] + offset]
+                    q = queries[has]
+                    distance = np.hypot(self.xs[candidates] - xs[q],
+                                        self.ys[candidates] - ys[q])
+                    better = distance < best[q]
+                    best[q[better]] = distance[better]
+                    result[q[better]] = candidates[better]
+                    offset += 1
+            # Unsearched buckets are at least this far away.
+            done = ((best[todo] <= ring * self.size) |
+                    (ring > max(self.columns, self.rows)))
+            todo = todo[~done]
+            ring += 1
+        return result.reshape(shape)
+
+
+def ring_offsets(ring):
+    """Return the (di, dj) bucket offsets at Chebyshev distance ``ring``."""
+    if ring == 0:
+        return [(0, 0)]
+    offsets = []
+    for d in range(-ring, ring + 1):
+        offsets.extend([(d, -ring), (d, ring)])
+    for d in range(-ring + 1, ring):
+        offsets.extend([(-ring, d), (ring, d)])
+    return offsets
+
+
+def points_in_polygon(xs, ys, polygon):
+    """Return a boolean array: which points lie inside ``polygon``.
+
+    ``polygon`` is a sequence of (x, y) vertices, it is closed
+    automatically. Even-odd rule (ray casting), vectorized over the points.
+    """
+    polygon = np.asarray(polygon, dtype='f8')
+    inside = np.zeros(np.shape(xs), dtype=bool)
+    x1, y1 = polygon[-1]
+    for x2, y2 in polygon:
+        crosses = (y1 > ys) != (y2 > ys)
+        if crosses.any():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (xs < x)
+        x1, y1 = x2, y2
+    return inside
+
+
+class GridIndex(object):
+    """Spatial queries on a model's 2d cells and links.
+
+    ``contour_x`` and ``contour_y`` are the cell contours (see
+    :class:`CellIndex`), ``link_x`` and ``link_y`` the coordinates of the
+    links (``FlowLink_xu`` and ``FlowLink_yu``).
+    """
+
+    def __init__(self, contour_x, contour_y, link_x, link_y):
+        self.cells = CellIndex(contour_x, contour_y)
+        self.links = PointHash(link_x, link_y)
+        # The cells sorted by their left edge, for the bounding box query.
+        self.by_xmin = np.argsort(self.cells.xmin, kind='mergesort')
+        self.sorted_xmin = self.cells.xmin[self.by_xmin]
+        sizes = self.cells.xmax - self.cells.xmin
+        self.max_size = sizes.max() if len(sizes) else 0.0
+
+    def cells_at(self, xs, ys):
+        """Return the cell per point, -1 for points outside the cells."""
+        return self.cells.lookup(xs, ys)
+
+    def cells_in_bbox(self, xmin, ymin, xmax, ymax):
+        """Return the (sorted) cells that overlap the bounding box."""
+        start = np.searchsorted(self.sorted_xmin, xmin - self.max_size,
+                                side='right')
+        end = np.searchsorted(self.sorted_xmin, xmax, side='left')
+        candidates = self.by_xmin[start:end]
+        cells = self.cells
+        overlap = ((cells.xmax[candidates] > xmin) &
+                   (cells.ymax[candidates] > ymin) &
+                   (cells.ymin[candidates] < ymax))
+        return np.sort(candidates[overlap])
+
+    def cells_in_polygon(self, polygon):
+        """Return the (sorted) cells whose center lies inside ``polygon``.
+        """
+        polygon = np.asarray(polygon, dtype='f8')
+        xmin, ymin = polygon.min(axis=0)
+        xmax, ymax = polygon.max(axis=0)
+        candidates = self.cells_in_bbox(xmin, ymin, xmax, ymax)
+        cells = self.cells
+        xc = (cells.xmin[candidates] + cells.xmax[candidates]) / 2
+        yc = (cells.ymin[candidates] + cells.ymax[candidates]) / 2
+        return candidates[points_in_polygon(xc, yc, polygon)]
+
+    def nearest_link(self, xs, ys):
+        """Return the nearest link per point (-1 if there are no links)."""
+        return self.links.nearest(xs, ys)
@@ -0,0 +1,210 @@
+"""Count and time the calls into the library and the wrapper.
+
+Instrumentation is off by default and then costs nothing: nothing is
+wrapped. :meth:`python_subgrid.wrapper.SubgridWrapper.instrument` (or the
+``measure`` context manager) puts timers around every library function
+(``native``) and around the wrapper's own methods (``python``)::
+
+    with subgrid.measure(trace=True) as instruments:
+        subgrid.run_steps(10)
+        subgrid.get_nd('pumps')
+    print(instruments.stats()['native']['update'])
+    instruments.write_chrome_trace('/tmp/trace.json')
+
+Per function there's the number of calls, the total time, the time spent
+in the function itself (without the timed calls it made) and a histogram of
+the durations. ``get_nd`` also counts the bytes it copies and allocates per
+variable. The trace can be viewed in ``chrome://tracing`` or Perfetto.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import collections
+import json
+import math
+import os
+import threading
+import timeit
+
+clock = timeit.default_timer
+
+
+class CallStats(object):
+    """Calls, durations and a histogram of the durations of a function.
+
+    The histogram counts calls per power of two microseconds: bucket ``b``
+    has the calls that took less than ``2 ** b`` microseconds (and at least
+    half of that).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.histogram = collections.Counter()
+
+    def add(self, duration, self_duration):
+        self.calls += 1
+        self.seconds += duration
+        self.self_seconds += self_duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        self.histogram[math.frexp(duration * 1e6)[1]] += 1
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'seconds': self.seconds,
+            'self_seconds': self.self_seconds,
+            'mean': self.seconds / self.calls if self.calls else 0.0,
+            'min': self.min if self.calls else 0.0,
+            'max': self.max,
+            # Upper bound in microseconds: number of calls.
+            'histogram': dict((2 ** bucket, count) for (bucket, count)
+                              in sorted(self.histogram.items())),
+        }
+
+
+class Instruments(object):
+    """Statistics (and optionally a trace) of timed calls.
+
+    With ``trace`` every call is kept as well, for
+    :meth:`write_chrome_trace`.
+    """
+
+    def __init__(self, trace=False):
+        self.calls = {'native': collections.defaultdict(CallStats),
+                      'python': collections.defaultdict(CallStats)}
+        self.bytes = collections.defaultdict(collections.Counter)
+        self.trace = [] if trace else None
+        self.start = clock()
+        # Per thread the time spent in timed calls made by the running
+        # timed call, for the self time.
+        self._local = threading.local()
+
+    def timed(self, category, name, func):
+        """Return ``func`` with a timer that records into ``name``."""
+        stats = self.calls[category][name]
+        local = self._local
+        trace = self.trace
+
+        def timed(*args, **kwargs):
+            try:
+                stack = local.stack
+            except AttributeError:
+                stack = local.stack = []
+            children = [0.0]
+            stack.append(children)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = clock() - start
+                stack.pop()
+                if stack:
+                    stack[-1][0] += duration
+                stats.add(duration, duration - children[0])
+                if trace is not None:
+                    trace.append((category, name, start, duration,
+                                  threading.current_thread().ident))
+        timed.__name__ = name
+        timed.__doc__ = func.__doc__
+        for attribute in ('argtypes', 'restype'):
+            if hasattr(func, attribute):
+                setattr(timed, attribute, getattr(func, attribute))
+        return timed
+
+    def count_bytes(self, name, nbytes, allocated=True):
+        """Record that ``nbytes`` of variable ``name`` were copied (into a
+        new array if ``allocated``).
+        """
+        counter = self.bytes[name]
+        counter['copied'] += nbytes
+        if allocated:
+            counter['allocated'] += nbytes
+
+    def stats(self):
+        """Return the statistics as a dictionary.
+
+        ``native`` and ``python`` have per function the :class:`CallStats`
+        as a dictionary, ``bytes`` has per variable the bytes that
+        ``get_nd`` copied and allocated.
+        """
+        result = dict(
+            (category, dict((name, stats.as_dict())
+                            for (name, stats) in calls.items()
+                            if stats.calls))
+            for (category, calls) in self.calls.items())
+        result['bytes'] = dict((name, {'copied': counter['copied'],
+                                       'allocated': counter['allocated']})
+                               for (name, counter) in self.bytes.items())
+        return result
+
+    def chrome_trace(self):
+        """Return the trace in the Chrome trace event format."""
+        if self.trace is None:
+            raise ValueError("Tracing is off, pass trace=True")
+        pid = os.getpid()
+        events = [{'name': name, 'cat': category, 'ph': 'X',
+                   'ts': (start - self.start) * 1e6, 'dur': duration * 1e6,
+                   'pid': pid, 'tid': tid}
+                  for (category, name, start, duration, tid) in self.trace]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        """Write the trace to ``path``, as Chrome trace event JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class TimedFunction(object):
+    """A ctypes function of the library, with a timer.
+
+    ``argtypes`` and ``restype`` are those of the ctypes function, so the
+    wrapper can annotate it as usual.
+    """
+
+    def __init__(self, name, func, instruments):
+        self.__name__ = name
+        self.func = func
+        self._call = instruments.timed('native', name, func)
+
+    @property
+    def argtypes(self):
+        return self.func.argtypes
+
+    @argtypes.setter
+    def argtypes(self, value):
+        self.func.argtypes = value
+
+    @property
+    def restype(self):
+        return self.func.restype
+
+    @restype.setter
+    def restype(self, value):
+        self.func.restype = value
+
+    def __call__(self, *args):
+        return self._call(*args)
+
+
+class InstrumentedLibrary(object):
+    """The loaded library, with a timer on every function."""
+
+    def __init__(self, library, instruments):
+        self.library = library
+        self.instruments = instruments
+
+    def __getattr__(self, name):
+        func = getattr(self.library, name)
+        if name.startswith('_') or not callable(func):
+            return func
+        timed = TimedFunction(name, func, self.instruments)
+        # Found without ``__getattr__`` from now on.
+        setattr(self, name, timed)
+        return timed
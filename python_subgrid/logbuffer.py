@@ -0,0 +1,120 @@
+"""Buffer for the log messages of the Fortran library.
+
+The library calls back into python for every log line, during a long run
+that can be many lines per timestep. The :class:`LogBuffer` is a cheaper
+callback (see :meth:`python_subgrid.wrapper.SubgridWrapper.buffer_log`):
+
+- Messages below the threshold are dropped right away, before anything of
+  python's ``logging`` is touched.
+
+- The other messages go into a ring buffer of fixed size. When it is full
+  the oldest messages are dropped (and counted).
+
+- Identical messages are summarized: a message that is already in the
+  buffer only increases the count of that entry.
+
+The buffer is drained in bulk into a python logger by :meth:`drain`, by you
+or by a background thread (:meth:`start`).
+
+"""
+from __future__ import print_function
+import collections
+import logging
+import threading
+
+
+class LogBuffer(object):
+    """Ring buffer of ``size`` log messages for ``logger``.
+
+    ``threshold`` and the message levels are the library's levels, the
+    ``levels`` dictionary translates them to python's levels.
+    """
+
+    def __init__(self, logger, threshold, levels, size=10000):
+        self.logger = logger
+        self.threshold = threshold
+        self.levels = levels
+        self.size = size
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.thread = None
+        self._stop = threading.Event()
+        self._clear()
+
+    def _clear(self):
+        # ``[level, message, count]`` lists, oldest first.
+        self.entries = collections.deque(maxlen=self.size)
+        # Per (level, message) its entry, for the summaries.
+        self.index = {}
+        # The number of messages dropped because the buffer was full.
+        self.dropped = 0
+
+    def __call__(self, level_p, message):
+        """Log callback for the library."""
+        level = level_p[0]
+        if level < self.threshold:
+            return
+        key = (level, message)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None:
+                entry[2] += 1
+                return
+            entries = self.entries
+            if len(entries) == self.size:
+                oldest = entries[0]
+                self.dropped += oldest[2]
+                del self.index[(oldest[0], oldest[1])]
+            entry = [level, message, 1]
+            entries.append(entry)
+            self.index[key] = entry
+
+    def drain(self):
+        """Log the buffered messages, return the number of messages.
+
+        A summarized message is logged once, with the number of times it
+        was received.
+        """
+        with self.lock:
+            entries = self.entries
+            dropped = self.dropped
+            self._clear()
+        logger = self.logger
+        levels = self.levels
+        messages = 0
+        for level, message, count in entries:
+            if count == 1:
+                logger.log(levels[level], message)
+            else:
+                logger.log(levels[level], "%s (%s times)", message, count)
+            messages += count
+        if dropped:
+            logger.warning("%s log messages dropped, the buffer was full",
+                           dropped)
+        self.stats['logged'] += len(entries)
+        self.stats['summarized'] += messages - len(entries)
+        self.stats['dropped'] += dropped
+        return messages
+
+    def start(self, interval=1.0):
+        """Drain the buffer every ``interval`` seconds in a thread."""
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, args=(interval, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread of :meth:`start` and drain what is left."""
+        if self.thread is not None:
+            self._stop.set()
+            self.thread.join()
+            self.thread = None
+        self.drain()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.drain()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "Draining the log buffer failed")
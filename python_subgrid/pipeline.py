@@ -0,0 +1,182 @@
+"""Overlap the timesteps with the post-processing of the previous step.
+
+A plain loop does an ``update``, then copies and post-processes the output,
+then the next ``update``: the model waits for python and python waits for
+the model. ctypes releases the GIL during ``update`` (and numpy during most
+of its work), so a :class:`Pipeline` runs the updates in a worker thread.
+After every step it copies the output variables into one of two buffer
+sets, starts the next step and meanwhile runs the hooks on the copy::
+
+    def statistics(step, t, buffers):
+        print(step, t, np.percentile(buffers['s1'], [5, 50, 95]))
+
+    with SubgridWrapper(mdu='/full/path/model.mdu') as subgrid:
+        subgrid.initmodel()
+        pipeline = Pipeline(subgrid, ['s1', 'u1'], hooks=[statistics])
+        pipeline.run_steps(1000)
+        print(pipeline.stats)
+
+The hooks run in the calling thread while the library is busy, so they
+must only use the buffers and not call the library. For edits use
+:meth:`python_subgrid.wrapper.SubgridWrapper.defer_events`: the events
+that the hooks of a step add are applied before the step after the one
+that is running.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import threading
+import time
+from ctypes import byref
+from ctypes import c_double
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+class Pipeline(object):
+    """Run the timesteps of a started wrapper in a worker thread, while
+    ``hooks`` post-process copies of ``variables``.
+
+    Every ``every`` timesteps the variables are copied into one of the two
+    buffer sets and the hooks are called with ``(step, t, buffers)``, like
+    the ``callback`` of the wrapper's ``run_steps``. A hook may keep its
+    buffers until the hooks of the next output step have run, so it can
+    compare the current step with the previous one.
+
+    :attr:`stats` has the time spent in the hooks, waiting for the library
+    after the hooks (``wait_seconds``) and the number of output steps.
+    A variable without data or an ``every`` below 1 raises a
+    ``ValueError`` before the first timestep.
+    """
+
+    def __init__(self, subgrid, variables, hooks=(), every=1):
+        self.subgrid = subgrid
+        self.variables = list(variables)
+        self.hooks = list(hooks)
+        self.every = every
+        self.stats = {}
+
+    def add_hook(self, hook):
+        """Register ``hook(step, t, buffers)``."""
+        self.hooks.append(hook)
+
+    def run_steps(self, n, dt=-1):
+        """Do ``n`` timesteps, return the number of timesteps done."""
+        return self._run(n, None, dt)
+
+    def run_until(self, t_end, dt=-1):
+        """Do timesteps until the model time (``t1``) reaches ``t_end``."""
+        return self._run(None, t_end, dt)
+
+    def _update(self, requests, results, dt, time_, t_end):
+        """Do the requested numbers of updates (or fewer, when the model
+        time reaches ``t_end``), run in the worker thread.
+        """
+        update = self.subgrid.library.update
+        c_dt = c_double(dt)
+        dt_p = byref(c_dt)
+        while True:
+            n = requests.get()
+            if n is None:
+                break
+            done = 0
+            exit_code = 0
+            try:
+                while (done < n and not exit_code and
+                       (t_end is None or time_[()] < t_end)):
+                    exit_code = update(dt_p)
+                    done += 1
+            except Exception as e:
+                results.put((done, e))
+            else:
+                results.put((done, exit_code))
+
+    def _run(self, n, t_end, dt):
+        subgrid = self.subgrid
+        if self.every < 1:
+            msg = "every must be at least 1, not {}".format(self.every)
+            raise ValueError(msg)
+        # Updates don't resize the arrays, so we can keep pointing at them.
+        sources = {}
+        for name in self.variables:
+            subgrid._check_documented(name)
+            sources[name] = subgrid._array(name)
+            if sources[name] is None:
+                raise ValueError("Variable '{}' has no data".format(name))
+        slots = [dict((name, np.empty_like(source))
+                      for (name, source) in sources.items())
+                 for i in range(2)]
+        time_ = subgrid._array('t1')
+        if time_ is None and t_end is not None:
+            raise RuntimeError("The model time (t1) is not available")
+        self.stats = {
+            'outputs': 0,
+            'hook_seconds': 0.0,
+            'wait_seconds': 0.0,
+        }
+        requests = queue.Queue()
+        results = queue.Queue()
+        worker = threading.Thread(target=self._update,
+                                  args=(requests, results, dt, time_,
+                                        t_end))
+        worker.daemon = True
+        worker.start()
+        step = 0
+        # The output step whose buffers go to the hooks, while the library
+        # does the next steps.
+        pending = None
+        busy = False
+
+        def more():
+            return ((n is None or step < n) and
+                    (t_end is None or time_[()] < t_end))
+
+        try:
+            while True:
+                if more():
+                    if subgrid.events:
+                        subgrid.flush_events()
+                    requests.put(self.every if n is None
+                                 else min(self.every, n - step))
+                    busy = True
+                if pending is not None:
+                    start = time.time()
+                    for hook in self.hooks:
+                        hook(*pending)
+                    self.stats['hook_seconds'] += time.time() - start
+                    self.stats['outputs'] += 1
+                    pending = None
+                if not busy:
+                    break
+                start = time.time()
+                done, exit_code = results.get()
+                busy = False
+                self.stats['wait_seconds'] += time.time() - start
+                step += done
+                subgrid.generation += 1
+                if isinstance(exit_code, Exception):
+                    raise exit_code
+                if exit_code:
+                    msg = "Update {} failed with exit code {}"
+                    raise RuntimeError(msg.format(step, exit_code))
+                buffers = slots[self.stats['outputs'] % 2]
+                for name, source in sources.items():
+                    buffers[name][...] = source
+                t = time_[()] if time_ is not None else None
+                pending = (step, t, buffers)
+        finally:
+            if busy:
+                # Don't leave the library running on an error in a hook.
+                results.get()
+                subgrid.generation += 1
+            requests.put(None)
+            worker.join()
+            if (subgrid.log_buffer is not None and
+                    subgrid.log_buffer.thread is None):
+                subgrid.log_buffer.drain()
+        return step
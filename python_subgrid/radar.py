@@ -0,0 +1,335 @@
+"""Feed radar rainfall to a running model.
+
+A radar frame is a regular grid of rain depths. Regridding it to the
+model's 2d cells is a sparse matrix: per cell the radar pixels it overlaps
+and how much of the cell each of them covers. The :class:`RainfallIngestor`
+computes that matrix once per (radar grid, model grid) pair and keeps it in
+a cache directory, keyed by a hash of both grids. Every frame is then one
+sparse matrix-vector product. The rain goes into the model through the
+library's ``dropinstantrain``, so the library's water balance counts it::
+
+    grid = RadarGrid.from_extent(extent, shape=(765, 700))
+    with SubgridWrapper(mdu='/full/path/model.mdu') as subgrid:
+        subgrid.initmodel()
+        rainfall = RainfallIngestor(subgrid, grid)
+        rainfall.run(filenames, steps_per_frame=300)
+
+The frames (the ``filenames`` here) are read and decoded in a background
+thread, so the next frame is ready when the model is done with its
+timesteps.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'python_subgrid',
+                         'radar')
+
+Weights = collections.namedtuple('Weights', ['cells', 'pixels', 'values'])
+
+
+class RadarGrid(collections.namedtuple(
+        'RadarGrid', ['x0', 'y0', 'dx', 'dy', 'rows', 'columns'])):
+    """A radar's pixel grid.
+
+    Pixel ``(row, column)`` of a frame covers ``x0 + column * dx`` to
+    ``x0 + (column + 1) * dx`` and the same in y. ``dy`` is negative for
+    frames that are stored top row first.
+    """
+
+    @classmethod
+    def from_extent(cls, extent, shape):
+        """Return the grid of frames of ``shape`` that are stored top row
+        first and cover ``extent``: ``(xmin, xmax, ymin, ymax)``.
+        """
+        xmin, xmax, ymin, ymax = [float(value) for value in extent]
+        rows, columns = shape
+        return cls(xmin, ymax, (xmax - xmin) / columns,
+                   (ymin - ymax) / rows, int(rows), int(columns))
+
+    def key(self):
+        """Return a hash of the grid."""
+        return hashlib.sha1(repr(tuple(self)).encode('ascii')).hexdigest()
+
+
+def radar_weights(grid, xmin, xmax, ymin, ymax):
+    """Return the sparse matrix that regrids a frame of ``grid`` to cells.
+
+    The cells are the rectangles ``xmin`` to ``xmax`` by ``ymin`` to
+    ``ymax``. The result has per non-zero: the cell, the (flat) pixel and
+    the fraction of the cell that the pixel covers. The rain in a cell is
+    the area weighted mean of its pixels, parts of cells outside the radar
+    get no rain.
+    """
+    x0, dx, columns = grid.x0, grid.dx, grid.columns
+    y0, dy, rows = grid.y0, grid.dy, grid.rows
+    flipped = dy < 0
+    if flipped:
+        # Count the rows from the bottom up, flip them back at the end.
+        y0, dy = y0 + rows * dy, -dy
+    # The range of pixels per cell, clipped to the grid.
+    j0 = np.clip(np.floor((xmin - x0) / dx).astype('i8'), 0, columns)
+    j1 = np.clip(np.ceil((xmax - x0) / dx).astype('i8'), 0, columns)
+    i0 = np.clip(np.floor((ymin - y0) / dy).astype('i8'), 0, rows)
+    i1 = np.clip(np.ceil((ymax - y0) / dy).astype('i8'), 0, rows)
+    width = j1 - j0
+    counts = width * (i1 - i0)
+    cells = np.repeat(np.arange(len(xmin)), counts)
+    # Position of every non-zero within its cell's block of pixels.
+    offsets = np.arange(len(cells)) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+    j = j0[cells] + offsets % np.maximum(width[cells], 1)
+    i = i0[cells] + offsets // np.maximum(width[cells], 1)
+    overlap_x = (np.minimum(xmax[cells], x0 + (j + 1) * dx) -
+                 np.maximum(xmin[cells], x0 + j * dx))
+    overlap_y = (np.minimum(ymax[cells], y0 + (i + 1) * dy) -
+                 np.maximum(ymin[cells], y0 + i * dy))
+    area = (xmax - xmin)[cells] * (ymax - ymin)[cells]
+    values = overlap_x * overlap_y / area
+    if flipped:
+        i = rows - 1 - i
+    keep = values > 0
+    return Weights(cells[keep], (i * columns + j)[keep], values[keep])
+
+
+def cells_key(xmin, xmax, ymin, ymax):
+    """Return a hash of the model grid (the cells' bounds)."""
+    sha1 = hashlib.sha1()
+    for bounds in (xmin, xmax, ymin, ymax):
+        sha1.update(np.ascontiguousarray(bounds, dtype='f8').tobytes())
+    return sha1.hexdigest()
+
+
+def cached_weights(grid, xmin, xmax, ymin, ymax, cache_dir=CACHE_DIR):
+    """Return :func:`radar_weights`, from ``cache_dir`` if possible.
+
+    Newly computed weights are saved in ``cache_dir``. Pass None as
+    ``cache_dir`` to always compute them.
+    """
+    if cache_dir is None:
+        return radar_weights(grid, xmin, xmax, ymin, ymax)
+    key = grid.key() + cells_key(xmin, xmax, ymin, ymax)
+    key = hashlib.sha1(key.encode('ascii')).hexdigest()
+    path = os.path.join(cache_dir, 'weights-{}.npz'.format(key))
+    if os.path.exists(path):
+        logger.debug("Loading radar weights from %s", path)
+        arrays = np.load(path)
+        return Weights(*[arrays[name] for name in Weights._fields])
+    weights = radar_weights(grid, xmin, xmax, ymin, ymax)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write and rename, so other processes never load half a file.
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **weights._asdict())
+    os.rename(tmp, path)
+    logger.debug("Saved radar weights in %s", path)
+    return weights
+
+
+def regrid(weights, frame, n):
+    """Return the rain per cell (``n`` cells) for radar ``frame``.
+
+    Masked and NaN pixels count as no rain.
+    """
+    # Only look at the pixels that are used, radar frames are a lot larger
+    # than most models.
+    rain = np.ma.filled(frame, 0.0).ravel()[weights.pixels]
+    rain[np.isnan(rain)] = 0.0
+    return np.bincount(weights.cells, weights=weights.values * rain,
+                       minlength=n)
+
+
+def read_hdf5_frame(filename):
+    """Return the ``precipitation`` of a KNMI HDF5 radar file, needs h5py.
+
+    Pixels with the file's ``fill_value`` are masked.
+    """
+    with h5py.File(filename, 'r') as f:
+        frame = f['precipitation'][...]
+        return np.ma.masked_equal(frame, f.attrs['fill_value'])
+
+
+def prefetch(sources, read_frame, size=2):
+    """Yield ``read_frame(source)`` per source, read in a background thread.
+
+    At most ``size`` frames are read ahead. Errors of ``read_frame`` are
+    raised here, at the frame where they happened.
+    """
+    frames = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        """Put ``item`` in the queue, return False if we're stopped."""
+        while not stopped.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        for source in sources:
+            try:
+                item = (read_frame(source), None)
+            except Exception as e:
+                logger.debug("Reading %s failed", source, exc_info=True)
+                item = (None, e)
+            if not put(item) or item[1] is not None:
+                return
+        put((None, StopIteration()))
+
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            frame, error = frames.get()
+            if isinstance(error, StopIteration):
+                return
+            if error is not None:
+                raise error
+            yield frame
+    finally:
+        stopped.set()
+
+
+class RainfallIngestor(object):
+    """Add radar rainfall on ``grid`` to the 2d cells of a started wrapper.
+
+    Frames are rain depths in the unit that ``scale`` converts to meters
+    (millimeters by default). ``cache_dir`` is where the regridding weights
+    are kept (None: not on disk), ``read_frame`` turns a source (a
+    filename) into a frame and ``prefetch`` is the number of frames that
+    are read ahead. The default ``read_frame`` needs h5py, without it an
+    ``ImportError`` is raised.
+
+    With ``balance=False`` the rain is written straight into the water
+    levels, all cells at once, which is faster but the library's water
+    balance and rain totals don't count it. It is logged as a warning.
+    """
+
+    def __init__(self, subgrid, grid, cache_dir=CACHE_DIR, scale=1e-3,
+                 read_frame=read_hdf5_frame, prefetch=2, balance=True):
+        if read_frame is read_hdf5_frame and h5py is None:
+            raise ImportError("Reading HDF5 radar frames needs h5py, install "
+                              "it or pass another read_frame")
+        self.subgrid = subgrid
+        self.grid = grid
+        self.cache_dir = cache_dir
+        self.scale = scale
+        self.read_frame = read_frame
+        self.prefetch = prefetch
+        self.balance = balance
+        if not balance:
+            logger.warning("The radar rain is added to the water levels "
+                           "directly, the library's water balance doesn't "
+                           "count it")
+        self.stats = {
+            'frames': 0,
+            'regrid_seconds': 0.0,
+            'wait_seconds': 0.0,
+        }
+
+    def weights(self):
+        """Return the regridding weights for the current model grid.
+
+        They are cached in memory until the grid changes (see
+        :meth:`python_subgrid.wrapper.SubgridWrapper.grid_index`).
+        """
+        cells = self.subgrid.grid_index().cells
+        cached = getattr(self, '_weights', None)
+        if cached is not None and cached[0] is cells:
+            return cached[1]
+        weights = cached_weights(self.grid, cells.xmin, cells.xmax,
+                                 cells.ymin, cells.ymax,
+                                 cache_dir=self.cache_dir)
+        self._weights = (cells, weights)
+        return weights
+
+    def regrid(self, frame):
+        """Return the rain depth (in meters) per 2d cell for ``frame``."""
+        n = len(self.subgrid.grid_index().cells)
+        return regrid(self.weights(), frame, n) * self.scale
+
+    def apply(self, frame):
+        """Add the rain of ``frame`` to the water of the 2d cells, return
+        the rain depth per cell.
+
+        Every cell with rain gets a ``dropinstantrain`` at its center, on a
+        circle with the cell's area. The circle sticks out of the cell's
+        corners a bit, so some of the rain falls on the neighbours, but the
+        volume and the water balance are right.
+
+        With ``balance=False`` every cell gets its rain depth times its
+        area as volume and the water levels that hold the new volumes are
+        written to ``s1`` in the library's memory, all cells at once (see
+        :meth:`python_subgrid.wrapper.SubgridWrapper.add_volume`). The area
+        is the derived ``area``, of the cell's pixels with bathymetry: rain
+        on pixels without bathymetry is lost.
+        """
+        start = time.time()
+        rain = self.regrid(frame)
+        if self.balance:
+            self.drop(rain)
+        else:
+            area = self.subgrid.get_derived('area', view=True)
+            self.subgrid.add_volume(rain * area)
+        self.stats['frames'] += 1
+        self.stats['regrid_seconds'] += time.time() - start
+        return rain
+
+    def drop(self, rain):
+        """Drop ``rain`` (meters per 2d cell) with ``dropinstantrain``."""
+        cells = self.subgrid.grid_index().cells
+        raining = np.flatnonzero(rain > 0)
+        x = (cells.xmin[raining] + cells.xmax[raining]) / 2
+        y = (cells.ymin[raining] + cells.ymax[raining]) / 2
+        area = ((cells.xmax[raining] - cells.xmin[raining]) *
+                (cells.ymax[raining] - cells.ymin[raining]))
+        diameter = 2 * np.sqrt(area / np.pi)
+        # The library wants millimeters.
+        amount = rain[raining] * 1e3
+        for args in zip(x, y, diameter, amount):
+            self.subgrid.dropinstantrain(*[float(arg) for arg in args])
+
+    def run(self, sources, steps_per_frame, dt=-1):
+        """Apply the frame of every source and do ``steps_per_frame``
+        timesteps after each, return the number of timesteps done.
+
+        The next frames are read while the model does its timesteps.
+        """
+        steps = 0
+        frames = prefetch(sources, self.read_frame, size=self.prefetch)
+        while True:
+            start = time.time()
+            try:
+                frame = next(frames)
+            except StopIteration:
+                break
+            self.stats['wait_seconds'] += time.time() - start
+            self.apply(frame)
+            steps += self.subgrid.run_steps(steps_per_frame, dt=dt)
+        return steps
@@ -0,0 +1,339 @@
+"""Record model output to disk while the model runs.
+
+The :class:`OutputRecorder` copies variables (numeric and compound ones) from
+the model every ``every`` timesteps. A background thread appends them to
+disk, so the timestep loop only waits for the disk when all staging buffers
+are still waiting to be written::
+
+    with SubgridWrapper(mdu='/full/path/model.mdu') as subgrid:
+        subgrid.initmodel()
+        with OutputRecorder(subgrid, '/tmp/output.h5', ['s1', 'pumps'],
+                            every=10) as recorder:
+            recorder.run_steps(1000)
+        print(recorder.stats)
+
+    output = load('/tmp/output.h5')
+    s1 = output['s1'][-1]
+
+The output goes into an HDF5 file if h5py is installed, otherwise into a
+directory with a raw file per variable and a JSON index (see
+:class:`RawStore`). Either way every variable is stored as an array with
+one row per output step, next to the ``step`` and ``t`` (model time) of
+every row.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from python_subgrid.utils import dtype_from_json
+from python_subgrid.utils import dtype_to_json
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+ROWS_FILENAME = 'rows.bin'
+# The step and model time of a row of a raw store.
+ROW_DTYPE = np.dtype([('step', 'i8'), ('t', 'f8')])
+
+
+class RawStore(object):
+    """Append-only store of raw files in directory ``path``.
+
+    Every variable gets a ``<name>.bin`` file with its rows in C order.
+    ``index.json`` has the shape and dtype per variable, it is written
+    right away. ``rows.bin`` has the ``step`` and ``t`` per row. The files
+    are flushed after every row, so what was recorded can be loaded even if
+    the process died before the store was closed.
+    """
+
+    def __init__(self, path, variables):
+        self.path = path
+        self.variables = variables
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = {
+            'variables': dict(
+                (name, {'shape': [int(size) for size in shape],
+                        'dtype': dtype_to_json(dtype)})
+                for (name, (shape, dtype)) in variables.items()),
+        }
+        with open(os.path.join(path, INDEX_FILENAME), 'w') as f:
+            json.dump(index, f)
+        self.files = dict(
+            (name, open(os.path.join(path, name + '.bin'), 'wb'))
+            for name in variables)
+        self.rows = open(os.path.join(path, ROWS_FILENAME), 'wb')
+
+    def append(self, step, t, arrays):
+        for name, array in arrays.items():
+            array.tofile(self.files[name])
+            self.files[name].flush()
+        # The row counts once its variables are written.
+        np.array((step, t), dtype=ROW_DTYPE).tofile(self.rows)
+        self.rows.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.rows.close()
+
+    @staticmethod
+    def load(path):
+        """Return the arrays in the store as read-only memory maps.
+
+        A row that wasn't written completely (the process died while
+        writing it) is left out.
+        """
+        with open(os.path.join(path, INDEX_FILENAME)) as f:
+            index = json.load(f)
+        filename = os.path.join(path, ROWS_FILENAME)
+        rows = os.path.getsize(filename) // ROW_DTYPE.itemsize
+        variables = {}
+        for name, description in index['variables'].items():
+            shape = tuple(description['shape'])
+            dtype = dtype_from_json(description['dtype'])
+            row_size = int(np.prod(shape)) * dtype.itemsize
+            if row_size:
+                filename = os.path.join(path, name + '.bin')
+                rows = min(rows, os.path.getsize(filename) // row_size)
+            variables[str(name)] = (shape, dtype)
+        if rows:
+            steps = np.fromfile(os.path.join(path, ROWS_FILENAME),
+                                dtype=ROW_DTYPE, count=rows)
+        else:
+            steps = np.empty(0, dtype=ROW_DTYPE)
+        result = {
+            'step': steps['step'],
+            't': steps['t'],
+        }
+        for name, (shape, dtype) in variables.items():
+            shape = (rows, ) + shape
+            if not rows or not dtype.itemsize:
+                result[name] = np.empty(shape, dtype=dtype)
+                continue
+            result[name] = np.memmap(os.path.join(path, name + '.bin'),
+                                     dtype=dtype, mode='r', shape=shape)
+        return result
+
+
+class HDF5Store(object):
+    """Append-only store in HDF5 file ``path``, needs h5py.
+
+    Every variable is a chunked dataset that grows by a row per output step,
+    the ``step`` and ``t`` datasets have the step and model time per row.
+    """
+
+    def __init__(self, path, variables):
+        self.file = h5py.File(path, 'w')
+        self.rows = 0
+        for name, (shape, dtype) in variables.items():
+            self.file.create_dataset(name, shape=(0, ) + shape,
+                                     maxshape=(None, ) + shape,
+                                     dtype=dtype, chunks=True)
+        self.file.create_dataset('step', shape=(0, ), maxshape=(None, ),
+                                 dtype='i8', chunks=True)
+        self.file.create_dataset('t', shape=(0, ), maxshape=(None, ),
+                                 dtype='f8', chunks=True)
+
+    def append(self, step, t, arrays):
+        row = self.rows
+        self.rows += 1
+        items = list(arrays.items()) + [('step', step), ('t', t)]
+        for name, value in items:
+            dataset = self.file[name]
+            dataset.resize(self.rows, axis=0)
+            dataset[row] = value
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(path):
+        """Return the arrays in the file (read into memory)."""
+        with h5py.File(path, 'r') as f:
+            return dict((name, f[name][...]) for name in f)
+
+
+STORES = {
+    'raw': RawStore,
+    'hdf5': HDF5Store,
+}
+
+
+def load(path):
+    """Return a dictionary with the arrays recorded in ``path``."""
+    if os.path.isdir(path):
+        return RawStore.load(path)
+    return HDF5Store.load(path)
+
+
+class OutputRecorder(object):
+    """Record ``variables`` of a started wrapper into ``path``.
+
+    ``every`` is the output interval in timesteps for :meth:`run_steps` and
+    :meth:`run_until`, call :meth:`record` yourself if you run your own
+    loop. There are ``slots`` staging buffers (two: double buffering) for
+    the background writer. When they are all full, recording waits for the
+    writer; these stalls are counted in :attr:`stats`.
+
+    ``store`` is ``'hdf5'`` (``path`` is a file) or ``'raw'`` (``path`` is a
+    directory), by default HDF5 is used if h5py is installed.
+    """
+
+    def __init__(self, subgrid, path, variables, every=1, slots=2,
+                 store=None):
+        if store is None:
+            store = 'hdf5' if h5py is not None else 'raw'
+        if store not in STORES:
+            msg = "Unknown store {}, use one of {}".format(store,
+                                                           sorted(STORES))
+            raise ValueError(msg)
+        if store == 'hdf5' and h5py is None:
+            raise ImportError("The hdf5 store needs h5py")
+        self.subgrid = subgrid
+        self.path = path
+        self.variables = list(variables)
+        self.every = every
+        self.slots = slots
+        self.store = store
+        self.thread = None
+        self.error = None
+        self.recorded = 0
+        self.stats = {}
+
+    def start(self):
+        """Allocate the staging buffers and start the writer thread."""
+        variables = {}
+        for name in self.variables:
+            self.subgrid._check_documented(name)
+            info = self.subgrid._var_info(name)
+            if self.subgrid._array(name) is None:
+                raise ValueError("Variable '{}' has no data".format(name))
+            variables[name] = (info.shape, info.dtype)
+        self.stats = {
+            'records': 0,
+            'bytes': 0,
+            'write_seconds': 0.0,
+            'stalls': 0,
+            'stall_seconds': 0.0,
+        }
+        self.error = None
+        self.recorded = 0
+        # Staging buffers go from ``free`` to ``filled`` (by :meth:`record`)
+        # and back (by the writer thread).
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for i in range(self.slots):
+            self.free.put(dict((name, np.empty(shape, dtype=dtype))
+                               for (name, (shape, dtype))
+                               in variables.items()))
+        store = STORES[self.store](self.path, variables)
+        self.thread = threading.Thread(target=self._write, args=(store, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Write what is left, stop the writer thread and close the store.
+        """
+        if self.thread is None:
+            return
+        self.filled.put(None)
+        self.thread.join()
+        self.thread = None
+        stats = self.stats
+        logger.info(
+            "Recorded %s steps, %.1f MB/s, %s stalls (%.3f s)",
+            stats['records'],
+            stats['bytes'] / stats['write_seconds'] / 1e6
+            if stats['write_seconds'] else 0.0,
+            stats['stalls'], stats['stall_seconds'])
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _write(self, store):
+        """Write the filled staging buffers, run in the writer thread."""
+        try:
+            while True:
+                item = self.filled.get()
+                if item is None:
+                    break
+                step, t, slot = item
+                if self.error is None:
+                    start = time.time()
+                    try:
+                        store.append(step, t, slot)
+                    except Exception as e:
+                        logger.exception("Writing output failed")
+                        self.error = e
+                    self.stats['write_seconds'] += time.time() - start
+                    self.stats['bytes'] += sum(array.nbytes
+                                               for array in slot.values())
+                    self.stats['records'] += 1
+                self.free.put(slot)
+        finally:
+            store.close()
+
+    def record(self, step=None, t=None):
+        """Copy the variables into a staging buffer for the writer.
+
+        ``step`` defaults to the number of earlier records, ``t`` is read
+        from the model (``t1``) if you don't pass it.
+        """
+        self._check_error()
+        if step is None:
+            step = self.recorded
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            start = time.time()
+            slot = self.free.get()
+            self.stats['stalls'] += 1
+            self.stats['stall_seconds'] += time.time() - start
+        for name, array in slot.items():
+            self.subgrid.get_nd(name, out=array)
+        if t is None:
+            t = self.subgrid.get_nd('t1')
+        t = np.nan if t is None else float(t)
+        self.filled.put((step, t, slot))
+        self.recorded += 1
+
+    def __call__(self, step, t, buffers):
+        """Record, as the ``callback`` of the wrapper's ``run_steps``."""
+        self.record(step=step, t=t)
+
+    def run_steps(self, n, dt=-1):
+        """Do ``n`` timesteps and record every ``every`` steps."""
+        return self.subgrid.run_steps(n, dt=dt, every=self.every,
+                                      callback=self)
+
+    def run_until(self, t_end, dt=-1):
+        """Do timesteps until ``t_end`` and record every ``every`` steps."""
+        return self.subgrid.run_until(t_end, dt=dt, every=self.every,
+                                      callback=self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stop()
@@ -0,0 +1,263 @@
+"""Run the model in a child process, behind the wrapper's interface.
+
+A crash (a segfault in Fortran) or a hanging ``update`` takes down the whole
+process that loaded the library. The :class:`RemoteSubgridWrapper` loads the
+library in a child process instead and has the same methods as
+:class:`python_subgrid.wrapper.SubgridWrapper`::
+
+    with RemoteSubgridWrapper(mdu='/full/path/model.mdu',
+                              timeout=60) as subgrid:
+        subgrid.initmodel()
+        subgrid.update(-1)
+        s1 = subgrid.get_nd('s1')
+
+The calls and their arguments go over a pipe. The arrays from ``get_nd``
+don't, they are copied into shared memory by the child process and mapped
+by the parent without any further copying. When the child dies or doesn't
+answer within ``timeout`` seconds, a :class:`python_subgrid.utils.RemoteError`
+is raised and the model has to be started again.
+
+"""
+from __future__ import print_function
+import logging
+import multiprocessing
+import os
+import traceback
+
+from python_subgrid import utils
+from python_subgrid.wrapper import FUNCTIONS
+from python_subgrid.wrapper import SubgridWrapper
+from python_subgrid.wrapper import TYPEMAP
+
+logger = logging.getLogger(__name__)
+
+# Wrapper methods that are called in the model process. Arguments and return
+# values are pickled, so callbacks (``run_steps``) aren't supported.
+# ``get_nd`` is handled separately, see :func:`shared_get_nd`.
+REMOTE_METHODS = [function['name'] for function in FUNCTIONS] + [
+    'buffer_log',
+    'defer_events',
+    'flush_events',
+    'flush_log',
+    'get_var_type',
+    'get_var_rank',
+    'get_var_shape',
+    'inq_compound',
+    'inq_compound_field',
+    'instrument',
+    'restore',
+    'run_steps',
+    'run_until',
+    'set_structure_field',
+    'set_structure_fields',
+    'snapshot',
+    'stats',
+]
+
+
+def shared_get_nd(subgrid, segments, name, view=False, out=False):
+    """Call ``get_nd`` in the model process, return how to get the result.
+
+    Arrays are copied into shared memory and ``('shared', (path, shape,
+    dtype))`` is returned. Every call gets a new segment, except with
+    ``view`` or ``out``: those reuse one segment per variable, kept in
+    ``segments``. Scalars and data frames (compound variables without
+    ``view`` or ``out``) are returned as ``('value', value)``.
+    """
+    subgrid._check_documented(name)
+    info = subgrid._var_info(name)
+    reuse = view or out
+    if not info.shape or (info.type not in TYPEMAP and not reuse):
+        return 'value', subgrid.get_nd(name)
+    path, array = segments.get(name, (None, None))
+    new = not reuse or array is None or (array.shape, array.dtype) != (
+        info.shape, info.dtype)
+    if new:
+        path, array = utils.create_shared_array(info.shape, info.dtype)
+    if subgrid.get_nd(name, out=array) is None:
+        if new and path is not None:
+            os.unlink(path)
+        return 'value', None
+    if reuse:
+        segments[name] = (path, array)
+    return 'shared', (path, info.shape, info.dtype)
+
+
+def serve(conn, subgrid):
+    """Answer calls for ``subgrid`` received over ``conn`` until ``None``.
+
+    A call is a ``(method name, args, kwargs)`` tuple, the answer is
+    ``('ok', result)`` or ``('error', (exception, formatted traceback))``.
+    """
+    segments = {}
+    while True:
+        call = conn.recv()
+        if call is None:
+            break
+        name, args, kwargs = call
+        try:
+            if name == 'get_nd':
+                result = shared_get_nd(subgrid, segments, *args, **kwargs)
+            else:
+                result = getattr(subgrid, name)(*args, **kwargs)
+            conn.send(('ok', result))
+        except Exception as e:
+            tb = traceback.format_exc()
+            try:
+                conn.send(('error', (e, tb)))
+            except Exception:
+                # The exception or the result can't be pickled.
+                conn.send(('error', (utils.RemoteError(tb), tb)))
+
+
+def run_server(conn, mdu, call_mode):
+    """Serve a new (not yet started) wrapper, see :func:`serve`."""
+    serve(conn, SubgridWrapper(mdu=mdu, call_mode=call_mode))
+
+
+class RemoteSubgridWrapper(object):
+    """:class:`python_subgrid.wrapper.SubgridWrapper` in a child process.
+
+    The methods of the wrapper (see ``REMOTE_METHODS``) are called in the
+    model process. ``get_nd`` returns arrays on shared memory:
+
+    - By default every call gives a new array. It is writable, changes stay
+      private to your process (copy-on-write).
+
+    - With ``view=True`` you get a read-only array on a segment that is
+      reused for the variable: it doesn't follow the model, but the next
+      ``get_nd(name, view=True)`` (or ``out=...``) call refreshes it.
+
+    - With ``out`` the data is copied from that segment into ``out``.
+
+    """
+
+    def __init__(self, mdu=None, call_mode='safe', timeout=None):
+        """Initialize the class, nothing is started yet.
+
+        ``mdu`` and ``call_mode`` are passed to the wrapper in the model
+        process. ``timeout`` is the number of seconds to wait for a call,
+        ``None`` waits forever.
+        """
+        self.mdu = mdu
+        self.call_mode = call_mode
+        self.timeout = timeout
+        self.process = None
+        self.conn = None
+        # Per variable the (path, shape, dtype) and the array of the shared
+        # segment for views, see :func:`shared_get_nd`.
+        self._segments = {}
+
+    def start(self):
+        """Start the model process and the wrapper in it."""
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_server, args=(child_conn, self.mdu, self.call_mode))
+        self.process.daemon = True
+        self.process.start()
+        # Only the child has the other end now, so we notice when it dies.
+        child_conn.close()
+        try:
+            self._call('start')
+        except Exception:
+            self._kill()
+            raise
+
+    def stop(self):
+        """Stop the wrapper and the model process."""
+        if self.process is None:
+            return
+        try:
+            self._call('stop')
+        finally:
+            if self.process is not None:
+                self.conn.send(None)
+                self.process.join()
+                self._cleanup()
+
+    def _kill(self):
+        """Kill the model process, return its exit code."""
+        self.process.terminate()
+        self.process.join()
+        exitcode = self.process.exitcode
+        self._cleanup()
+        return exitcode
+
+    def _cleanup(self):
+        self.conn.close()
+        self.conn = None
+        self.process = None
+        self._segments.clear()
+
+    def _call(self, name, args=(), kwargs=None):
+        """Call method ``name`` in the model process, return the result.
+
+        Exceptions raised in the model process are raised again here.
+        """
+        if self.process is None:
+            raise utils.RemoteError(
+                "The model process isn't running, call start() first")
+        try:
+            self.conn.send((name, args, kwargs or {}))
+            if self.timeout is not None and not self.conn.poll(self.timeout):
+                self._kill()
+                msg = "{} didn't return within {} seconds, model stopped"
+                raise utils.RemoteError(msg.format(name, self.timeout))
+            status, result = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            msg = "The model process died (exit code {}) during {}"
+            raise utils.RemoteError(msg.format(self._kill(), name))
+        if status == 'error':
+            exception, tb = result
+            logger.debug("Error in the model process:\n%s", tb)
+            raise exception
+        return result
+
+    def get_nd(self, name, view=False, out=None):
+        """Return an nd array from the model process, see the class docs."""
+        reuse = view or out is not None
+        kind, result = self._call('get_nd', (name, ),
+                                  {'view': view, 'out': reuse})
+        if kind == 'value':
+            if out is None or result is None:
+                return result
+            out[...] = result
+            return out
+        path, shape, dtype = result
+        if not reuse:
+            return utils.open_shared_array(path, shape, dtype, mode='c')
+        key, array = self._segments.get(name, (None, None))
+        if key != result:
+            array = utils.open_shared_array(path, shape, dtype)
+            self._segments[name] = (result, array)
+        if out is None:
+            return array
+        if out.shape != shape or out.dtype != dtype:
+            msg = "Variable '{}' has shape {} and dtype {}, out has {} {}"
+            raise ValueError(msg.format(name, shape, dtype,
+                                        out.shape, out.dtype))
+        out[...] = array
+        return out
+
+    def __enter__(self):
+        """Start the model process (if needed), see :meth:`start`."""
+        if self.process is None:
+            self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        """Stop the model process, see :meth:`stop`."""
+        self.stop()
+
+
+def remote_method(name):
+    """Return a method that calls ``name`` in the model process."""
+    def method(self, *args, **kwargs):
+        return self._call(name, args, kwargs)
+    method.__name__ = name
+    method.__doc__ = "Call ``{}`` in the model process.".format(name)
+    return method
+
+
+for _name in REMOTE_METHODS:
+    setattr(RemoteSubgridWrapper, _name, remote_method(_name))
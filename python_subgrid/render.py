@@ -0,0 +1,199 @@
+"""Water depth rasters from the water levels and the bathymetry.
+
+The water depth of a pixel of the fine bathymetry grid (``dps``) is the
+water level (``s1``) of the cell the pixel is in, minus the bathymetry.
+A :class:`DepthRenderer` computes the pixel to cell map once per model,
+plus a pyramid of ever coarser versions of ``dps`` (and of the map). A
+raster for a bounding box only touches the pixels in view, at the pyramid
+level that fits the requested resolution::
+
+    renderer = DepthRenderer(subgrid)
+    subgrid.update(-1)
+    depth = renderer.render(xmin, ymin, xmax, ymax, width=256, height=256)
+
+Dry pixels and pixels outside the grid are NaN.
+
+After a ``changebathy`` only the pyramid blocks under the changed square
+are recomputed, other changes of the model's grid (``initmodel``,
+``loadmodel``, a restored snapshot with ``dps``) rebuild everything. See
+:meth:`python_subgrid.wrapper.SubgridWrapper._log_edit`.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import collections
+
+import numpy as np
+
+NODATA = -9999.0
+# Chunks of this many pixels when the cells are rasterized.
+CHUNK_PIXELS = 1000000
+
+
+def cell_map(xmin, xmax, ymin, ymax, x0, y0, dx, shape):
+    """Return the cell of every pixel, -1 for pixels without a cell.
+
+    ``xmin`` to ``ymax`` are the bounds of the cells (see
+    :class:`python_subgrid.grid.CellIndex`), the pixels are ``dx`` wide
+    and high from ``(x0, y0)`` on. The map has ``shape`` (columns, rows),
+    like ``dps``.
+    """
+    result = np.empty(shape, dtype='i4', order='F')
+    result.fill(-1)
+    widths = np.round((xmax - xmin) / dx).astype('i8')
+    for width in np.unique(widths):
+        cells = np.flatnonzero(widths == width)
+        width = max(int(width), 1)
+        offsets = np.arange(width)
+        chunk = max(CHUNK_PIXELS // (width * width), 1)
+        for start in range(0, len(cells), chunk):
+            block = cells[start:start + chunk]
+            i0 = np.round((xmin[block] - x0) / dx).astype('i8')
+            j0 = np.round((ymin[block] - y0) / dx).astype('i8')
+            i = (i0[:, None] + offsets)[:, :, None]
+            j = (j0[:, None] + offsets)[:, None, :]
+            inside = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1])
+            i, j, block = np.broadcast_arrays(i, j, block[:, None, None])
+            result[i[inside], j[inside]] = block[inside]
+    return result
+
+
+def downsample(values):
+    """Return the mean of every 2 by 2 block of ``values``, ignoring NaN.
+
+    Odd sizes are padded with NaN, blocks of only NaN are NaN.
+    """
+    columns, rows = values.shape
+    padded = np.empty((columns + columns % 2, rows + rows % 2), dtype='f8')
+    padded.fill(np.nan)
+    padded[:columns, :rows] = values
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0.0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype('f4')
+
+
+class DepthRenderer(object):
+    """Render water depth rasters of a started wrapper.
+
+    The pyramid has up to ``levels`` levels on top of ``dps`` itself, every
+    level has pixels twice as large as the one below. Bathymetry values
+    ``nodata`` are missing.
+    """
+
+    def __init__(self, subgrid, levels=8, nodata=NODATA):
+        self.subgrid = subgrid
+        self.levels = levels
+        self.nodata = nodata
+        # The wrapper's ``edit_count`` the pyramid is up to date with.
+        self.seen = None
+        self.stats = collections.Counter()
+
+    def _dps(self, i0=None, i1=None, j0=None, j1=None):
+        """Return (a block of) the library's ``dps``, with NaN for missing
+        values.
+        """
+        dps = self.subgrid._array('dps')[i0:i1, j0:j1]
+        return np.where(dps == self.nodata, np.nan, dps)
+
+    def build(self):
+        """Compute the pixel to cell map and the pyramid from scratch."""
+        subgrid = self.subgrid
+        self.seen = subgrid.edit_count
+        self.x0 = float(subgrid.get_nd('x0p'))
+        self.y0 = float(subgrid.get_nd('y0p'))
+        self.dx = float(subgrid.get_nd('dxp'))
+        shape = subgrid._var_info('dps').shape
+        cells = subgrid.grid_index().cells
+        self.cells = [cell_map(cells.xmin, cells.xmax, cells.ymin,
+                               cells.ymax, self.x0, self.y0, self.dx,
+                               shape)]
+        # Level 0 is the library's ``dps`` itself.
+        self.dps = [None]
+        dps = self._dps()
+        while len(self.dps) <= self.levels and min(dps.shape) > 1:
+            dps = downsample(dps)
+            self.dps.append(dps)
+            self.cells.append(self.cells[-1][::2, ::2])
+        self.stats['builds'] += 1
+
+    def _update(self, xmin, ymin, xmax, ymax):
+        """Recompute the pyramid blocks under a box of changed pixels."""
+        shape = self.cells[0].shape
+        i0 = max(int(np.floor((xmin - self.x0) / self.dx)), 0)
+        i1 = min(int(np.ceil((xmax - self.x0) / self.dx)), shape[0])
+        j0 = max(int(np.floor((ymin - self.y0) / self.dx)), 0)
+        j1 = min(int(np.ceil((ymax - self.y0) / self.dx)), shape[1])
+        if i0 >= i1 or j0 >= j1:
+            return
+        for level in range(1, len(self.dps)):
+            # The blocks of this level that cover the changed pixels below.
+            i0, i1 = i0 // 2, (i1 + 1) // 2
+            j0, j1 = j0 // 2, (j1 + 1) // 2
+            if level == 1:
+                source = self._dps(2 * i0, 2 * i1, 2 * j0, 2 * j1)
+            else:
+                source = self.dps[level - 1][2 * i0:2 * i1, 2 * j0:2 * j1]
+            self.dps[level][i0:i1, j0:j1] = downsample(source)
+        self.stats['updates'] += 1
+
+    def sync(self):
+        """Bring the pyramid up to date with the model's grid and bathymetry.
+
+        :meth:`render` does this for you.
+        """
+        subgrid = self.subgrid
+        new = subgrid.edit_count - (self.seen or 0)
+        if self.seen is not None and not new:
+            return
+        edits = list(subgrid.edits)[-new:]
+        if (self.seen is None or new > len(edits) or
+                any(name != 'changebathy' for (name, args) in edits)):
+            self.build()
+            return
+        for name, (xc, yc, size, bval, bmode) in edits:
+            half = size / 2
+            self._update(xc - half, yc - half, xc + half, yc + half)
+        self.seen = subgrid.edit_count
+
+    def level(self, resolution):
+        """Return the pyramid level for pixels of ``resolution`` meters.
+
+        That's the coarsest level with pixels no larger than that.
+        """
+        if resolution <= self.dx:
+            return 0
+        level = int(np.floor(np.log2(resolution / self.dx)))
+        return min(level, len(self.dps) - 1)
+
+    def render(self, xmin, ymin, xmax, ymax, width=256, height=256):
+        """Return the water depth in a box as a ``(height, width)`` array.
+
+        The first row is the top (north) of the box. Dry pixels and pixels
+        outside the grid are NaN.
+        """
+        self.sync()
+        level = self.level(min((xmax - xmin) / width, (ymax - ymin) / height))
+        size = self.dx * 2 ** level
+        cells = self.cells[level]
+        xs = xmin + (np.arange(width) + 0.5) * ((xmax - xmin) / width)
+        ys = ymax - (np.arange(height) + 0.5) * ((ymax - ymin) / height)
+        i = np.floor((xs - self.x0) / size).astype('i8')
+        j = np.floor((ys - self.y0) / size).astype('i8')
+        inside = (((i >= 0) & (i < cells.shape[0]))[None, :] &
+                  ((j >= 0) & (j < cells.shape[1]))[:, None])
+        i = np.clip(i, 0, cells.shape[0] - 1)[None, :]
+        j = np.clip(j, 0, cells.shape[1] - 1)[:, None]
+        pixel_cells = cells[i, j]
+        if level:
+            dps = self.dps[level][i, j]
+        else:
+            dps = self.subgrid._array('dps')[i, j]
+            inside &= dps != self.nodata
+        depth = self.subgrid._array('s1')[pixel_cells] - dps
+        with np.errstate(invalid='ignore'):
+            depth[~(inside & (pixel_cells >= 0) & (depth > 0))] = np.nan
+        self.stats['renders'] += 1
+        return depth
@@ -0,0 +1,124 @@
+"""Snapshots of a model's state, in memory or in a file.
+
+:meth:`python_subgrid.wrapper.SubgridWrapper.snapshot` copies the state
+variables (water levels, velocities, structures, model time) out of the
+library into one contiguous buffer, ``restore`` copies them back. That makes
+branching off scenarios cheap::
+
+    base = subgrid.snapshot()
+    for capacity in [0.0, 5.0, 10.0]:
+        subgrid.restore(base)
+        subgrid.set_structure_fields('pumps', ['pump01'],
+                                     {'capacity': capacity})
+        subgrid.run_steps(100)
+
+With a ``path`` the buffer is a file: a small JSON header followed by the
+raw data. :meth:`Snapshot.open` maps such a file into memory, so another
+process (with the same model loaded) can restore it without reading it
+first.
+
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import struct
+
+import numpy as np
+
+from python_subgrid.utils import dtype_from_json
+from python_subgrid.utils import dtype_to_json
+
+MAGIC = b'SUBGRIDSNAPSHOT1'
+# Every variable starts at a multiple of this number of bytes.
+ALIGNMENT = 64
+
+
+def align(offset):
+    """Return ``offset`` rounded up to a multiple of ``ALIGNMENT``."""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class Snapshot(object):
+    """Raw copies of variables in one buffer.
+
+    ``layout`` has a ``(name, offset, shape, dtype)`` tuple per variable,
+    ``buffer`` is a 1d uint8 array (possibly a memory map) with the
+    variables' bytes in the library's (Fortran) order.
+    """
+
+    def __init__(self, layout, buffer):
+        self.layout = layout
+        self.buffer = buffer
+
+    @classmethod
+    def empty(cls, variables, path=None):
+        """Return an uninitialized snapshot for ``(name, shape, dtype)``
+        tuples, in memory or in file ``path``.
+        """
+        layout = []
+        nbytes = 0
+        for name, shape, dtype in variables:
+            dtype = np.dtype(dtype)
+            # The library's shapes are numpy integers, json wants ints.
+            shape = tuple(int(size) for size in shape)
+            layout.append((name, nbytes, shape, dtype))
+            nbytes = align(nbytes + int(np.prod(shape)) * dtype.itemsize)
+        if path is None:
+            return cls(layout, np.empty(nbytes, dtype='u1'))
+        header = json.dumps([(item[0], item[1], list(item[2]),
+                              dtype_to_json(item[3])) for item in layout])
+        start = align(len(MAGIC) + 8 + len(header))
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.truncate(start + nbytes)
+        if not nbytes:
+            return cls(layout, np.empty(0, dtype='u1'))
+        return cls(layout, np.memmap(path, dtype='u1', mode='r+',
+                                     offset=start, shape=(nbytes, )))
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Return the snapshot in file ``path``, mapped into memory.
+
+        ``mode`` is passed to ``np.memmap``: ``'r'`` is read-only, ``'r+'``
+        writes changes back to the file.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a snapshot".format(path))
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length))
+        layout = [(str(name), offset, tuple(shape), dtype_from_json(dtype))
+                  for (name, offset, shape, dtype) in header]
+        start = align(len(MAGIC) + 8 + length)
+        nbytes = 0
+        if layout:
+            name, offset, shape, dtype = layout[-1]
+            nbytes = align(offset + int(np.prod(shape)) * dtype.itemsize)
+        if not nbytes:
+            return cls(layout, np.empty(0, dtype='u1'))
+        return cls(layout, np.memmap(path, dtype='u1', mode=mode,
+                                     offset=start, shape=(nbytes, )))
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def __contains__(self, name):
+        return any(name == item[0] for item in self.layout)
+
+    def __getitem__(self, name):
+        """Return an array on the buffer for variable ``name``."""
+        for name_, offset, shape, dtype in self.layout:
+            if name_ == name:
+                nbytes = int(np.prod(shape)) * dtype.itemsize
+                return np.ndarray(shape, dtype=dtype, order='F',
+                                  buffer=self.buffer[offset:offset + nbytes])
+        raise KeyError(name)
+
+    def flush(self):
+        """Write the changes of a file snapshot to disk."""
+        if isinstance(self.buffer, np.memmap):
+            self.buffer.flush()
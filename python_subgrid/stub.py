@@ -0,0 +1,49 @@
+"""Stand-in for the Fortran subgrid library, for tests and benchmarks.
+
+``subgrid_stub.c`` (next to this file) is a small C library that exports the
+functions the wrapper uses, over synthetic arrays. It needs a C compiler::
+
+    >>> from python_subgrid import stub
+    >>> directory = stub.build()  # doctest: +SKIP
+    >>> os.environ['SUBGRID_PATH'] = directory  # doctest: +SKIP
+
+Afterwards :class:`python_subgrid.wrapper.SubgridWrapper` finds the stub
+library instead of the real one, :func:`mdu` is a model file you can load.
+
+"""
+from __future__ import print_function
+import logging
+import os
+import subprocess
+import tempfile
+
+from python_subgrid.wrapper import SubgridWrapper
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'subgrid_stub.c')
+MDU_FILENAME = 'stub.mdu'
+
+logger = logging.getLogger(__name__)
+
+
+def build(directory=None):
+    """Compile the stub library into ``directory`` and return the directory.
+
+    A temporary directory is created if you don't pass one. The ``CC``
+    environment variable can be used to pick the compiler. An (empty) model
+    file is placed next to the library, see :func:`mdu`.
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='subgrid_stub')
+    compiler = os.environ.get('CC', 'cc')
+    target = os.path.join(directory, SubgridWrapper()._libname())
+    command = [compiler, '-shared', '-fPIC', '-O2', '-o', target, SOURCE]
+    logger.info("Building stub library: %s", ' '.join(command))
+    subprocess.check_call(command)
+    open(mdu(directory), 'w').close()
+    return directory
+
+
+def mdu(directory):
+    """Return the path of the stub model file in ``directory``."""
+    return os.path.join(directory, MDU_FILENAME)
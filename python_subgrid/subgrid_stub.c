@@ -0,0 +1,427 @@
+/*
+ * Stand-in for the Fortran libsubgrid shared library.
+ *
+ * It exports the symbols used by python_subgrid.wrapper.SubgridWrapper over
+ * synthetic arrays so that the wrapper can be tested and benchmarked on a
+ * machine without the (proprietary) subgrid library or model checkouts.
+ *
+ * The model is a small "quadtree": a block of fine cells (10m) next to a
+ * block of coarse cells (20m), one link per cell and a fine pixel grid (5m)
+ * with bathymetry. Sizes and cost can be tuned with environment variables
+ * that are read on ``loadmodel``:
+ *
+ *   SUBGRID_STUB_NX        number of fine cells in each direction (32)
+ *   SUBGRID_STUB_PUMPS     number of pumps (3)
+ *   SUBGRID_STUB_WORK      busy loop iterations per cell per update (0)
+ *   SUBGRID_STUB_LOGLINES  debug log messages per update (0)
+ *
+ * Build it with ``python_subgrid.stub.build()`` or by hand with
+ * ``cc -shared -fPIC -O2 -o libsubgrid.so subgrid_stub.c``.
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define MAXDIMS 6
+#define IDLEN 20
+
+typedef void (*log_func_t)(int *level, const char *message);
+
+typedef struct {
+    char id[IDLEN];
+    double capacity;
+    int active;
+} pump_t;
+
+static log_func_t logger = NULL;
+
+static int nx = 0;
+static int ny = 0;
+static int n2d = 0;
+static int n1d = 0;
+static int nlinks = 0;
+static int imax = 0;
+static int jmax = 0;
+static int npumps = 0;
+static int nmanholes = 0;
+static long work = 0;
+static int loglines = 0;
+
+static double t1 = 0.0;
+static double dt_default = 1.0;
+static double x0p = 0.0;
+static double y0p = 0.0;
+static double dxp = 5.0;
+static double *s1 = NULL;
+static double *u1 = NULL;
+static double *xcc = NULL;
+static double *ycc = NULL;
+static double *contour_x = NULL;
+static double *contour_y = NULL;
+static double *xu = NULL;
+static double *yu = NULL;
+static double *dps = NULL;
+static pump_t *pumps = NULL;
+
+static void log_message(int level, const char *message)
+{
+    if (logger != NULL) {
+        logger(&level, message);
+    }
+}
+
+static int env_int(const char *name, int fallback)
+{
+    const char *value = getenv(name);
+    return value ? atoi(value) : fallback;
+}
+
+static void free_model(void)
+{
+    free(s1); free(u1); free(xcc); free(ycc);
+    free(contour_x); free(contour_y); free(xu); free(yu);
+    free(dps); free(pumps);
+    s1 = u1 = xcc = ycc = contour_x = contour_y = xu = yu = dps = NULL;
+    pumps = NULL;
+    n2d = nlinks = imax = jmax = npumps = nmanholes = 0;
+}
+
+static void add_cell(int c, double x, double y, double size)
+{
+    xcc[c] = x + size / 2;
+    ycc[c] = y + size / 2;
+    /* Fortran order (4, n2d): corner k of cell c lives at k + 4 * c. */
+    contour_x[4 * c + 0] = x;
+    contour_x[4 * c + 1] = x + size;
+    contour_x[4 * c + 2] = x + size;
+    contour_x[4 * c + 3] = x;
+    contour_y[4 * c + 0] = y;
+    contour_y[4 * c + 1] = y;
+    contour_y[4 * c + 2] = y + size;
+    contour_y[4 * c + 3] = y + size;
+    xu[c] = x + size;
+    yu[c] = y + size / 2;
+}
+
+static void init_state(void)
+{
+    int c, i, j;
+    t1 = 0.0;
+    for (c = 0; c < n2d; c++) {
+        s1[c] = 0.0;
+        u1[c] = 0.0;
+    }
+    for (j = 0; j < jmax; j++) {
+        for (i = 0; i < imax; i++) {
+            dps[i + j * imax] = -1.0 + 0.001 * i - 0.002 * j;
+        }
+    }
+    for (c = 0; c < npumps; c++) {
+        memset(pumps[c].id, 0, IDLEN);
+        snprintf(pumps[c].id, IDLEN, "pump%02d", c + 1);
+        pumps[c].capacity = 1.0 + c;
+        pumps[c].active = 1;
+    }
+}
+
+static int find_cell(double x, double y)
+{
+    int c;
+    for (c = 0; c < n2d; c++) {
+        if (x >= contour_x[4 * c] && x < contour_x[4 * c + 1] &&
+            y >= contour_y[4 * c] && y < contour_y[4 * c + 2]) {
+            return c;
+        }
+    }
+    return -1;
+}
+
+int startup(void)
+{
+    log_message(2, "stub subgrid library started");
+    return 0;
+}
+
+int shutdown(void)
+{
+    free_model();
+    logger = NULL;
+    return 0;
+}
+
+void set_mh_c_callback(log_func_t *callback)
+{
+    logger = *callback;
+}
+
+void subgrid_info(void)
+{
+    log_message(2, "stub subgrid library");
+}
+
+int loadmodel(const char *mdu)
+{
+    int c, i, j, ncoarse;
+    if (mdu == NULL || mdu[0] == '\0') {
+        return 1;
+    }
+    free_model();
+    nx = env_int("SUBGRID_STUB_NX", 32);
+    ny = nx;
+    npumps = env_int("SUBGRID_STUB_PUMPS", 3);
+    work = env_int("SUBGRID_STUB_WORK", 0);
+    loglines = env_int("SUBGRID_STUB_LOGLINES", 0);
+    ncoarse = (nx / 2) * (ny / 2);
+    n2d = nx * ny + ncoarse;
+    nlinks = n2d;
+    imax = 4 * nx;  /* 2 * nx * 10m / 5m */
+    jmax = 2 * ny;  /* ny * 10m / 5m */
+
+    s1 = calloc(n2d, sizeof(double));
+    u1 = calloc(nlinks, sizeof(double));
+    xcc = calloc(n2d, sizeof(double));
+    ycc = calloc(n2d, sizeof(double));
+    contour_x = calloc(4 * n2d, sizeof(double));
+    contour_y = calloc(4 * n2d, sizeof(double));
+    xu = calloc(nlinks, sizeof(double));
+    yu = calloc(nlinks, sizeof(double));
+    dps = calloc(imax * jmax, sizeof(double));
+    pumps = calloc(npumps > 0 ? npumps : 1, sizeof(pump_t));
+
+    c = 0;
+    for (j = 0; j < ny; j++) {
+        for (i = 0; i < nx; i++) {
+            add_cell(c++, i * 10.0, j * 10.0, 10.0);
+        }
+    }
+    for (j = 0; j < ny / 2; j++) {
+        for (i = 0; i < nx / 2; i++) {
+            add_cell(c++, nx * 10.0 + i * 20.0, j * 20.0, 20.0);
+        }
+    }
+    init_state();
+    log_message(2, "stub model loaded");
+    return 0;
+}
+
+int initmodel(void)
+{
+    init_state();
+    return 0;
+}
+
+int finalizemodel(void)
+{
+    return 0;
+}
+
+int update(double *dt)
+{
+    int c, k;
+    long w;
+    double step = (*dt < 0) ? dt_default : *dt;
+    volatile double sink = 0.0;
+    for (c = 0; c < n2d; c++) {
+        s1[c] += 0.001 * step * (1 + c % 7);
+        u1[c] = 0.01 * (c % 13) * step;
+        for (w = 0; w < work; w++) {
+            sink += s1[c] * w;
+        }
+    }
+    for (k = 0; k < loglines; k++) {
+        log_message(1, "stub update: computing timestep");
+    }
+    t1 += step;
+    return 0;
+}
+
+int changebathy(double *xc, double *yc, double *size, double *bval, int *bmode)
+{
+    int i, j;
+    double half = *size / 2, x, y;
+    for (j = 0; j < jmax; j++) {
+        y = y0p + (j + 0.5) * dxp;
+        if (y < *yc - half || y > *yc + half) continue;
+        for (i = 0; i < imax; i++) {
+            x = x0p + (i + 0.5) * dxp;
+            if (x < *xc - half || x > *xc + half) continue;
+            if (*bmode == 1) {
+                dps[i + j * imax] = *bval;
+            } else {
+                dps[i + j * imax] += *bval;
+            }
+        }
+    }
+    return 0;
+}
+
+int floodfilling(double *x, double *y, double *level, int *mode)
+{
+    int c = find_cell(*x, *y);
+    if (c < 0) return 1;
+    s1[c] = *level;
+    return 0;
+}
+
+int discharge(double *x, double *y, char *name, int *itype, double *value)
+{
+    int c = find_cell(*x, *y);
+    if (c < 0) return 1;
+    nmanholes++;
+    s1[c] += *value / 1000.0;
+    return 0;
+}
+
+int discard_manhole(double *x, double *y)
+{
+    if (nmanholes > 0) nmanholes--;
+    return 0;
+}
+
+int discard_structure(char *id)
+{
+    int c;
+    for (c = 0; c < npumps; c++) {
+        if (strncmp(pumps[c].id, id, IDLEN) == 0) {
+            memmove(&pumps[c], &pumps[c + 1],
+                    (npumps - c - 1) * sizeof(pump_t));
+            npumps--;
+            return 0;
+        }
+    }
+    return 1;
+}
+
+int dropinstantrain(double *x, double *y, double *diameter, double *amount)
+{
+    int c = find_cell(*x, *y);
+    if (c < 0) return 1;
+    s1[c] += *amount / 1000.0;
+    return 0;
+}
+
+int getwaterlevel(double *x, double *y, double *level)
+{
+    int c = find_cell(*x, *y);
+    *level = (c < 0) ? -999.0 : s1[c];
+    return 0;
+}
+
+/* Variable information functions. */
+
+void get_var_rank(char *name, int *rank)
+{
+    if (strcmp(name, "t1") == 0 || strcmp(name, "x0p") == 0 ||
+        strcmp(name, "y0p") == 0 || strcmp(name, "dxp") == 0 ||
+        strcmp(name, "nFlowElem2d") == 0 ||
+        strcmp(name, "nFlowElem1d") == 0) {
+        *rank = 0;
+    } else if (strcmp(name, "dps") == 0 ||
+               strcmp(name, "FlowElemContour_x") == 0 ||
+               strcmp(name, "FlowElemContour_y") == 0) {
+        *rank = 2;
+    } else {
+        *rank = 1;
+    }
+}
+
+void get_var_shape(char *name, int *shape)
+{
+    memset(shape, 0, MAXDIMS * sizeof(int));
+    if (strcmp(name, "dps") == 0) {
+        shape[0] = imax;
+        shape[1] = jmax;
+    } else if (strcmp(name, "FlowElemContour_x") == 0 ||
+               strcmp(name, "FlowElemContour_y") == 0) {
+        shape[0] = 4;
+        shape[1] = n2d;
+    } else if (strcmp(name, "pumps") == 0) {
+        shape[0] = npumps;
+    } else if (strcmp(name, "u1") == 0 || strcmp(name, "FlowLink_xu") == 0 ||
+               strcmp(name, "FlowLink_yu") == 0) {
+        shape[0] = nlinks;
+    } else {
+        int rank;
+        get_var_rank(name, &rank);
+        if (rank == 1) shape[0] = n2d;
+    }
+}
+
+void get_var_type(char *name, char *type)
+{
+    if (strcmp(name, "pumps") == 0) {
+        strcpy(type, "pump");
+    } else if (strcmp(name, "nFlowElem2d") == 0 ||
+               strcmp(name, "nFlowElem1d") == 0) {
+        strcpy(type, "int");
+    } else {
+        strcpy(type, "double");
+    }
+}
+
+void get_var(char *name, void **ptr)
+{
+    *ptr = NULL;
+    if (s1 == NULL) return;
+    if (strcmp(name, "s1") == 0) *ptr = s1;
+    else if (strcmp(name, "u1") == 0) *ptr = u1;
+    else if (strcmp(name, "t1") == 0) *ptr = &t1;
+    else if (strcmp(name, "dps") == 0) *ptr = dps;
+    else if (strcmp(name, "x0p") == 0) *ptr = &x0p;
+    else if (strcmp(name, "y0p") == 0) *ptr = &y0p;
+    else if (strcmp(name, "dxp") == 0) *ptr = &dxp;
+    else if (strcmp(name, "nFlowElem2d") == 0) *ptr = &n2d;
+    else if (strcmp(name, "nFlowElem1d") == 0) *ptr = &n1d;
+    else if (strcmp(name, "FlowElem_xcc") == 0) *ptr = xcc;
+    else if (strcmp(name, "FlowElem_ycc") == 0) *ptr = ycc;
+    else if (strcmp(name, "FlowElemContour_x") == 0) *ptr = contour_x;
+    else if (strcmp(name, "FlowElemContour_y") == 0) *ptr = contour_y;
+    else if (strcmp(name, "FlowLink_xu") == 0) *ptr = xu;
+    else if (strcmp(name, "FlowLink_yu") == 0) *ptr = yu;
+    else if (strcmp(name, "pumps") == 0) *ptr = pumps;
+}
+
+void inq_compound(char *name, int *nfields)
+{
+    *nfields = (strcmp(name, "pump") == 0) ? 3 : 0;
+}
+
+void inq_compound_field(char *name, int *index, char *fieldname,
+                        char *fieldtype, int *rank, int *shape)
+{
+    memset(shape, 0, MAXDIMS * sizeof(int));
+    *rank = 0;
+    switch (*index) {
+    case 1:
+        strcpy(fieldname, "id");
+        strcpy(fieldtype, "char");
+        *rank = 1;
+        shape[0] = IDLEN;
+        break;
+    case 2:
+        strcpy(fieldname, "capacity");
+        strcpy(fieldtype, "double");
+        break;
+    case 3:
+        strcpy(fieldname, "active");
+        strcpy(fieldtype, "int");
+        break;
+    }
+}
+
+int set_structure_field(char *name, char *id, char *field, void **value)
+{
+    int c;
+    for (c = 0; c < npumps; c++) {
+        if (strncmp(pumps[c].id, id, IDLEN) != 0) continue;
+        if (strcmp(field, "capacity") == 0) {
+            pumps[c].capacity = *(double *)*value;
+        } else if (strcmp(field, "active") == 0) {
+            pumps[c].active = *(int *)*value;
+        } else {
+            return 1;
+        }
+        return 0;
+    }
+    return 1;
+}
@@ -0,0 +1,230 @@
+"""Hand out ready models, forked from a model that is loaded only once.
+
+Loading a large model (``loadmodel``) takes seconds. The
+:class:`TemplatePool` loads the model once in a template process and forks
+that process for every model you ask for. The forked process starts out
+with the template's (already loaded and initialized) model, its memory is
+only copied when it changes (copy-on-write)::
+
+    with TemplatePool(mdu='/full/path/model.mdu') as pool:
+        for value in [10.0, 100.0]:
+            with pool.get() as subgrid:
+                subgrid.discharge(x, y, 'manhole', 1, value)
+                subgrid.update(-1)
+                s1 = subgrid.get_nd('s1')
+
+The models are :class:`python_subgrid.remote.RemoteSubgridWrapper`
+instances that are already started, stop them when you're done. This needs
+``os.fork()``, so it doesn't work on Windows.
+
+"""
+from __future__ import print_function
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import time
+import traceback
+from multiprocessing.connection import Client
+from multiprocessing.connection import Listener
+
+from python_subgrid import remote
+from python_subgrid import utils
+from python_subgrid.wrapper import SubgridWrapper
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the checks whether a forked process is still alive, while
+# we wait for it to connect.
+ACCEPT_POLL_INTERVAL = 0.1
+
+
+class ForkedProcess(object):
+    """A model process forked by the template process.
+
+    It isn't our child process, so this only has the parts of
+    ``multiprocessing.Process`` that the remote wrapper needs. The exit code
+    isn't known.
+    """
+
+    exitcode = None
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def join(self):
+        while self.is_alive():
+            time.sleep(0.001)
+
+
+def fork_model(conn, subgrid, address, authkey):
+    """Fork a process that serves ``subgrid`` on ``address``, return its pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    # We're the forked process, we never return into the template's loop.
+    exitcode = 0
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        conn.close()
+        remote.serve(Client(address, authkey=authkey), subgrid)
+    except Exception:
+        traceback.print_exc()
+        exitcode = 1
+    finally:
+        os._exit(exitcode)
+
+
+def run_template(conn, mdu, call_mode, init, authkey):
+    """Load the model once, fork it for every address received over ``conn``.
+    """
+    # The forked processes are reaped automatically.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    subgrid = SubgridWrapper(mdu=mdu, call_mode=call_mode)
+    try:
+        subgrid.start()
+        if init:
+            subgrid.initmodel()
+    except Exception as e:
+        conn.send(('error', (e, traceback.format_exc())))
+        return
+    conn.send(('ok', None))
+    try:
+        while True:
+            address = conn.recv()
+            if address is None:
+                break
+            try:
+                pid = fork_model(conn, subgrid, address, authkey)
+            except OSError as e:
+                conn.send(('error', (e, traceback.format_exc())))
+                continue
+            conn.send(('ok', pid))
+    finally:
+        subgrid.stop()
+
+
+class TemplatePool(object):
+    """Template process for handing out forked, ready to use models.
+
+    ``mdu`` and ``call_mode`` are the wrapper's, ``timeout`` is passed to the
+    remote wrappers that :meth:`get` returns. With ``init`` (the default)
+    the template model is initialized (``initmodel``) before it is forked.
+    """
+
+    def __init__(self, mdu, call_mode='safe', init=True, timeout=None):
+        self.mdu = mdu
+        self.call_mode = call_mode
+        self.init = init
+        self.timeout = timeout
+        self.process = None
+        self.conn = None
+        self.listener = None
+
+    def start(self):
+        """Start the template process and load the model in it."""
+        authkey = os.urandom(20)
+        self.listener = Listener(family='AF_UNIX', authkey=authkey)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_template,
+            args=(child_conn, self.mdu, self.call_mode, self.init, authkey))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        try:
+            self._receive()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        """Stop the template process.
+
+        Models that were handed out keep running until you stop them.
+        """
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join()
+        self.conn.close()
+        self.listener.close()
+        self.process = None
+
+    def _receive(self):
+        """Return the template's answer or raise its exception."""
+        try:
+            status, result = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            self.process.join()
+            msg = "The template process died (exit code {})"
+            raise utils.RemoteError(msg.format(self.process.exitcode))
+        if status == 'error':
+            exception, tb = result
+            logger.debug("Error in the template process:\n%s", tb)
+            raise exception
+        return result
+
+    def get(self):
+        """Return a started remote wrapper on a fork of the template model.
+        """
+        if self.process is None:
+            raise utils.RemoteError(
+                "The template process isn't running, call start() first")
+        self.conn.send(self.listener.address)
+        pid = self._receive()
+        subgrid = remote.RemoteSubgridWrapper(mdu=self.mdu,
+                                              call_mode=self.call_mode,
+                                              timeout=self.timeout)
+        process = ForkedProcess(pid)
+        subgrid.conn = self._accept(process)
+        subgrid.process = process
+        return subgrid
+
+    def _accept(self, process):
+        """Return the connection of forked ``process``.
+
+        Raise a :class:`python_subgrid.utils.RemoteError` if the process
+        dies before it connects, or doesn't connect within ``timeout``
+        seconds (then it is killed).
+        """
+        # The listener has no timeout of its own, so we wait for the
+        # connection on its socket.
+        listening = self.listener._listener._socket
+        start = time.time()
+        while not select.select([listening], [], [], ACCEPT_POLL_INTERVAL)[0]:
+            if not process.is_alive():
+                msg = "The forked model process {} died before it connected"
+                raise utils.RemoteError(msg.format(process.pid))
+            if (self.timeout is not None and
+                    time.time() - start > self.timeout):
+                process.terminate()
+                msg = "The forked model process {} didn't connect within {} "
+                msg += "seconds, it is stopped"
+                raise utils.RemoteError(msg.format(process.pid, self.timeout))
+        return self.listener.accept()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stop()
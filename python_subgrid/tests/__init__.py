@@ -1 +1,59 @@
-# Package
+"""Tests of python_subgrid.
+
+The stub library is built for the tests (see :mod:`python_subgrid.stub`),
+tests that need it derive from
+:class:`python_subgrid.tests.helpers.StubTestCase`. Without the Fortran
+library (no ``SUBGRID_PATH`` and nothing in the usual places) the other
+tests use the stub as well. The functional tests still need the real library
+and the scenario models.
+"""
+import atexit
+import logging
+import os
+import shutil
+import subprocess
+
+from python_subgrid import stub
+from python_subgrid.wrapper import SubgridWrapper
+
+logger = logging.getLogger(__name__)
+
+# The directory with the stub library, if we built it.
+stub_directory = None
+# Whether we pointed ``SUBGRID_PATH`` at the stub library.
+stub_path_set = False
+
+
+def build_stub():
+    """Return the directory with the stub library, built on first use.
+
+    None if the stub can't be built.
+    """
+    global stub_directory
+    if stub_directory is None:
+        try:
+            stub_directory = stub.build()
+        except (OSError, subprocess.CalledProcessError):
+            logger.warn("The stub library can't be built")
+            return None
+        # Also when the tests are run without the package's teardown.
+        atexit.register(shutil.rmtree, stub_directory, True)
+    return stub_directory
+
+
+def setup_package():
+    global stub_path_set
+    if build_stub() is None:
+        return
+    try:
+        SubgridWrapper()._library_path()
+    except RuntimeError:
+        os.environ['SUBGRID_PATH'] = stub_directory
+        stub_path_set = True
+
+
+def teardown_package():
+    global stub_path_set
+    if stub_path_set:
+        del os.environ['SUBGRID_PATH']
+        stub_path_set = False
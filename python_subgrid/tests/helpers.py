@@ -0,0 +1,36 @@
+"""Helpers shared by the tests."""
+import os
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid import stub
+from python_subgrid import tests
+
+
+def contours(cells):
+    """Return contour_x, contour_y for (x, y, size) squares."""
+    contour_x = np.array([[x, x + size, x + size, x]
+                          for (x, y, size) in cells]).T
+    contour_y = np.array([[y, y, y + size, y + size]
+                          for (x, y, size) in cells]).T
+    return contour_x.astype('f8'), contour_y.astype('f8')
+
+
+class StubTestCase(unittest.TestCase):
+    """Tests against the stub library, skipped if it couldn't be built.
+
+    ``SUBGRID_PATH`` points at the stub during the tests, ``self.mdu`` is
+    its model.
+    """
+
+    def setUp(self):
+        directory = tests.build_stub()
+        if directory is None:
+            raise unittest.SkipTest("The stub library isn't built")
+        self.environ = mock.patch.dict(os.environ,
+                                       {'SUBGRID_PATH': directory})
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+        self.mdu = stub.mdu(directory)
@@ -0,0 +1,50 @@
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid import asynchronous
+
+
+class TestAsyncSubgridWrapper(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = asynchronous.AsyncSubgridWrapper()
+        self.wrapper.subgrid = mock.Mock()
+        self.wrapper.subgrid.get_nd.side_effect = lambda name: np.zeros(3)
+        self.wrapper.start()
+
+    def tearDown(self):
+        self.wrapper.stop()
+
+    def test_coalesced_reads(self):
+        first = self.wrapper.get_nd('s1')
+        second = self.wrapper.get_nd('s1')
+        self.assertIs(first, second)
+        self.assertFalse(first.result().flags.writeable)
+        self.assertEqual(self.wrapper.subgrid.get_nd.call_count, 1)
+
+    def test_update_invalidates_reads(self):
+        first = self.wrapper.get_nd('s1')
+        self.wrapper.update(-1)
+        second = self.wrapper.get_nd('s1')
+        self.assertIsNot(first, second)
+        second.result()
+        self.assertEqual(self.wrapper.subgrid.get_nd.call_count, 2)
+
+    def test_exception(self):
+        self.wrapper.subgrid.update.side_effect = RuntimeError
+        future = self.wrapper.update(-1)
+        self.assertRaises(RuntimeError, future.result)
+
+
+class TestSimpleFuture(unittest.TestCase):
+
+    def test_callback(self):
+        future = asynchronous.SimpleFuture()
+        done = []
+        future.add_done_callback(done.append)
+        future.set_result(42)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+        self.assertEqual(future.result(), 42)
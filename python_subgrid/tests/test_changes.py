@@ -0,0 +1,115 @@
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid.changes import ChangeTracker
+from python_subgrid.changes import DeltaEncoder
+from python_subgrid.changes import Frame
+from python_subgrid.changes import runs_of
+
+
+class TestChanges(unittest.TestCase):
+
+    def test_runs(self):
+        runs = runs_of(np.array([1, 2, 3, 7, 9, 10]))
+        np.testing.assert_array_equal(runs, [[1, 3], [7, 1], [9, 2]])
+        frame = Frame(0, False, (12, ), runs, np.zeros(6, dtype='f4'), None)
+        np.testing.assert_array_equal(frame.indices(), [1, 2, 3, 7, 9, 10])
+        self.assertEqual(runs_of(np.array([], dtype='i8')).shape, (0, 2))
+
+    def test_delta(self):
+        encoder = DeltaEncoder(tolerance=0.01, keyframe_every=10)
+        array = np.zeros(10)
+        self.assertTrue(encoder.encode(array).keyframe)
+        array[[2, 3, 8]] = [1.0, 2.0, 0.005]
+        frame = encoder.encode(array)
+        self.assertFalse(frame.keyframe)
+        self.assertEqual(frame.step, 1)
+        # 0.005 is within the tolerance.
+        np.testing.assert_array_equal(frame.runs, [[2, 2]])
+        np.testing.assert_array_equal(frame.values, [1.0, 2.0])
+
+    def test_small_changes_add_up(self):
+        encoder = DeltaEncoder(tolerance=0.01)
+        array = np.zeros(3)
+        encoder.encode(array)
+        array += 0.006
+        self.assertEqual(len(encoder.encode(array).values), 0)
+        # Compared with what was sent, not with the previous step.
+        array += 0.006
+        self.assertEqual(len(encoder.encode(array).values), 3)
+
+    def test_keyframes(self):
+        encoder = DeltaEncoder(keyframe_every=3)
+        frames = [encoder.encode(np.zeros(4)) for i in range(7)]
+        self.assertEqual([frame.keyframe for frame in frames],
+                         [True, False, False, True, False, False, True])
+        self.assertTrue(encoder.encode(np.zeros(4), keyframe=True).keyframe)
+        self.assertTrue(encoder.encode(np.zeros(5)).keyframe)
+
+    def test_nan(self):
+        encoder = DeltaEncoder()
+        array = np.array([np.nan, 1.0])
+        encoder.encode(array)
+        self.assertEqual(len(encoder.encode(array).values), 0)
+        array[0] = 2.0
+        np.testing.assert_array_equal(encoder.encode(array).runs, [[0, 1]])
+
+    def test_quantized_nan(self):
+        encoder = DeltaEncoder(tolerance=0.0005, quantum=0.001)
+        array = np.array([np.nan, 1.0])
+        client = Frame.decode(encoder.encode(array).encode()).apply()
+        np.testing.assert_array_equal(client, [np.nan, 1.0])
+        self.assertEqual(len(encoder.encode(array).values), 0)
+        array[:] = [2.0, np.nan]
+        frame = Frame.decode(encoder.encode(array).encode())
+        np.testing.assert_array_equal(frame.apply(client), [2.0, np.nan])
+
+    def test_roundtrip(self):
+        encoder = DeltaEncoder(tolerance=0.0005, quantum=0.001)
+        array = np.asfortranarray(np.arange(12.0).reshape(3, 4))
+        client = None
+        for i in range(5):
+            array[i % 3, i % 4] += 0.25
+            frame = Frame.decode(encoder.encode(array).encode())
+            self.assertEqual(frame.quantum, 0.001)
+            client = frame.apply(client)
+            np.testing.assert_allclose(client, array, atol=0.0005)
+
+    def test_float32(self):
+        encoder = DeltaEncoder()
+        data = encoder.encode(np.array([1.5, 2.5])).encode()
+        frame = Frame.decode(data)
+        self.assertEqual(frame.values.dtype, np.dtype('<f4'))
+        self.assertEqual(frame.quantum, None)
+        self.assertEqual(len(data), frame.nbytes)
+        np.testing.assert_array_equal(frame.apply(), [1.5, 2.5])
+
+    def test_delta_without_keyframe(self):
+        encoder = DeltaEncoder()
+        encoder.encode(np.zeros(2))
+        frame = encoder.encode(np.ones(2))
+        self.assertRaises(ValueError, frame.apply)
+
+
+class TestChangeTracker(unittest.TestCase):
+
+    def test_extract(self):
+        subgrid = mock.Mock()
+        arrays = {'s1': np.zeros(5), 'u1': None}
+        subgrid._array = arrays.get
+        tracker = ChangeTracker(subgrid, {'s1': 0.001, 'u1': 0.01})
+        self.assertEqual([name for (name, frame) in tracker.extract()],
+                         ['s1'])
+        arrays['s1'][4] = 1.0
+        [(name, frame)] = tracker.extract(step=10)
+        self.assertEqual(frame.step, 10)
+        np.testing.assert_array_equal(frame.runs, [[4, 1]])
+        self.assertEqual(tracker.stats['keyframes'], 1)
+        self.assertEqual(tracker.stats['deltas'], 1)
+        self.assertEqual(tracker.stats['full_bytes'], 80)
+        # Reading doesn't apply deferred edits, unless asked to.
+        self.assertFalse(subgrid.flush_events.called)
+        tracker.extract(flush_events=True)
+        subgrid.flush_events.assert_called_with()
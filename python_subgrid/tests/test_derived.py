@@ -0,0 +1,138 @@
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid import wrapper
+from python_subgrid.derived import Buffers
+from python_subgrid.derived import Groups
+from python_subgrid.derived import Storage
+from python_subgrid.tests.helpers import contours
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_buffers(self):
+        buffers = Buffers()
+        out = buffers.get('out', 3)
+        self.assertTrue(buffers.get('out', 3) is out)
+        self.assertFalse(buffers.get('out', 4) is out)
+        self.assertEqual(buffers.get('out', 4, dtype='bool').dtype, bool)
+
+    def test_groups(self):
+        groups = Groups(np.array([2, -1, 0, 2, 2]))
+        np.testing.assert_array_equal(groups.order, [2, 0, 3, 4])
+        np.testing.assert_array_equal(groups.starts, [0, 1])
+        np.testing.assert_array_equal(groups.cells, [0, 2])
+        np.testing.assert_array_equal(groups.counts, [1, 3])
+
+    def test_storage(self):
+        # Cell 1 has pixels at 0, 1 and 2 (and one without bathymetry),
+        # cell 3 one at -1.
+        groups = Groups(np.array([1, 1, 3, 1, 1]))
+        dps = np.array([2.0, 0.0, 1.0, np.nan, -1.0])
+        storage = Storage(groups, dps, 4.0)
+        np.testing.assert_array_equal(storage.cells, [1, 3])
+        np.testing.assert_array_equal(storage.counts, [3, 1])
+        s1 = np.array([0.0, 1.5, 0.0, -2.0])
+        np.testing.assert_allclose(storage.volume(s1), [(1.5 + 0.5) * 4, 0])
+        np.testing.assert_allclose(storage.level([8.0, 0.0]), [1.5, -1.0])
+        # Above the highest pixel all pixels fill.
+        np.testing.assert_allclose(storage.level([24.0, 8.0]), [3.0, 1.0])
+
+
+class TestDerivedVariables(unittest.TestCase):
+
+    def setUp(self):
+        # Four 10m cells in a 2 by 2 grid on 5m pixels and the four links
+        # between them.
+        contour_x, contour_y = contours([(0, 0, 10), (10, 0, 10), (0, 10, 10),
+                                         (10, 10, 10)])
+        dps = -np.ones((4, 4), order='F')
+        dps[0, 0] = -2.0
+        dps[3, 3] = -9999.0
+        self.arrays = {
+            'FlowElemContour_x': contour_x,
+            'FlowElemContour_y': contour_y,
+            'FlowLink_xu': np.array([10.0, 5.0, 15.0, 10.0]),
+            'FlowLink_yu': np.array([5.0, 10.0, 10.0, 15.0]),
+            'x0p': np.array(0.0),
+            'y0p': np.array(0.0),
+            'dxp': np.array(5.0),
+            'dps': dps,
+            'nFlowElem2d': np.array(4),
+            's1': np.array([0.5, -2.0, 1.0, 0.0]),
+            'u1': np.array([1.0, 2.0, 3.0, 4.0]),
+        }
+        self.wrapper = wrapper.SubgridWrapper()
+        self.wrapper.library = mock.Mock()
+        self.wrapper._array = self.arrays.get
+
+    def test_quantities(self):
+        get = self.wrapper.get_derived
+        np.testing.assert_array_equal(get('bottom'), [-2.0, -1.0, -1.0, -1.0])
+        np.testing.assert_array_equal(get('depth'), [2.5, 0.0, 2.0, 1.0])
+        np.testing.assert_array_equal(get('wet'), [True, False, True, True])
+        # Cell 0: one pixel 2.5 deep, three 1.5 deep. Cell 3 has a pixel
+        # without bathymetry.
+        np.testing.assert_array_equal(get('volume'),
+                                      [(2.5 + 3 * 1.5) * 25, 0.0, 4 * 2 * 25,
+                                       3 * 1 * 25])
+        np.testing.assert_array_equal(get('area'), [100, 100, 100, 75])
+        np.testing.assert_allclose(get('velocity'),
+                                   [np.hypot(1, 2), np.hypot(1, 3),
+                                    np.hypot(4, 2), np.hypot(4, 3)])
+
+    def test_cached(self):
+        self.wrapper.get_derived('depth')
+        computed = self.wrapper.derived.stats['computed']
+        self.wrapper.get_derived('wet')
+        self.assertEqual(self.wrapper.derived.stats['computed'], computed + 1)
+        self.wrapper.get_derived('depth')
+        self.assertEqual(self.wrapper.derived.stats['computed'], computed + 1)
+
+    def test_update(self):
+        depth = self.wrapper.get_derived('depth', view=True)
+        computed = self.wrapper.derived.stats['computed']
+        self.arrays['s1'] += 1.0
+        self.wrapper.generation += 1
+        np.testing.assert_array_equal(self.wrapper.get_derived('depth'),
+                                      [3.5, 0.0, 3.0, 2.0])
+        # Only the depth, the bottom levels are kept.
+        self.assertEqual(self.wrapper.derived.stats['computed'], computed + 1)
+        # Computed in the same buffer.
+        self.assertTrue(
+            self.wrapper.get_derived('depth', view=True).base is depth.base)
+
+    def test_changebathy(self):
+        self.wrapper.get_derived('depth')
+        self.arrays['dps'][:] = -3.0
+        self.wrapper._log_edit('changebathy', (5.0, 5.0, 20.0, -3.0, 1))
+        np.testing.assert_array_equal(self.wrapper.get_derived('bottom'),
+                                      [-3.0] * 4)
+
+    def test_resize_keeps_static(self):
+        self.wrapper._annotate_functions()
+        self.wrapper.get_derived('bottom')
+        computed = self.wrapper.derived.stats['computed']
+        self.wrapper.discard_structure('pump01')
+        self.wrapper.get_derived('bottom')
+        self.assertEqual(self.wrapper.derived.stats['computed'], computed)
+
+    def test_out(self):
+        out = np.empty(4)
+        self.assertTrue(self.wrapper.get_derived('depth', out=out) is out)
+        self.assertRaises(ValueError, self.wrapper.get_derived, 'depth',
+                          out=np.empty(5))
+
+    def test_copy(self):
+        depth = self.wrapper.get_derived('depth')
+        depth[0] = 100.0
+        self.assertEqual(self.wrapper.get_derived('depth')[0], 2.5)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self.wrapper.get_derived, 'colour')
+
+    def test_no_data(self):
+        del self.arrays['u1']
+        self.assertRaises(ValueError, self.wrapper.get_derived, 'velocity')
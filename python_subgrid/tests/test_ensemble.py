@@ -0,0 +1,72 @@
+import glob
+import os
+import signal
+
+import mock
+
+from python_subgrid import utils
+from python_subgrid.ensemble import Ensemble
+from python_subgrid.ensemble import Job
+from python_subgrid.tests.helpers import StubTestCase
+from python_subgrid.wrapper import SubgridWrapper
+
+
+def crash(subgrid):
+    """Kill the worker like a segfault in the library does."""
+    os.kill(os.getpid(), signal.SIGSEGV)
+
+
+class TestEnsemble(StubTestCase):
+
+    def segments(self):
+        return set(glob.glob(os.path.join(utils.SHARED_MEMORY_DIR,
+                                          'subgrid*')))
+
+    def test_run(self):
+        jobs = [Job(self.mdu, steps=steps, variables=['t1', 's1'])
+                for steps in [1, 2, 3]]
+        with Ensemble(processes=2) as ensemble:
+            results = ensemble.run(jobs)
+        self.assertEqual([result['t1'] for result in results],
+                         [1.0, 2.0, 3.0])
+        self.assertTrue((results[2]['s1'] > results[0]['s1']).all())
+
+    def test_reuse(self):
+        jobs = [Job(self.mdu, steps=2, variables=['t1']) for i in range(3)]
+        with Ensemble(processes=1) as ensemble:
+            pid = ensemble.workers[0].process.pid
+            results = ensemble.run(jobs)
+            self.assertEqual(ensemble.workers[0].process.pid, pid)
+        # The model is initialized again for every job.
+        self.assertEqual([result['t1'] for result in results],
+                         [2.0, 2.0, 2.0])
+
+    def test_crash(self):
+        jobs = [Job(self.mdu, steps=1, variables=['t1']),
+                Job(self.mdu, actions=[('crash', ())]),
+                Job(self.mdu, steps=2, variables=['t1'])]
+        # The workers are forked, so they have the patched wrapper.
+        with mock.patch.object(SubgridWrapper, 'crash', crash, create=True):
+            with Ensemble(processes=1) as ensemble:
+                pid = ensemble.workers[0].process.pid
+                results = ensemble.run(jobs)
+                self.assertNotEqual(ensemble.workers[0].process.pid, pid)
+        self.assertEqual(results[0]['t1'], 1.0)
+        self.assertTrue(isinstance(results[1], utils.JobError))
+        self.assertEqual(results[2]['t1'], 2.0)
+
+    def test_failed_variable(self):
+        before = self.segments()
+        jobs = [Job(self.mdu, steps=1, variables=['s1', 'dps', 'unknown'])]
+        with Ensemble(processes=1) as ensemble:
+            results = ensemble.run(jobs)
+        self.assertTrue(isinstance(results[0], utils.JobError))
+        self.assertEqual(self.segments(), before)
+
+    def test_no_data(self):
+        # The stub has no data for nodtype.
+        jobs = [Job(self.mdu, variables=['s1', 'nodtype'])]
+        with Ensemble(processes=1) as ensemble:
+            results = ensemble.run(jobs)
+        self.assertTrue(isinstance(results[0], utils.JobError))
+        self.assertTrue("'nodtype' has no data" in str(results[0]))
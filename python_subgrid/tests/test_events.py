@@ -0,0 +1,59 @@
+import unittest
+
+from python_subgrid.events import EventBuffer
+
+
+class TestEventBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.events = EventBuffer()
+
+    def test_discharge_keeps_last_value(self):
+        self.events.add('discharge', (1.0, 2.0, 'mh', 1, 10.0))
+        self.events.add('discharge', (5.0, 5.0, 'other', 1, 1.0))
+        self.events.add('discharge', (1.0, 2.0, 'mh', 1, 20.0))
+        self.assertEqual(self.events.pop(),
+                         [('discharge', [1.0, 2.0, 'mh', 1, 20.0]),
+                          ('discharge', [5.0, 5.0, 'other', 1, 1.0])])
+        self.assertEqual(self.events.saved['discharge'], 1)
+
+    def test_discharge_types_kept_apart(self):
+        self.events.add('discharge', (1.0, 2.0, 'mh', 1, 10.0))
+        self.events.add('discharge', (1.0, 2.0, 'mh', 2, 20.0))
+        self.assertEqual(self.events.pop(),
+                         [('discharge', [1.0, 2.0, 'mh', 1, 10.0]),
+                          ('discharge', [1.0, 2.0, 'mh', 2, 20.0])])
+        self.assertEqual(self.events.saved['discharge'], 0)
+
+    def test_absolute_changebathy_replaces_square(self):
+        self.events.add('changebathy', (1.0, 1.0, 10.0, 0.5, 0))
+        self.events.add('changebathy', (9.0, 9.0, 10.0, 3.0, 1))
+        self.events.add('changebathy', (1.0, 1.0, 10.0, 2.0, 1))
+        self.assertEqual(len(self.events), 2)
+        self.assertEqual(self.events.pop(),
+                         [('changebathy', [9.0, 9.0, 10.0, 3.0, 1]),
+                          ('changebathy', [1.0, 1.0, 10.0, 2.0, 1])])
+        self.assertEqual(self.events.saved['changebathy'], 1)
+
+    def test_relative_changebathy_is_kept(self):
+        self.events.add('changebathy', (1.0, 1.0, 10.0, 0.5, 0))
+        self.events.add('changebathy', (1.0, 1.0, 10.0, 0.5, 0))
+        self.assertEqual(len(self.events.pop()), 2)
+
+    def test_rain_is_added_up(self):
+        self.events.add('dropinstantrain', (1.0, 1.0, 5.0, 2.0))
+        self.events.add('dropinstantrain', (1.0, 1.0, 5.0, 3.0))
+        self.assertEqual(self.events.pop(),
+                         [('dropinstantrain', [1.0, 1.0, 5.0, 5.0])])
+
+    def test_rain_not_merged_across_changebathy(self):
+        self.events.add('dropinstantrain', (1.0, 1.0, 5.0, 2.0))
+        self.events.add('changebathy', (1.0, 1.0, 10.0, 0.5, 1))
+        self.events.add('dropinstantrain', (1.0, 1.0, 5.0, 3.0))
+        self.assertEqual(len(self.events.pop()), 3)
+
+    def test_stats(self):
+        self.events.add('discharge', (1.0, 2.0, 'mh', 1, 10.0))
+        self.events.add('discharge', (1.0, 2.0, 'mh', 1, 20.0))
+        self.assertEqual(self.events.stats()['total'],
+                         {'received': 2, 'saved': 1})
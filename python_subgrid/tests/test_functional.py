@@ -5,11 +5,27 @@ import unittest
 import os
 import logging
 import io
+import shutil
+import tempfile
 from nose.plugins.attrib import attr
 import numpy as np
 
 from python_subgrid.wrapper import SubgridWrapper, logger
+from python_subgrid.changes import ChangeTracker
+from python_subgrid.changes import Frame
+from python_subgrid.ensemble import Ensemble
+from python_subgrid.ensemble import Job
+from python_subgrid.radar import RadarGrid
+from python_subgrid.radar import RainfallIngestor
+from python_subgrid.pipeline import Pipeline
+from python_subgrid.recorder import OutputRecorder
+from python_subgrid.recorder import load
+from python_subgrid.remote import RemoteSubgridWrapper
+from python_subgrid.render import DepthRenderer
+from python_subgrid.template import TemplatePool
+from python_subgrid.utils import JobError
 from python_subgrid.utils import NotDocumentedError
+from python_subgrid.utils import StaleViewError
 
 # We don't want to know about ctypes here
 # only in the test_wrapper and the wrapper itself.
@@ -142,6 +158,103 @@ class LibSubgridTest(unittest.TestCase):
                 print subgrid.update(-1)
                 # -1 = use default model timestep.
 
+    def test_run_steps(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            captured = []
+
+            def callback(step, t, buffers):
+                captured.append((step, t, buffers['s1'].copy()))
+
+            steps = subgrid.run_steps(10, every=5, variables=['s1'],
+                                      callback=callback)
+            self.assertEqual(steps, 10)
+            self.assertEqual([step for (step, t, s1) in captured], [5, 10])
+            self.assertTrue((captured[-1][2] == subgrid.get_nd('s1')).all())
+
+    def test_run_until(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            t_end = subgrid.get_nd('t1') + 60.0
+            steps = subgrid.run_until(t_end)
+            self.assertGreater(steps, 0)
+            self.assertGreaterEqual(subgrid.get_nd('t1'), t_end)
+
+    def test_pipeline(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            captured = []
+
+            def hook(step, t, buffers):
+                captured.append((step, buffers['s1'].copy()))
+
+            pipeline = Pipeline(subgrid, ['s1'], hooks=[hook], every=5)
+            self.assertEqual(pipeline.run_steps(10), 10)
+            self.assertEqual([step for (step, s1) in captured], [5, 10])
+            np.testing.assert_array_equal(captured[-1][1],
+                                          subgrid.get_nd('s1'))
+
+    def test_recorder(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+                subgrid.initmodel()
+                with OutputRecorder(subgrid, directory, ['s1', 'pumps'],
+                                    every=2, store='raw') as recorder:
+                    recorder.run_steps(10)
+                s1 = subgrid.get_nd('s1')
+            output = load(directory)
+            np.testing.assert_array_equal(output['step'], [2, 4, 6, 8, 10])
+            np.testing.assert_array_equal(output['s1'][-1], s1)
+            self.assertEqual(len(output['pumps']), 5)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ensemble(self):
+        jobs = [Job(self.default_mdu, steps=steps, variables=['s1'])
+                for steps in [0, 5]]
+        jobs.append(Job(self.default_mdu, variables=['unknown']))
+        with Ensemble(processes=2) as ensemble:
+            results = ensemble.run(jobs)
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.run_steps(5)
+            s1 = subgrid.get_nd('s1')
+        np.testing.assert_array_equal(results[1]['s1'], s1)
+        self.assertEqual(results[0]['s1'].shape, s1.shape)
+        self.assertIsInstance(results[2], JobError)
+
+    def test_remote(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            s1 = subgrid.get_nd('s1')
+        with RemoteSubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            np.testing.assert_array_equal(subgrid.get_nd('s1'), s1)
+            view = subgrid.get_nd('s1', view=True)
+            np.testing.assert_array_equal(view, s1)
+            out = np.empty_like(s1)
+            subgrid.get_nd('s1', out=out)
+            np.testing.assert_array_equal(out, s1)
+            with self.assertRaises(NotDocumentedError):
+                subgrid.get_nd('unknown')
+
+    def test_template_pool(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            s1 = subgrid.get_nd('s1')
+        with TemplatePool(self.default_mdu) as pool:
+            first = pool.get()
+            second = pool.get()
+            first.update(-1)
+            first.update(-1)
+            second.update(-1)
+            # The forks don't share their state.
+            np.testing.assert_array_equal(second.get_nd('s1'), s1)
+            first.stop()
+            second.stop()
+
     #@unittest.skip
     def test_dropinstantrain(self):
         with SubgridWrapper(mdu=self.default_mdu) as subgrid:
@@ -261,6 +374,31 @@ class LibSubgridTest(unittest.TestCase):
             self.assertEqual(len(arr.shape), 1)
             logging.debug(arr)
 
+    def test_get_nd_twice(self):
+        # The second call uses the cached variable information.
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            arr1 = subgrid.get_nd('s1')
+            arr2 = subgrid.get_nd('s1')
+            self.assertTrue((arr1 == arr2).all())
+
+    def test_get_nd_view(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            view = subgrid.get_nd('s1', view=True)
+            self.assertTrue((view == subgrid.get_nd('s1')).all())
+            subgrid.update(-1)
+            self.assertRaises(StaleViewError, lambda: view[0])
+
+    def test_get_nd_out(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            s1 = subgrid.get_nd('s1')
+            out = np.zeros_like(s1)
+            result = subgrid.get_nd('s1', out=out)
+            self.assertTrue(result is out)
+            self.assertTrue((out == s1).all())
+
     def test_get_nd_unknown_variable(self):
         with SubgridWrapper(mdu=self.default_mdu) as subgrid:
             subgrid.initmodel()
@@ -295,6 +433,15 @@ class LibSubgridTest(unittest.TestCase):
             self.assertEqual(len(df), 1)
             logger.info(df.to_string())
 
+    def test_compound_view(self):
+        with SubgridWrapper(mdu=self._mdu_path('1dpumps')) as subgrid:
+            subgrid.initmodel()
+            df = subgrid.get_nd('pumps')
+            pumps = subgrid.get_nd('pumps', view=True)
+            self.assertEqual(len(pumps), 1)
+            self.assertEqual(pumps['id'][0], df['id'][0])
+            self.assertEqual(pumps['capacity'][0], df['capacity'][0])
+
     def test_remove_pump(self):
         with SubgridWrapper(mdu=self._mdu_path('1dpumps')) as subgrid:
             subgrid.initmodel()
@@ -314,9 +461,9 @@ class LibSubgridTest(unittest.TestCase):
             self.assertEqual(len(df), 1)
             # Increase capacity of all pumps by a factor 10
             df['capacity'] = df['capacity'] * 10
-            s1before = subgrid.get_nd('s1').copy()
+            s1before = subgrid.get_nd('s1')
             subgrid.update(-1)
-            s1after = subgrid.get_nd('s1').copy()
+            s1after = subgrid.get_nd('s1')
             # There should be water movement now, check S1
             self.assertGreater(np.abs(s1after - s1before).sum(), 0)
 
@@ -338,6 +485,29 @@ class LibSubgridTest(unittest.TestCase):
             self.assertEqual(capacity1, capacity0 * 10)
 
 
+    def test_set_structure_fields(self):
+        with SubgridWrapper(mdu=self._mdu_path('1dpumps')) as subgrid:
+            subgrid.initmodel()
+            df = subgrid.get_nd('pumps')
+            capacity0 = df.capacity[0]
+            pumpid = df.id[0]
+            subgrid.set_structure_fields("pumps", [pumpid],
+                                         {"capacity": [capacity0 * 10]})
+            df = subgrid.get_nd('pumps')
+            self.assertEqual(df.capacity[0], capacity0 * 10)
+
+    def test_set_structure_fields_setter(self):
+        with SubgridWrapper(mdu=self._mdu_path('1dpumps')) as subgrid:
+            subgrid.initmodel()
+            df = subgrid.get_nd('pumps')
+            capacity0 = df.capacity[0]
+            pumpid = df.id[0]
+            subgrid.set_structure_fields("pumps", [pumpid],
+                                         {"capacity": capacity0 * 10},
+                                         direct=False)
+            df = subgrid.get_nd('pumps')
+            self.assertEqual(df.capacity[0], capacity0 * 10)
+
     # def test_get_water_level(self):
     #     print
     #     print '########### test get water level'
@@ -428,6 +598,151 @@ class LibSubgridTest(unittest.TestCase):
                 print 'doing %d...' % i
                 print subgrid.update(-1)  # -1 = use default model time
 
+    def test_get_water_levels(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            xs = subgrid.get_nd('FlowElem_xcc')[:100]
+            ys = subgrid.get_nd('FlowElem_ycc')[:100]
+            levels = subgrid.get_water_levels(xs, ys)
+            np.testing.assert_array_equal(levels, subgrid.get_nd('s1')[:100])
+            # Points outside the grid go through getwaterlevel.
+            self.assertEqual(subgrid.get_water_levels([-1e9], [-1e9]).shape,
+                             (1, ))
+
+    def test_radar(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            cells = subgrid.grid_index().cells
+            extent = (cells.xmin.min(), cells.xmax.max(),
+                      cells.ymin.min(), cells.ymax.max())
+            grid = RadarGrid.from_extent(extent, (10, 10))
+            s1 = subgrid.get_nd('s1')
+            rainfall = RainfallIngestor(subgrid, grid, cache_dir=None,
+                                        read_frame=np.ones)
+            rainfall.apply(np.ones((10, 10)))
+            # 1 mm everywhere.
+            np.testing.assert_allclose(subgrid.get_nd('s1')[:len(cells)],
+                                       s1[:len(cells)] + 1e-3)
+            self.assertEqual(rainfall.run([(10, 10)] * 2, 1), 2)
+
+    def test_snapshot(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            snapshot = subgrid.snapshot()
+            s1 = subgrid.get_nd('s1')
+            t1 = subgrid.get_nd('t1')
+            for i in range(5):
+                subgrid.update(-1)
+            subgrid.restore(snapshot)
+            np.testing.assert_array_equal(subgrid.get_nd('s1'), s1)
+            self.assertEqual(subgrid.get_nd('t1'), t1)
+
+    def test_instrument(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            with subgrid.measure(trace=True) as instruments:
+                subgrid.update(-1)
+                subgrid.get_nd('s1')
+            stats = instruments.stats()
+            self.assertEqual(stats['native']['update']['calls'], 1)
+            self.assertEqual(stats['python']['get_nd']['calls'], 1)
+            self.assertTrue(stats['bytes']['s1']['copied'] > 0)
+            self.assertTrue(instruments.chrome_trace()['traceEvents'])
+
+    def test_buffer_log(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.buffer_log(level=logging.DEBUG)
+            subgrid.initmodel()
+            subgrid.run_steps(5)
+            stats = subgrid.buffer_log(False)
+            self.assertTrue('logged' in stats)
+            self.assertEqual(subgrid.log_buffer, None)
+
+    def test_changes(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            tracker = ChangeTracker(subgrid, {'s1': 0.001})
+            s1 = None
+            for i in range(5):
+                subgrid.update(-1)
+                [(name, frame)] = tracker.extract()
+                s1 = Frame.decode(frame.encode()).apply(s1)
+            np.testing.assert_allclose(s1, subgrid.get_nd('s1'), atol=0.001)
+
+    def test_render(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            renderer = DepthRenderer(subgrid)
+            cells = subgrid.grid_index().cells
+            extent = (cells.xmin.min(), cells.ymin.min(),
+                      cells.xmax.max(), cells.ymax.max())
+            depth = renderer.render(*extent, width=100, height=50)
+            self.assertEqual(depth.shape, (50, 100))
+            self.assertTrue((depth[~np.isnan(depth)] > 0).all())
+            xc = (extent[0] + extent[2]) / 2
+            yc = (extent[1] + extent[3]) / 2
+            subgrid.changebathy(xc, yc, 50.0, -3.0, 1)
+            renderer.render(*extent, width=100, height=50)
+            self.assertEqual(renderer.stats['updates'], 1)
+
+    def test_derived(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            depth = subgrid.get_derived('depth')
+            n2d = int(subgrid.get_nd('nFlowElem2d'))
+            self.assertEqual(depth.shape, (n2d, ))
+            wet = subgrid.get_derived('wet')
+            np.testing.assert_array_equal(wet, depth > 0)
+            self.assertTrue((subgrid.get_derived('volume')[~wet] == 0).all())
+            subgrid.get_derived('velocity')
+
+    def test_variables(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            subgrid.update(-1)
+            variables = subgrid.variables
+            self.assertTrue('s1' in variables)
+            self.assertTrue(variables.nbytes > 0)
+            np.testing.assert_array_equal(variables['s1'].read(),
+                                          subgrid.get_nd('s1'))
+            self.assertEqual(variables['pumps'].view().dtype,
+                             subgrid.get_nd('pumps', view=True).dtype)
+
+    def test_private_library(self):
+        with SubgridWrapper(mdu=self.default_mdu,
+                            private_library=True) as first:
+            with SubgridWrapper(mdu=self.default_mdu,
+                                private_library=True) as second:
+                first.initmodel()
+                second.initmodel()
+                first.update(-1)
+                first.update(-1)
+                second.update(-1)
+                self.assertTrue(first.get_nd('t1') > second.get_nd('t1'))
+
+    def test_defer_events(self):
+        with SubgridWrapper(mdu=self.default_mdu) as subgrid:
+            subgrid.initmodel()
+            xc = 125209.332
+            yc = 483799.384
+            subgrid.changebathy(xc, yc, 50.0, -3.0, 1)
+            subgrid.update(-1)
+            dps = subgrid.get_nd('dps')
+            subgrid.initmodel()
+            subgrid.defer_events()
+            for bval in [-1.0, -2.0, -3.0]:
+                subgrid.changebathy(xc, yc, 50.0, bval, 1)
+            self.assertEqual(len(subgrid.events), 1)
+            subgrid.update(-1)
+            self.assertEqual(len(subgrid.events), 0)
+            stats = subgrid.defer_events(False)
+            self.assertEqual(stats['changebathy']['saved'], 2)
+            np.testing.assert_array_equal(subgrid.get_nd('dps'), dps)
+
     def test_changebathy_heerenveen(self):
         print
         print '########### test change bathy heerenveen'
@@ -452,11 +767,10 @@ class LibSubgridTest(unittest.TestCase):
 
     def test_link_table(self):
         with SubgridWrapper(mdu=self._mdu_path('1d-democase')) as subgrid:
-            # Note the copy, variables get reused, so copy them if you're calling
-            # get_nd, multiple times
-            data = dict(branch=subgrid.get_nd('link_branchid').copy(),
-                        chainage=subgrid.get_nd('link_chainage').copy(),
-                        idx=subgrid.get_nd('link_idx').copy())
+            # get_nd returns copies, so no need to copy them ourselves.
+            data = dict(branch=subgrid.get_nd('link_branchid'),
+                        chainage=subgrid.get_nd('link_chainage'),
+                        idx=subgrid.get_nd('link_idx'))
             df = pandas.DataFrame(data)
             self.assertEqual(df.idx.item(0), 249)
             self.assertEqual(df.idx.item(-1), 248)
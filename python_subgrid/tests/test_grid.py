@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as np
+
+from python_subgrid.grid import CellIndex
+from python_subgrid.grid import GridIndex
+from python_subgrid.grid import PointHash
+from python_subgrid.tests.helpers import contours
+
+
+class TestCellIndex(unittest.TestCase):
+
+    def setUp(self):
+        # Four small cells next to a big one.
+        self.index = CellIndex(*contours([(0, 0, 10), (10, 0, 10),
+                                          (0, 10, 10), (10, 10, 10),
+                                          (20, 0, 20)]))
+
+    def test_lookup(self):
+        cells = self.index.lookup([5, 15, 5, 15, 25, 39.9],
+                                  [5, 5, 15, 15, 10, 19.9])
+        np.testing.assert_array_equal(cells, [0, 1, 2, 3, 4, 4])
+
+    def test_edges(self):
+        # Cells include their lower and left edges, not the others.
+        cells = self.index.lookup([10, 20, 40], [0, 0, 0])
+        np.testing.assert_array_equal(cells, [1, 4, -1])
+
+    def test_outside(self):
+        cells = self.index.lookup([-1, 5, 25], [5, 25, -0.1])
+        np.testing.assert_array_equal(cells, [-1, -1, -1])
+
+    def test_shape(self):
+        cells = self.index.lookup([[5, 15]], [[5, 5]])
+        self.assertEqual(cells.shape, (1, 2))
+
+    def test_empty_grid(self):
+        index = CellIndex(np.empty((4, 0)), np.empty((4, 0)))
+        np.testing.assert_array_equal(index.lookup([1.0], [1.0]), [-1])
+
+
+class TestPointHash(unittest.TestCase):
+
+    def test_nearest(self):
+        random = np.random.RandomState(0)
+        xs, ys = random.uniform(0, 100, (2, 500))
+        points = PointHash(xs, ys)
+        # Including queries far outside the points.
+        qx, qy = random.uniform(-50, 150, (2, 200))
+        expected = [np.argmin(np.hypot(xs - x, ys - y))
+                    for (x, y) in zip(qx, qy)]
+        np.testing.assert_array_equal(points.nearest(qx, qy), expected)
+
+    def test_no_points(self):
+        points = PointHash(np.empty(0), np.empty(0))
+        np.testing.assert_array_equal(points.nearest([1.0], [1.0]), [-1])
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        contour_x, contour_y = contours([(0, 0, 10), (10, 0, 10),
+                                         (0, 10, 10), (10, 10, 10),
+                                         (20, 0, 20)])
+        # The links between the small cells and to the big one.
+        self.index = GridIndex(contour_x, contour_y,
+                               [10, 10, 5, 15, 20, 20],
+                               [5, 15, 10, 10, 5, 15])
+
+    def test_cells_at(self):
+        np.testing.assert_array_equal(self.index.cells_at([5, 25], [15, 5]),
+                                      [2, 4])
+
+    def test_cells_in_bbox(self):
+        np.testing.assert_array_equal(
+            self.index.cells_in_bbox(12, 2, 22, 8), [1, 4])
+        # Touching edges don't count as overlap.
+        np.testing.assert_array_equal(
+            self.index.cells_in_bbox(0, 0, 10, 10), [0])
+        self.assertEqual(len(self.index.cells_in_bbox(50, 50, 60, 60)), 0)
+
+    def test_cells_in_polygon(self):
+        # A triangle with the centers of cells 0, 1 and 2 inside.
+        cells = self.index.cells_in_polygon([(0, 0), (40, 0), (0, 20)])
+        np.testing.assert_array_equal(cells, [0, 1, 2])
+
+    def test_nearest_link(self):
+        links = self.index.nearest_link([9, 16, 30], [4, 11, 30])
+        np.testing.assert_array_equal(links, [0, 3, 5])
@@ -0,0 +1,100 @@
+import unittest
+
+import mock
+
+from python_subgrid import wrapper
+from python_subgrid.instruments import InstrumentedLibrary
+from python_subgrid.instruments import Instruments
+
+
+class TestInstruments(unittest.TestCase):
+
+    def setUp(self):
+        self.instruments = Instruments(trace=True)
+
+    def test_calls(self):
+        inner = self.instruments.timed('native', 'inner', lambda: 42)
+
+        def outer():
+            return inner() + inner()
+        outer = self.instruments.timed('python', 'outer', outer)
+        self.assertEqual(outer(), 84)
+        stats = self.instruments.stats()
+        self.assertEqual(stats['native']['inner']['calls'], 2)
+        self.assertEqual(sum(stats['native']['inner']['histogram'].values()),
+                         2)
+        outer = stats['python']['outer']
+        # The time in inner isn't outer's own time.
+        self.assertTrue(outer['self_seconds'] <= outer['seconds'])
+
+    def test_errors_are_timed(self):
+        def fail():
+            raise RuntimeError()
+        fail = self.instruments.timed('python', 'fail', fail)
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(self.instruments.stats()['python']['fail']['calls'],
+                         1)
+
+    def test_bytes(self):
+        self.instruments.count_bytes('s1', 80)
+        self.instruments.count_bytes('s1', 80, allocated=False)
+        self.assertEqual(self.instruments.stats()['bytes']['s1'],
+                         {'copied': 160, 'allocated': 80})
+
+    def test_chrome_trace(self):
+        self.instruments.timed('native', 'update', lambda: None)()
+        events = self.instruments.chrome_trace()['traceEvents']
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[0]['name'], 'update')
+
+    def test_no_trace(self):
+        self.assertRaises(ValueError, Instruments().chrome_trace)
+
+    def test_library(self):
+        library = mock.Mock()
+        instrumented = InstrumentedLibrary(library, self.instruments)
+        instrumented.update.argtypes = ['a']
+        self.assertEqual(library.update.argtypes, ['a'])
+        instrumented.update(1)
+        library.update.assert_called_with(1)
+        self.assertEqual(self.instruments.stats()['native']['update']['calls'],
+                         1)
+
+
+class TestWrapperInstruments(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = wrapper.SubgridWrapper()
+        self.library = self.wrapper.library = mock.Mock()
+        self.wrapper._annotate_functions()
+
+    def test_instrument(self):
+        self.wrapper.instrument()
+        self.wrapper.update(1.0)
+        stats = self.wrapper.stats()
+        self.assertEqual(stats['native']['update']['calls'], 1)
+        self.assertEqual(stats['python']['update']['calls'], 1)
+        stats = self.wrapper.instrument(False)
+        self.assertEqual(stats['native']['update']['calls'], 1)
+        # Nothing is wrapped anymore.
+        self.assertTrue(self.wrapper.library is self.library)
+        self.assertFalse('get_nd' in self.wrapper.__dict__)
+        self.wrapper.update(1.0)
+        self.assertEqual(self.wrapper.stats()['native'], {})
+
+    def test_measure(self):
+        self.wrapper.instrument()
+        self.wrapper.update(1.0)
+        with self.wrapper.measure() as instruments:
+            self.wrapper.update(1.0)
+            self.wrapper.update(1.0)
+        self.assertEqual(instruments.stats()['native']['update']['calls'], 2)
+        # The earlier instrumentation continues.
+        self.wrapper.update(1.0)
+        self.assertEqual(self.wrapper.stats()['native']['update']['calls'], 2)
+
+    def test_annotations_are_kept(self):
+        self.wrapper.instrument()
+        self.assertEqual(self.wrapper.update.argtypes,
+                         self.library.update.argtypes)
@@ -0,0 +1,69 @@
+import ctypes
+import logging
+import unittest
+
+import mock
+
+from python_subgrid import wrapper
+from python_subgrid.logbuffer import LogBuffer
+
+
+def level(value):
+    return ctypes.pointer(ctypes.c_int(value))
+
+
+class TestLogBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = mock.Mock()
+        self.buffer = LogBuffer(self.logger, 2, wrapper.LEVELS_F2PY, size=3)
+
+    def test_threshold(self):
+        self.buffer(level(1), 'debug')
+        self.buffer(level(2), 'info')
+        self.assertEqual(self.buffer.drain(), 1)
+        self.logger.log.assert_called_once_with(logging.INFO, 'info')
+
+    def test_summarized(self):
+        for i in range(5):
+            self.buffer(level(3), 'flood')
+            self.buffer(level(2), 'other')
+        self.assertEqual(self.buffer.drain(), 10)
+        self.assertEqual(self.logger.log.call_args_list, [
+            mock.call(logging.WARN, "%s (%s times)", 'flood', 5),
+            mock.call(logging.INFO, "%s (%s times)", 'other', 5)])
+        self.assertEqual(self.buffer.stats['summarized'], 8)
+
+    def test_full(self):
+        for i in range(5):
+            self.buffer(level(2), 'message {}'.format(i))
+        self.assertEqual(self.buffer.drain(), 3)
+        self.assertEqual(self.logger.log.call_args_list[0],
+                         mock.call(logging.INFO, 'message 2'))
+        self.logger.warning.assert_called_once_with(
+            "%s log messages dropped, the buffer was full", 2)
+
+    def test_thread(self):
+        self.buffer.start(interval=0.01)
+        self.buffer(level(2), 'info')
+        self.buffer.stop()
+        self.logger.log.assert_called_once_with(logging.INFO, 'info')
+        self.assertEqual(self.buffer.thread, None)
+
+
+class TestWrapperLogBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = wrapper.SubgridWrapper()
+        self.library = self.wrapper.library = mock.Mock()
+
+    def test_buffer_log(self):
+        self.wrapper.buffer_log(level=logging.WARN)
+        self.assertEqual(self.wrapper.log_buffer.threshold, 3)
+        callback = self.library.set_mh_c_callback.call_args[0][0]
+        self.assertTrue(callback._obj is self.wrapper._log_callback)
+        self.wrapper.log_buffer(level(3), 'warning')
+        self.assertEqual(self.wrapper.flush_log(), 1)
+        stats = self.wrapper.buffer_log(False)
+        self.assertEqual(stats['logged'], 1)
+        self.assertTrue(self.wrapper._log_callback is wrapper.fortran_log_func)
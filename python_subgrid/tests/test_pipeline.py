@@ -0,0 +1,113 @@
+import threading
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid.pipeline import Pipeline
+from python_subgrid.tests.helpers import StubTestCase
+from python_subgrid.wrapper import SubgridWrapper
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.subgrid = mock.Mock()
+        self.subgrid.events = None
+        self.subgrid.log_buffer = None
+        self.subgrid.generation = 0
+        self.arrays = {'s1': np.zeros(3), 't1': np.array(0.0)}
+        self.subgrid._array.side_effect = self.arrays.get
+        self.threads = set()
+
+        def update(dt_p):
+            self.threads.add(threading.current_thread())
+            self.arrays['s1'] += 1.0
+            self.arrays['t1'][()] += 10.0
+            return 0
+        self.subgrid.library.update.side_effect = update
+
+    def test_run_steps(self):
+        captured = []
+
+        def hook(step, t, buffers):
+            captured.append((step, t, buffers['s1'].copy()))
+
+        pipeline = Pipeline(self.subgrid, ['s1'], hooks=[hook], every=2)
+        self.assertEqual(pipeline.run_steps(5), 5)
+        self.assertEqual([step for (step, t, s1) in captured], [2, 4, 5])
+        self.assertEqual([t for (step, t, s1) in captured],
+                         [20.0, 40.0, 50.0])
+        np.testing.assert_array_equal(captured[-1][2], [5.0, 5.0, 5.0])
+        self.assertEqual(pipeline.stats['outputs'], 3)
+        self.assertNotIn(threading.current_thread(), self.threads)
+
+    def test_buffers_alternate(self):
+        seen = []
+        pipeline = Pipeline(self.subgrid, ['s1'])
+        pipeline.add_hook(lambda step, t, buffers: seen.append(buffers))
+        pipeline.run_steps(3)
+        self.assertIsNot(seen[0], seen[1])
+        self.assertIs(seen[0], seen[2])
+        # The previous step's buffers are kept until the next hooks ran.
+        np.testing.assert_array_equal(seen[1]['s1'], [2.0, 2.0, 2.0])
+
+    def test_run_until(self):
+        pipeline = Pipeline(self.subgrid, ['s1'], every=4)
+        self.assertEqual(pipeline.run_until(25.0), 3)
+        self.assertEqual(self.arrays['t1'], 30.0)
+
+    def test_update_failed(self):
+        self.subgrid.library.update.side_effect = [0, 1]
+        pipeline = Pipeline(self.subgrid, ['s1'])
+        self.assertRaises(RuntimeError, pipeline.run_steps, 5)
+
+    def test_hook_failed(self):
+        def hook(step, t, buffers):
+            raise ValueError()
+
+        pipeline = Pipeline(self.subgrid, ['s1'], hooks=[hook])
+        self.assertRaises(ValueError, pipeline.run_steps, 5)
+        # The step that ran during the hook was finished.
+        self.assertEqual(self.subgrid.library.update.call_count, 2)
+
+    def test_no_data(self):
+        # The mock library has no data for nodtype.
+        pipeline = Pipeline(self.subgrid, ['s1', 'nodtype'])
+        self.assertRaises(ValueError, pipeline.run_steps, 5)
+        self.assertFalse(self.subgrid.library.update.called)
+
+    def test_every_invalid(self):
+        pipeline = Pipeline(self.subgrid, ['s1'], every=0)
+        self.assertRaises(ValueError, pipeline.run_steps, 5)
+
+
+class TestPipelineStub(StubTestCase):
+
+    def setUp(self):
+        super(TestPipelineStub, self).setUp()
+        self.subgrid = SubgridWrapper(mdu=self.mdu)
+        self.subgrid.start()
+        self.addCleanup(self.subgrid.stop)
+        self.subgrid.initmodel()
+
+    def test_run_until(self):
+        captured = []
+
+        def hook(step, t, buffers):
+            captured.append((step, t, buffers['s1'].copy()))
+
+        pipeline = Pipeline(self.subgrid, ['s1'], hooks=[hook], every=2)
+        self.assertEqual(pipeline.run_until(5.0, dt=1.0), 5)
+        self.assertEqual(self.subgrid.get_nd('t1'), 5.0)
+        self.assertEqual([(step, t) for (step, t, s1) in captured],
+                         [(2, 2.0), (4, 4.0), (5, 5.0)])
+        self.assertTrue((captured[1][2] > captured[0][2]).all())
+        np.testing.assert_array_equal(captured[-1][2],
+                                      self.subgrid.get_nd('s1'))
+
+    def test_no_data(self):
+        # The stub has no data for nodtype.
+        pipeline = Pipeline(self.subgrid, ['nodtype'])
+        self.assertRaises(ValueError, pipeline.run_steps, 1)
+        self.assertEqual(self.subgrid.get_nd('t1'), 0.0)
@@ -0,0 +1,185 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid import radar
+from python_subgrid import wrapper
+from python_subgrid.tests.helpers import StubTestCase
+from python_subgrid.tests.helpers import contours
+
+# 2 x 2 pixels of 10m, top row first, covering (0, 20) x (0, 20).
+GRID = radar.RadarGrid.from_extent((0, 20, 0, 20), (2, 2))
+FRAME = np.array([[1.0, 2.0],
+                  [3.0, 4.0]])
+
+
+def bounds(cells):
+    contour_x, contour_y = contours(cells)
+    return (contour_x.min(axis=0), contour_x.max(axis=0),
+            contour_y.min(axis=0), contour_y.max(axis=0))
+
+
+class TestRegrid(unittest.TestCase):
+
+    def test_regrid(self):
+        # A small cell in the bottom left pixel, a cell on all four pixels
+        # and a cell that is half outside the radar.
+        weights = radar.radar_weights(
+            GRID, *bounds([(0, 0, 5), (5, 5, 10), (15, 15, 10)]))
+        rain = radar.regrid(weights, FRAME, 4)
+        np.testing.assert_allclose(rain, [3.0, 2.5, 0.5, 0.0])
+
+    def test_masked(self):
+        weights = radar.radar_weights(GRID, *bounds([(5, 5, 10)]))
+        frame = np.ma.masked_equal(FRAME, 4.0)
+        np.testing.assert_allclose(radar.regrid(weights, frame, 1), [1.5])
+
+    def test_outside(self):
+        weights = radar.radar_weights(GRID, *bounds([(100, 100, 10)]))
+        self.assertEqual(len(weights.cells), 0)
+
+
+class TestCachedWeights(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        cells = bounds([(0, 0, 5), (5, 5, 10)])
+        weights = radar.cached_weights(GRID, *cells,
+                                       cache_dir=self.directory)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        with mock.patch.object(radar, 'radar_weights') as radar_weights:
+            cached = radar.cached_weights(GRID, *cells,
+                                          cache_dir=self.directory)
+            self.assertFalse(radar_weights.called)
+        for expected, array in zip(weights, cached):
+            np.testing.assert_array_equal(array, expected)
+        # Another grid gets other weights.
+        radar.cached_weights(GRID._replace(dx=5.0), *cells,
+                             cache_dir=self.directory)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_order(self):
+        frames = radar.prefetch(range(10), lambda source: source * 2, size=2)
+        self.assertEqual(list(frames), range(0, 20, 2))
+
+    def test_error(self):
+        def read_frame(source):
+            if source == 2:
+                raise IOError("broken")
+            return source
+        frames = radar.prefetch(range(5), read_frame)
+        self.assertEqual(next(frames), 0)
+        self.assertEqual(next(frames), 1)
+        self.assertRaises(IOError, next, frames)
+
+
+class TestGridKeys(unittest.TestCase):
+
+    def test_key(self):
+        key = GRID.key()
+        self.assertEqual(len(key), 40)
+        self.assertNotEqual(GRID._replace(dx=5.0).key(), key)
+
+    def test_h5py_missing(self):
+        with mock.patch.object(radar, 'h5py', None):
+            self.assertRaises(ImportError, radar.RainfallIngestor,
+                              mock.Mock(), GRID)
+
+
+class TestRainfallIngestor(unittest.TestCase):
+
+    def setUp(self):
+        # Two 10m cells on 5m pixels: the first has one pixel that is 1m
+        # lower than the others and is dry, the second has a pixel without
+        # bathymetry. And a 1d node.
+        contour_x, contour_y = contours([(0, 0, 10), (10, 10, 10)])
+        dps = np.zeros((4, 4), order='F')
+        dps[0, 0] = -1.0
+        dps[3, 3] = -9999.0
+        self.arrays = {
+            'FlowElemContour_x': contour_x,
+            'FlowElemContour_y': contour_y,
+            'x0p': np.array(0.0),
+            'y0p': np.array(0.0),
+            'dxp': np.array(5.0),
+            'dps': dps,
+            'nFlowElem2d': np.array(2),
+            's1': np.array([-1.0, 0.5, 0.0]),
+        }
+        self.subgrid = wrapper.SubgridWrapper()
+        self.subgrid.library = mock.Mock()
+        self.subgrid._array = self.arrays.get
+        self.subgrid.run_steps = lambda n, dt: n
+        self.rainfall = radar.RainfallIngestor(
+            self.subgrid, GRID, cache_dir=None,
+            read_frame=lambda source: FRAME, balance=False)
+
+    def test_volume(self):
+        before = self.subgrid.get_derived('volume')
+        rain = self.rainfall.apply(FRAME)
+        np.testing.assert_allclose(rain, [3e-3, 2e-3])
+        # The rain on the whole cell (but not on the pixel without
+        # bathymetry) is added as volume.
+        np.testing.assert_allclose(self.subgrid.get_derived('volume') - before,
+                                   [3e-3 * 100, 2e-3 * 75])
+        # The rain on the dry cell gathers in its lowest pixel.
+        np.testing.assert_allclose(self.arrays['s1'],
+                                   [-1.0 + 3e-3 * 100 / 25, 0.5 + 2e-3, 0.0])
+
+    def test_fills_pixels(self):
+        # 50cm on the first cell fills its lowest pixel and floods the
+        # others.
+        self.rainfall.scale = 0.5 / 3.0
+        self.rainfall.apply(FRAME)
+        np.testing.assert_allclose(self.subgrid.get_derived('volume')[0],
+                                   50.0)
+        np.testing.assert_allclose(self.arrays['s1'][0], (50.0 / 25 - 1) / 4)
+
+    def test_run(self):
+        self.assertEqual(self.rainfall.run(['a', 'b'], steps_per_frame=5),
+                         10)
+        np.testing.assert_allclose(self.arrays['s1'][1:], [0.504, 0.0])
+        self.assertEqual(self.rainfall.stats['frames'], 2)
+        self.assertEqual(self.subgrid.generation, 2)
+
+
+class TestRainfallStub(StubTestCase):
+
+    def setUp(self):
+        super(TestRainfallStub, self).setUp()
+        self.subgrid = wrapper.SubgridWrapper(mdu=self.mdu)
+        self.subgrid.start()
+        self.addCleanup(self.subgrid.stop)
+        self.subgrid.initmodel()
+
+    def test_dropinstantrain(self):
+        rainfall = radar.RainfallIngestor(self.subgrid, GRID,
+                                          cache_dir=None,
+                                          read_frame=lambda source: FRAME)
+        with mock.patch.object(self.subgrid, 'dropinstantrain',
+                               wraps=self.subgrid.dropinstantrain) as drop:
+            rainfall.apply(FRAME)
+        # Only the four cells under the radar get rain, in millimeters.
+        self.assertEqual(drop.call_count, 4)
+        x, y, diameter, amount = drop.call_args_list[0][0]
+        self.assertEqual((x, y, amount), (5.0, 5.0, 3.0))
+        self.assertAlmostEqual(np.pi * diameter ** 2 / 4, 100.0)
+        cells = self.subgrid.grid_index().cells
+        s1 = self.subgrid.get_nd('s1')
+        for (x, y, rain) in [(0, 0, 3e-3), (10, 0, 4e-3), (0, 10, 1e-3),
+                             (10, 10, 2e-3)]:
+            cell = np.flatnonzero((cells.xmin == x) & (cells.ymin == y))
+            np.testing.assert_allclose(s1[cell], [rain])
+        self.assertEqual(np.count_nonzero(s1), 4)
@@ -0,0 +1,90 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid import recorder
+from python_subgrid.wrapper import VarInfo
+
+POINT = np.dtype({'names': ['id', 'xy', 'active'],
+                  'formats': ['S4', ('f8', (2, )), 'i4'],
+                  'offsets': [0, 8, 24],
+                  'itemsize': 32})
+
+
+class TestRawStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        store = recorder.RawStore(self.directory, {'s1': ((2, 3), 'f8'),
+                                                   'points': ((2, ), POINT)})
+        s1 = np.arange(6.0).reshape(2, 3)
+        points = np.zeros(2, dtype=POINT)
+        points['id'] = ['a', 'b']
+        store.append(10, 1.0, {'s1': s1, 'points': points})
+        store.append(20, 2.0, {'s1': s1 * 2, 'points': points})
+        store.close()
+        output = recorder.load(self.directory)
+        np.testing.assert_array_equal(output['step'], [10, 20])
+        np.testing.assert_array_equal(output['t'], [1.0, 2.0])
+        np.testing.assert_array_equal(output['s1'][1], s1 * 2)
+        self.assertEqual(list(output['points'][0]['id']), ['a', 'b'])
+
+    def test_not_closed(self):
+        store = recorder.RawStore(self.directory, {'s1': ((3, ), 'f8')})
+        store.append(10, 1.0, {'s1': np.ones(3)})
+        store.append(20, 2.0, {'s1': np.ones(3) * 2})
+        # A row that was being written when the process died.
+        store.files['s1'].write(b'\0' * 8)
+        store.files['s1'].flush()
+        output = recorder.load(self.directory)
+        np.testing.assert_array_equal(output['step'], [10, 20])
+        np.testing.assert_array_equal(output['s1'][:, 0], [1.0, 2.0])
+        store.close()
+
+    def test_empty(self):
+        recorder.RawStore(self.directory, {'s1': ((3, ), 'f8')}).close()
+        output = recorder.load(self.directory)
+        self.assertEqual(output['s1'].shape, (0, 3))
+        self.assertEqual(len(output['step']), 0)
+
+
+class TestOutputRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.subgrid = mock.Mock()
+        self.subgrid._var_info.return_value = VarInfo(
+            rank=1, shape=(3, ), type='double', dtype=np.dtype('f8'),
+            ctype=None)
+        self.values = iter(range(100))
+
+        def get_nd(name, out=None):
+            out[...] = next(self.values)
+            return out
+        self.subgrid.get_nd.side_effect = get_nd
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        with recorder.OutputRecorder(self.subgrid, self.directory, ['s1'],
+                                     slots=1, store='raw') as output:
+            for i in range(5):
+                output.record(step=i, t=i * 10.0)
+        self.assertEqual(output.stats['records'], 5)
+        self.assertEqual(output.stats['bytes'], 5 * 3 * 8)
+        s1 = recorder.load(self.directory)['s1']
+        np.testing.assert_array_equal(s1[:, 0], range(5))
+
+    def test_unknown_store(self):
+        self.assertRaises(ValueError, recorder.OutputRecorder,
+                          self.subgrid, self.directory, ['s1'],
+                          store='csv')
@@ -0,0 +1,86 @@
+import glob
+import os
+import signal
+
+import numpy as np
+
+from python_subgrid import utils
+from python_subgrid.remote import RemoteSubgridWrapper
+from python_subgrid.tests.helpers import StubTestCase
+from python_subgrid.utils import NotDocumentedError
+from python_subgrid.utils import RemoteError
+
+
+class TestRemoteSubgridWrapper(StubTestCase):
+
+    def setUp(self):
+        super(TestRemoteSubgridWrapper, self).setUp()
+        self.subgrid = RemoteSubgridWrapper(mdu=self.mdu, timeout=10)
+        self.subgrid.start()
+        self.addCleanup(self.stop)
+        self.subgrid.initmodel()
+
+    def stop(self):
+        if self.subgrid.process is not None:
+            self.subgrid.stop()
+
+    def segments(self):
+        return set(glob.glob(os.path.join(utils.SHARED_MEMORY_DIR,
+                                          'subgrid*')))
+
+    def test_calls(self):
+        self.assertEqual(self.subgrid.update(2.0), 0)
+        self.assertEqual(self.subgrid.get_nd('t1'), 2.0)
+        self.assertEqual(self.subgrid.run_steps(3), 3)
+        self.assertEqual(self.subgrid.get_nd('t1'), 5.0)
+
+    def test_get_nd(self):
+        before = self.segments()
+        s1 = self.subgrid.get_nd('s1')
+        self.subgrid.update(1.0)
+        after = self.subgrid.get_nd('s1')
+        self.assertTrue((after > s1).all())
+        # Copy-on-write: changes stay in this process.
+        after[0] = 100.0
+        self.assertNotEqual(self.subgrid.get_nd('s1')[0], 100.0)
+        # The segments are removed once they are mapped.
+        self.assertEqual(self.segments(), before)
+
+    def test_view(self):
+        view = self.subgrid.get_nd('s1', view=True)
+        self.assertFalse(view.flags.writeable)
+        first = view.copy()
+        self.subgrid.update(1.0)
+        np.testing.assert_array_equal(view, first)
+        again = self.subgrid.get_nd('s1', view=True)
+        self.assertTrue(again is view)
+        self.assertTrue((view > first).all())
+
+    def test_out(self):
+        out = np.empty_like(self.subgrid.get_nd('s1'))
+        self.assertTrue(self.subgrid.get_nd('s1', out=out) is out)
+        np.testing.assert_array_equal(out, self.subgrid.get_nd('s1'))
+        self.assertRaises(ValueError, self.subgrid.get_nd, 's1',
+                          out=np.empty(1))
+
+    def test_compound(self):
+        pumps = self.subgrid.get_nd('pumps')
+        self.assertEqual(list(pumps['capacity']), [1.0, 2.0, 3.0])
+
+    def test_error(self):
+        self.assertRaises(NotDocumentedError, self.subgrid.get_nd, 'unknown')
+        self.assertRaises(ValueError, self.subgrid.set_structure_fields,
+                          'pumps', ['pump99'], {'capacity': [1.0]})
+        # The model process still works.
+        self.assertEqual(self.subgrid.update(1.0), 0)
+
+    def test_child_died(self):
+        os.kill(self.subgrid.process.pid, signal.SIGKILL)
+        self.assertRaises(RemoteError, self.subgrid.update, 1.0)
+        self.assertTrue(self.subgrid.process is None)
+        self.assertRaises(RemoteError, self.subgrid.update, 1.0)
+
+    def test_timeout(self):
+        self.subgrid.timeout = 0.1
+        self.assertRaises(RemoteError, self.subgrid.run_steps, 10 ** 9)
+        self.assertTrue(self.subgrid.process is None)
@@ -0,0 +1,101 @@
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid.grid import GridIndex
+from python_subgrid.render import DepthRenderer
+from python_subgrid.render import cell_map
+from python_subgrid.render import downsample
+from python_subgrid.tests.helpers import contours
+
+
+class TestRasters(unittest.TestCase):
+
+    def test_cell_map(self):
+        # Two 10m cells and a 20m cell, on 5m pixels.
+        xmin = np.array([0.0, 10.0, 20.0])
+        ymin = np.array([0.0, 0.0, 0.0])
+        size = np.array([10.0, 10.0, 20.0])
+        result = cell_map(xmin, xmin + size, ymin, ymin + size, 0.0, 0.0,
+                          5.0, (8, 4))
+        np.testing.assert_array_equal(result[:, 0],
+                                      [0, 0, 1, 1, 2, 2, 2, 2])
+        np.testing.assert_array_equal(result[:, 3],
+                                      [-1, -1, -1, -1, 2, 2, 2, 2])
+
+    def test_downsample(self):
+        values = np.array([[1.0, 3.0, 5.0],
+                           [np.nan, 2.0, 7.0],
+                           [4.0, 4.0, np.nan]])
+        np.testing.assert_allclose(downsample(values),
+                                   [[2.0, 6.0], [4.0, np.nan]])
+
+
+class TestDepthRenderer(unittest.TestCase):
+
+    def setUp(self):
+        # Four 10m cells in a 2 by 2 grid, 5m pixels, bathymetry at -1.
+        contour_x, contour_y = contours([(0, 0, 10), (10, 0, 10), (0, 10, 10),
+                                         (10, 10, 10)])
+        self.arrays = {
+            'x0p': np.array(0.0),
+            'y0p': np.array(0.0),
+            'dxp': np.array(5.0),
+            'dps': np.asfortranarray(-np.ones((4, 4))),
+            's1': np.array([0.5, -2.0, 1.0, 0.0]),
+        }
+        self.subgrid = mock.Mock()
+        self.subgrid._array = self.arrays.get
+        self.subgrid.get_nd = self.arrays.get
+        self.subgrid._var_info = lambda name: mock.Mock(
+            shape=self.arrays[name].shape)
+        self.subgrid.grid_index.return_value = GridIndex(
+            contour_x, contour_y, np.empty(0), np.empty(0))
+        self.subgrid.edits = []
+        self.subgrid.edit_count = 0
+        self.renderer = DepthRenderer(self.subgrid)
+
+    def edit(self, name, args=None):
+        self.subgrid.edits.append((name, args))
+        self.subgrid.edit_count += 1
+
+    def test_render(self):
+        depth = self.renderer.render(0, 0, 20, 20, width=4, height=4)
+        # Top row first: cells 2 and 3, then cells 0 and 1 (dry).
+        np.testing.assert_array_equal(depth[0], [2.0, 2.0, 1.0, 1.0])
+        np.testing.assert_array_equal(depth[3], [1.5, 1.5, np.nan, np.nan])
+
+    def test_levels(self):
+        self.renderer.sync()
+        self.assertEqual(len(self.renderer.dps), 3)
+        self.assertEqual(self.renderer.level(5.0), 0)
+        self.assertEqual(self.renderer.level(12.0), 1)
+        self.assertEqual(self.renderer.level(1000.0), 2)
+        depth = self.renderer.render(0, 0, 20, 20, width=2, height=2)
+        np.testing.assert_array_equal(depth, [[2.0, 1.0], [1.5, np.nan]])
+
+    def test_outside_and_nodata(self):
+        self.arrays['dps'][0, 0] = -9999.0
+        depth = self.renderer.render(-10, -10, 10, 10, width=4, height=4)
+        self.assertTrue(np.isnan(depth[:, :2]).all())
+        self.assertTrue(np.isnan(depth[2:]).all())
+        self.assertTrue(np.isnan(depth[1, 2]))
+        self.assertEqual(depth[0, 3], 1.5)
+
+    def test_changebathy(self):
+        self.renderer.render(0, 0, 20, 20, width=2, height=2)
+        self.arrays['dps'][:2, :2] = -3.0
+        self.edit('changebathy', (5.0, 5.0, 10.0, -3.0, 1))
+        depth = self.renderer.render(0, 0, 20, 20, width=2, height=2)
+        self.assertEqual(depth[1, 0], 3.5)
+        self.assertEqual(self.renderer.stats['builds'], 1)
+        self.assertEqual(self.renderer.stats['updates'], 1)
+
+    def test_rebuild(self):
+        self.renderer.sync()
+        self.edit('initmodel', ())
+        self.renderer.sync()
+        self.assertEqual(self.renderer.stats['builds'], 2)
+        self.renderer.sync()
+        self.assertEqual(self.renderer.stats['builds'], 2)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy as np
+
+from python_subgrid import wrapper
+from python_subgrid.snapshot import Snapshot
+
+POINT = np.dtype({'names': ['id', 'xy', 'active'],
+                  'formats': ['S4', ('f8', (2, )), 'i4'],
+                  'offsets': [0, 8, 24],
+                  'itemsize': 32})
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_layout(self):
+        snapshot = Snapshot.empty([('t1', (), 'f8'), ('s1', (3, 2), 'f8')])
+        self.assertEqual(snapshot.layout[1][1], 64)
+        self.assertEqual(snapshot.nbytes, 128)
+        snapshot['s1'][...] = 1.0
+        self.assertEqual(snapshot['s1'].shape, (3, 2))
+        self.assertTrue('t1' in snapshot)
+        self.assertFalse('u1' in snapshot)
+
+    def test_file(self):
+        shape = tuple(np.array([3, 2], dtype='int32'))
+        snapshot = Snapshot.empty([('s1', shape, 'f8'),
+                                   ('pumps', (2, ), POINT)],
+                                  path=self.path)
+        snapshot['s1'][...] = np.arange(6.0).reshape(3, 2)
+        snapshot['pumps']['id'] = ['a', 'b']
+        snapshot.flush()
+        opened = Snapshot.open(self.path)
+        np.testing.assert_array_equal(opened['s1'],
+                                      np.arange(6.0).reshape(3, 2))
+        self.assertEqual(list(opened['pumps']['id']), ['a', 'b'])
+        self.assertEqual(opened['pumps'].dtype, POINT)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'nothing to see here')
+        self.assertRaises(ValueError, Snapshot.open, self.path)
+
+
+class TestSnapshotRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wrapper = wrapper.SubgridWrapper()
+        self.wrapper.library = mock.Mock()
+        self.wrapper._annotate_functions()
+        self.arrays = {
+            't1': np.array(10.0),
+            's1': np.asfortranarray(np.arange(6.0).reshape(3, 2)),
+            'pumps': np.zeros(2, dtype=POINT),
+        }
+        self.arrays['pumps']['id'] = ['pump01', 'pump02']
+        self.wrapper._array = self.arrays.get
+        self.wrapper._var_info = lambda name: wrapper.VarInfo(
+            rank=self.arrays[name].ndim, shape=self.arrays[name].shape,
+            type='double', dtype=self.arrays[name].dtype, ctype=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def change(self):
+        self.arrays['t1'][...] = 20.0
+        self.arrays['s1'][...] = -1.0
+        self.arrays['pumps']['xy'] = 5.0
+
+    def check(self):
+        self.assertEqual(self.arrays['t1'], 10.0)
+        np.testing.assert_array_equal(self.arrays['s1'],
+                                      np.arange(6.0).reshape(3, 2))
+        np.testing.assert_array_equal(self.arrays['pumps']['xy'], 0.0)
+
+    def test_roundtrip(self):
+        # u1 has no data, it is left out.
+        snapshot = self.wrapper.snapshot()
+        self.assertEqual([item[0] for item in snapshot.layout],
+                         ['t1', 's1', 'pumps'])
+        self.change()
+        self.wrapper.restore(snapshot)
+        self.check()
+        self.assertEqual(self.wrapper.generation, 1)
+
+    def test_file(self):
+        path = os.path.join(self.directory, 'state.snapshot')
+        self.wrapper.snapshot(path=path)
+        self.change()
+        self.wrapper.restore(path)
+        self.check()
+
+    def test_other_shape(self):
+        snapshot = self.wrapper.snapshot()
+        self.arrays['s1'] = np.zeros(4)
+        self.assertRaises(ValueError, self.wrapper.restore, snapshot)
@@ -0,0 +1,57 @@
+import multiprocessing
+
+from python_subgrid.template import ForkedProcess
+from python_subgrid.template import TemplatePool
+from python_subgrid.tests.helpers import StubTestCase
+from python_subgrid.utils import RemoteError
+
+
+class TestTemplatePool(StubTestCase):
+
+    def setUp(self):
+        super(TestTemplatePool, self).setUp()
+        self.pool = TemplatePool(mdu=self.mdu, timeout=10)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def get(self):
+        subgrid = self.pool.get()
+        self.addCleanup(subgrid.stop)
+        return subgrid
+
+    def test_forks_are_independent(self):
+        first = self.get()
+        second = self.get()
+        self.assertNotEqual(first.process.pid, second.process.pid)
+        first.update(5.0)
+        self.assertEqual(first.get_nd('t1'), 5.0)
+        # The second fork starts from the template's model.
+        self.assertEqual(second.get_nd('t1'), 0.0)
+        second.update(1.0)
+        self.assertEqual(first.get_nd('t1'), 5.0)
+
+    def test_initialized(self):
+        subgrid = self.get()
+        self.assertEqual(list(subgrid.get_nd('pumps')['capacity']),
+                         [1.0, 2.0, 3.0])
+
+    def test_stop_keeps_forks(self):
+        subgrid = self.get()
+        self.pool.stop()
+        self.assertEqual(subgrid.update(1.0), 0)
+        self.assertRaises(RemoteError, self.pool.get)
+
+    def test_dead_before_connecting(self):
+        process = multiprocessing.Process(target=lambda: None)
+        process.start()
+        process.join()
+        self.assertRaises(RemoteError, self.pool._accept,
+                          ForkedProcess(process.pid))
+
+
+class TestTemplateErrors(StubTestCase):
+
+    def test_load_error(self):
+        pool = TemplatePool(mdu='/non-existing/model.mdu')
+        self.assertRaises(OSError, pool.start)
+        self.assertTrue(pool.process is None)
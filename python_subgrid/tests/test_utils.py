@@ -1,10 +1,17 @@
+import json
 import os
 import unittest
 
 import mock
+import numpy as np
 
 from python_subgrid import utils
 
+POINT = np.dtype({'names': ['id', 'xy', 'active'],
+                  'formats': ['S4', ('f8', (2, )), 'i4'],
+                  'offsets': [0, 8, 24],
+                  'itemsize': 32})
+
 
 @unittest.skipIf(not os.path.exists('doc/source/index.rst'),
                  'doc/source dir not available')
@@ -13,3 +20,32 @@ class TestUtils(unittest.TestCase):
     def test_generate_functions_documentation(self):
         with mock.patch('__builtin__.open'):
             utils.generate_functions_documentation()
+
+
+class TestSharedArrays(unittest.TestCase):
+
+    def test_roundtrip(self):
+        path, array = utils.create_shared_array((2, 3), np.dtype('f8'))
+        array[:] = 1.5
+        del array
+        shared = utils.open_shared_array(path, (2, 3), np.dtype('f8'))
+        np.testing.assert_array_equal(shared, np.ones((2, 3)) * 1.5)
+        self.assertFalse(shared.flags.writeable)
+
+    def test_file_removed(self):
+        path, array = utils.create_shared_array((2, ), np.dtype('i4'))
+        utils.open_shared_array(path, (2, ), np.dtype('i4'))
+        self.assertFalse(os.path.exists(path))
+
+
+class TestDtypeJson(unittest.TestCase):
+
+    def roundtrip(self, dtype):
+        description = json.loads(json.dumps(utils.dtype_to_json(dtype)))
+        return utils.dtype_from_json(description)
+
+    def test_simple(self):
+        self.assertEqual(self.roundtrip(np.dtype('f8')), np.dtype('f8'))
+
+    def test_structured(self):
+        self.assertEqual(self.roundtrip(POINT), POINT)
@@ -3,8 +3,12 @@ import os
 import unittest
 
 import mock
+import numpy as np
 
 from python_subgrid import wrapper
+from python_subgrid.tests.helpers import StubTestCase
+from python_subgrid.utils import StaleViewError
+from python_subgrid.utils import UnknownVariableError
 
 
 class TestHelperFunctions(unittest.TestCase):
@@ -40,6 +44,15 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEquals(type(self.wrapper._load_library()),
                           ctypes.CDLL)
 
+    def test_load_private_library(self):
+        self.wrapper.private_library = True
+        first = self.wrapper._load_library()
+        second = self.wrapper._load_library()
+        self.assertNotEquals(first._handle, second._handle)
+        self.assertNotEquals(first._name, self.wrapper._library_path())
+        # The copy is removed right after loading.
+        self.assertFalse(os.path.exists(first._name))
+
     def test_load_model_exception(self):
         self.wrapper.mdu = os.path.join(os.getcwd(), 'non-existing.mdu')
         # ^^^ in the current directory so the os.chdir() is OK.
@@ -60,3 +73,373 @@ class TestWrapper(unittest.TestCase):
         with wrapper.SubgridWrapper() as subgrid:
             self.assertEquals(subgrid.update.restype,
                               ctypes.c_int)
+
+
+class TestVariableCache(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = wrapper.SubgridWrapper()
+        self.wrapper.library = mock.Mock()
+        self.wrapper._annotate_functions()
+        self.wrapper.get_var_rank = mock.Mock(return_value=1)
+        self.wrapper.get_var_shape = mock.Mock(return_value=(10,))
+        self.wrapper.get_var_type = mock.Mock(return_value='double')
+
+    def test_var_info(self):
+        info = self.wrapper._var_info('s1')
+        self.assertEquals(info.shape, (10,))
+        self.assertEquals(info.dtype, 'double')
+
+    def test_var_info_cached(self):
+        self.wrapper._var_info('s1')
+        self.wrapper._var_info('s1')
+        self.assertEquals(self.wrapper.get_var_rank.call_count, 1)
+
+    def test_var_info_cleared_on_resize(self):
+        self.wrapper._var_info('s1')
+        self.wrapper.initmodel()
+        self.wrapper._var_info('s1')
+        self.assertEquals(self.wrapper.get_var_rank.call_count, 2)
+
+    def test_unknown_variable(self):
+        # The library has no type for names it doesn't know.
+        self.wrapper.get_var_type.return_value = ''
+        self.wrapper.get_var_rank.return_value = 0
+        self.wrapper.inq_compound = mock.Mock()
+        self.assertRaises(UnknownVariableError, self.wrapper._var_info, 's1')
+        self.assertEquals(self.wrapper._array('s1'), None)
+        self.assertEquals(len(self.wrapper.variables), 0)
+        self.assertFalse(self.wrapper.inq_compound.called)
+
+    def test_scalar_compound_skipped(self):
+        self.wrapper.get_var_type.return_value = 'pump'
+        self.wrapper.get_var_rank.return_value = 0
+        self.wrapper.inq_compound = mock.Mock()
+        self.assertEquals(len(self.wrapper.variables), 0)
+        self.assertFalse(self.wrapper.inq_compound.called)
+
+    def test_edits_logged(self):
+        self.wrapper.changebathy(1.0, 2.0, 10.0, -1.0, 1)
+        self.wrapper.update(1.0)
+        self.assertEquals(self.wrapper.edit_count, 1)
+        self.assertEquals(list(self.wrapper.edits),
+                          [('changebathy', (1.0, 2.0, 10.0, -1.0, 1))])
+
+    def test_var_info_kept_on_discharge(self):
+        self.wrapper._var_info('s1')
+        generation = self.wrapper.generation
+        self.wrapper.discharge(1.0, 2.0, 'manhole', 1, 5.0)
+        self.wrapper._var_info('s1')
+        self.assertEquals(self.wrapper.get_var_rank.call_count, 1)
+        self.assertEquals(self.wrapper.generation, generation + 1)
+
+    def test_resizes_not_logged_as_edit(self):
+        self.wrapper.discard_structure('pump01')
+        self.assertEquals(self.wrapper.edit_count, 0)
+
+    def test_var_info_kept_on_update(self):
+        self.wrapper._var_info('s1')
+        self.wrapper.update(1.0)
+        self.wrapper._var_info('s1')
+        self.assertEquals(self.wrapper.get_var_rank.call_count, 1)
+
+
+class TestModelView(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = wrapper.SubgridWrapper()
+        self.view = self.wrapper._view(np.arange(5.0))
+
+    def test_read_only(self):
+        self.assertFalse(self.view.flags.writeable)
+
+    def test_read(self):
+        self.assertEquals(self.view[1], 1.0)
+        self.assertEquals(self.view.sum(), 10.0)
+
+    def test_stale(self):
+        self.wrapper.generation += 1
+        self.assertTrue(self.view.stale)
+        self.assertRaises(StaleViewError, lambda: self.view[1])
+
+    def test_stale_slice(self):
+        view = self.view[1:3]
+        self.wrapper.generation += 1
+        self.assertRaises(StaleViewError, lambda: view[0])
+
+    def test_stale_calculation(self):
+        self.wrapper.generation += 1
+        self.assertRaises(StaleViewError, lambda: self.view * 2)
+
+    def test_stale_after_stop(self):
+        self.wrapper.library = mock.Mock()
+        self.wrapper._var_cache['s1'] = None
+        self.wrapper.stop()
+        self.assertRaises(StaleViewError, lambda: self.view[1])
+        self.assertEquals(self.wrapper._var_cache, {})
+
+    def test_copy_is_not_a_view(self):
+        copy = self.view.copy()
+        self.wrapper.generation += 1
+        self.assertEquals(copy[1], 1.0)
+
+    def test_mutating_function_increases_generation(self):
+        self.wrapper.library = mock.Mock()
+        self.wrapper._annotate_functions()
+        self.wrapper.update(1.0)
+        self.assertTrue(self.view.stale)
+
+    def test_getwaterlevel_keeps_generation(self):
+        self.wrapper.library = mock.Mock()
+        self.wrapper._annotate_functions()
+        self.wrapper.getwaterlevel(1.0, 1.0, 0.0)
+        self.assertFalse(self.view.stale)
+
+
+class POINT(ctypes.Structure):
+    _fields_ = [('id', ctypes.c_char * 8),
+                ('x', ctypes.c_double),
+                ('n', ctypes.c_int),
+                ('xy', ctypes.c_double * 2)]
+
+
+class TestStructuredArrays(unittest.TestCase):
+
+    def setUp(self):
+        self.points = (POINT * 2)()
+        self.points[0].id = b'first'
+        self.points[0].x = 1.5
+        self.points[1].id = b'second'
+        self.points[1].xy[1] = 3.0
+        dtype = wrapper.struct_dtype(POINT)
+        self.array = np.frombuffer(self.points, dtype=dtype)
+
+    def test_struct_dtype_layout(self):
+        self.assertEquals(self.array.dtype.itemsize, ctypes.sizeof(POINT))
+
+    def test_struct_dtype_values(self):
+        self.assertEquals(self.array['id'][1], b'second')
+        self.assertEquals(self.array['x'][0], 1.5)
+        self.assertEquals(self.array['xy'][1, 1], 3.0)
+
+    def test_struct_dtype_zero_copy(self):
+        self.points[0].x = 2.5
+        self.assertEquals(self.array['x'][0], 2.5)
+
+    def test_structs2pandas(self):
+        df = wrapper.structs2pandas(self.array)
+        self.assertEquals(list(df.columns), ['id', 'x', 'n', 'xy'])
+        self.assertEquals(df['id'][0], b'first')
+
+    def test_structs2pandas_ctypes(self):
+        df = wrapper.structs2pandas(self.points)
+        self.assertEquals(df['x'][0], 1.5)
+
+
+class TestVariables(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = wrapper.SubgridWrapper()
+        self.wrapper.library = mock.Mock()
+        self.arrays = {
+            's1': np.asfortranarray(np.arange(3.0)),
+            't1': np.array(5.0),
+        }
+        self.wrapper.library.get_var.side_effect = self.get_var
+        self.wrapper._var_info = self.var_info
+
+    def var_info(self, name):
+        shape = self.arrays[name].shape if name in self.arrays else (0, )
+        return wrapper.VarInfo(
+            rank=len(shape), shape=shape, type='double',
+            dtype=np.dtype('double'),
+            ctype=np.ctypeslib.ndpointer(dtype='double', ndim=len(shape),
+                                         shape=shape, flags='F'))
+
+    def get_var(self, c_name, data_p):
+        if c_name.value in self.arrays:
+            data_p._obj.value = self.arrays[c_name.value].ctypes.data
+
+    def test_variables(self):
+        variables = self.wrapper.variables
+        self.assertEquals(list(variables), ['s1', 't1'])
+        self.assertEquals(variables.nbytes, 32)
+        s1 = variables['s1']
+        self.assertEquals(s1.shape, (3, ))
+        self.assertEquals(s1.description, "water levels")
+        self.assertTrue(self.wrapper.variables is variables)
+
+    def test_read(self):
+        s1 = self.wrapper.variables['s1']
+        out = np.empty(3)
+        self.assertTrue(s1.read(out=out) is out)
+        np.testing.assert_array_equal(out, [0.0, 1.0, 2.0])
+        self.assertRaises(ValueError, s1.read, out=np.empty(4))
+        copy = s1.read()
+        copy[0] = 10.0
+        self.assertEquals(self.arrays['s1'][0], 0.0)
+        self.assertEquals(self.wrapper.variables['t1'].read(), 5.0)
+
+    def test_view(self):
+        view = self.wrapper.variables['s1'].view()
+        self.assertEquals(view[2], 2.0)
+        self.wrapper.generation += 1
+        self.assertRaises(StaleViewError, view.__getitem__, 0)
+
+    def test_rebind(self):
+        s1 = self.wrapper.variables['s1']
+        self.arrays['s1'] = np.arange(5.0)
+        self.wrapper._clear_var_cache()
+        self.assertEquals(s1.read().shape, (5, ))
+
+    def test_summary(self):
+        summary = self.wrapper.variables.summary()
+        self.assertEquals(list(summary['name']), ['s1', 't1'])
+        self.assertEquals(list(summary['nbytes']), [24, 8])
+
+
+class TestStructureFields(StubTestCase):
+
+    def setUp(self):
+        super(TestStructureFields, self).setUp()
+        self.subgrid = wrapper.SubgridWrapper(mdu=self.mdu)
+        self.subgrid.start()
+        self.addCleanup(self.subgrid.stop)
+        self.subgrid.initmodel()
+
+    def capacities(self):
+        return list(self.subgrid.get_nd('pumps', view=True)['capacity'])
+
+    def test_direct(self):
+        pumps = self.subgrid._array('pumps')
+        self.subgrid.set_structure_fields('pumps', ['pump01', 'pump03'],
+                                          {'capacity': [10.0, 30.0]})
+        # Written into the library's own memory.
+        self.assertEquals(list(pumps['capacity']), [10.0, 2.0, 30.0])
+        self.assertEquals(self.capacities(), [10.0, 2.0, 30.0])
+
+    def test_direct_scalar(self):
+        self.subgrid.set_structure_fields('pumps', ['pump01', 'pump02'],
+                                          {'capacity': 5.0})
+        self.assertEquals(self.capacities(), [5.0, 5.0, 3.0])
+
+    def test_direct_unknown(self):
+        self.assertRaises(ValueError, self.subgrid.set_structure_fields,
+                          'pumps', ['pump99'], {'capacity': [1.0]})
+
+    def test_library(self):
+        self.subgrid.set_structure_fields('pumps', ['pump02'],
+                                          {'capacity': [20.0]},
+                                          direct=False)
+        self.assertEquals(self.capacities(), [1.0, 20.0, 3.0])
+
+    def test_set_structure_field(self):
+        self.subgrid.set_structure_field('pumps', 'pump03', 'capacity', 7.0)
+        self.assertEquals(self.capacities(), [1.0, 2.0, 7.0])
+
+    def test_invalidates_views(self):
+        view = self.subgrid.get_nd('pumps', view=True)
+        self.subgrid.set_structure_fields('pumps', ['pump01'],
+                                          {'capacity': [10.0]})
+        self.assertTrue(view.stale)
+
+
+class TestTimestepLoops(StubTestCase):
+
+    def setUp(self):
+        super(TestTimestepLoops, self).setUp()
+        self.subgrid = wrapper.SubgridWrapper(mdu=self.mdu)
+        self.subgrid.start()
+        self.addCleanup(self.subgrid.stop)
+        self.subgrid.initmodel()
+        self.captured = []
+
+    def callback(self, step, t, buffers):
+        self.captured.append((step, t, buffers['s1'].copy()))
+
+    def test_run_steps(self):
+        t1 = float(self.subgrid.get_nd('t1'))
+        self.assertEquals(self.subgrid.run_steps(10, dt=2.0), 10)
+        self.assertEquals(self.subgrid.get_nd('t1'), t1 + 20.0)
+
+    def test_every(self):
+        self.subgrid.run_steps(10, dt=1.0, every=4, variables=['s1'],
+                               callback=self.callback)
+        self.assertEquals([step for (step, t, s1) in self.captured], [4, 8])
+        self.assertEquals([t for (step, t, s1) in self.captured], [4.0, 8.0])
+
+    def test_buffers(self):
+        self.subgrid.run_steps(3, dt=1.0, variables=['s1'],
+                               callback=self.callback)
+        self.assertEquals(len(self.captured), 3)
+        # Copies of the state at the time of the callback.
+        self.assertTrue((self.captured[1][2] > self.captured[0][2]).all())
+        np.testing.assert_array_equal(self.captured[-1][2],
+                                      self.subgrid.get_nd('s1'))
+
+    def test_run_until(self):
+        steps = self.subgrid.run_until(9.5, dt=2.0, every=2,
+                                       variables=['s1'],
+                                       callback=self.callback)
+        self.assertEquals(steps, 5)
+        self.assertEquals(self.subgrid.get_nd('t1'), 10.0)
+        self.assertEquals([step for (step, t, s1) in self.captured], [2, 4])
+
+    def test_run_until_reached(self):
+        self.subgrid.run_steps(2, dt=1.0)
+        self.assertEquals(self.subgrid.run_until(1.0), 0)
+
+    def test_invalidates_views(self):
+        view = self.subgrid.get_nd('s1', view=True)
+        self.subgrid.run_steps(1)
+        self.assertTrue(view.stale)
+
+    def test_no_data(self):
+        # The stub has no data for nodtype.
+        self.assertRaises(ValueError, self.subgrid.run_steps, 1,
+                          variables=['nodtype'], callback=self.callback)
+        self.assertEquals(self.subgrid.get_nd('t1'), 0.0)
+
+    def test_every_invalid(self):
+        self.assertRaises(ValueError, self.subgrid.run_steps, 3, every=0,
+                          variables=['s1'], callback=self.callback)
+
+
+class TestFastCallMode(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = wrapper.SubgridWrapper(call_mode='fast')
+        self.wrapper.library = mock.Mock()
+        for function in wrapper.FUNCTIONS:
+            library_function = getattr(self.wrapper.library, function['name'])
+            library_function.__name__ = function['name']
+        self.wrapper._annotate_functions()
+
+    def test_unknown_call_mode(self):
+        self.assertRaises(ValueError, wrapper.SubgridWrapper,
+                          call_mode='turbo')
+
+    def test_annotations(self):
+        self.assertEquals(self.wrapper.update.argtypes,
+                          [ctypes.POINTER(ctypes.c_double)])
+
+    def test_arguments(self):
+        self.wrapper.update(2.5)
+        pointer = self.wrapper.library.update.call_args[0][0]
+        self.assertEquals(pointer._obj.value, 2.5)
+
+    def test_string_arguments(self):
+        self.wrapper.discard_structure('pump01')
+        self.wrapper.library.discard_structure.assert_called_with('pump01')
+
+    def test_generation(self):
+        self.wrapper.update(1.0)
+        self.wrapper.getwaterlevel(1.0, 1.0, 0.0)
+        self.assertEquals(self.wrapper.generation, 1)
+
+    def test_edits_logged(self):
+        self.wrapper.initmodel()
+        self.wrapper.changebathy(1.0, 2.0, 10.0, -1.0, 1)
+        self.assertEquals(list(self.wrapper.edits),
+                          [('initmodel', ()),
+                           ('changebathy', (1.0, 2.0, 10.0, -1.0, 1))])
@@ -1,16 +1,26 @@
-"""Utilities. For the moment documentation-generation related."""
+"""Utilities: documentation generation, library unloading, shared memory
+arrays and dtypes in json."""
 from __future__ import print_function
 import collections
 import ctypes
 import logging
 import os
 import platform
+import tempfile
+
+import numpy as np
 
 SUFFIXES = collections.defaultdict(lambda: '.so')
 SUFFIXES['Darwin'] = '.dylib'
 SUFFIXES['Windows'] = '.dll'
 SUFFIX = SUFFIXES[platform.system()]
 
+# Shared memory arrays are files in a memory-backed directory if there is one.
+if os.path.isdir('/dev/shm'):
+    SHARED_MEMORY_DIR = '/dev/shm'
+else:
+    SHARED_MEMORY_DIR = tempfile.gettempdir()
+
 
 FILE_HEADER = """
 Fortran functions and variables
@@ -52,6 +62,95 @@ class NotDocumentedError(Exception):
     pass
 
 
+class StaleViewError(Exception):
+    """A view on the library's memory is used after the model changed."""
+    pass
+
+
+class UnknownVariableError(Exception):
+    """The library has no type for a variable, it doesn't know the name."""
+    pass
+
+
+class JobError(Exception):
+    """A job failed or crashed the process it ran in."""
+    pass
+
+
+class RemoteError(Exception):
+    """The model process died or didn't answer in time."""
+    pass
+
+
+# Utility functions for sharing arrays between processes
+def create_shared_array(shape, dtype):
+    """Return the path of and an array in a new shared memory file.
+
+    Another process can map the same memory with :func:`open_shared_array`.
+    Empty arrays don't need a file, the path is ``None`` then.
+    """
+    dtype = np.dtype(dtype)
+    if not int(np.prod(shape)) * dtype.itemsize:
+        return None, np.empty(shape, dtype=dtype)
+    fd, path = tempfile.mkstemp(prefix='subgrid', dir=SHARED_MEMORY_DIR)
+    os.close(fd)
+    array = np.memmap(path, dtype=dtype, mode='w+', shape=shape, order='F')
+    return path, array
+
+
+def open_shared_array(path, shape, dtype, unlink=True, mode='r'):
+    """Return a read-only array on a file made by :func:`create_shared_array`.
+
+    No data is copied. By default the file is removed right away, the memory
+    stays available as long as the array exists. With ``mode='c'`` the array
+    is writable, changes stay private to this process (copy-on-write).
+    """
+    if path is None:
+        return np.empty(shape, dtype=dtype)
+    array = np.memmap(path, dtype=dtype, mode=mode, shape=shape, order='F')
+    if unlink:
+        os.unlink(path)
+    return array
+
+
+# Utility functions for storing dtypes in json
+def dtype_to_json(dtype):
+    """Return a json-able description of ``dtype``.
+
+    Structured dtypes keep their field offsets and item size, so the
+    padding of the compound variables' C structures is kept as well.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.subdtype is not None:
+        base, shape = dtype.subdtype
+        return [dtype_to_json(base), list(shape)]
+    if dtype.names:
+        return {
+            'names': list(dtype.names),
+            'formats': [dtype_to_json(dtype.fields[name][0])
+                        for name in dtype.names],
+            'offsets': [dtype.fields[name][1] for name in dtype.names],
+            'itemsize': dtype.itemsize,
+        }
+    return dtype.str
+
+
+def dtype_from_json(description):
+    """Return the dtype described by :func:`dtype_to_json`."""
+    if isinstance(description, dict):
+        return np.dtype({
+            'names': [str(name) for name in description['names']],
+            'formats': [dtype_from_json(format_)
+                        for format_ in description['formats']],
+            'offsets': description['offsets'],
+            'itemsize': description['itemsize'],
+        })
+    if isinstance(description, list):
+        base, shape = description
+        return np.dtype((dtype_from_json(base), tuple(shape)))
+    return np.dtype(str(description))
+
+
 # Utility functions for library unloading
 def isloaded(lib):
     """return true if library is loaded"""
@@ -4,31 +4,41 @@ This module provides a ctypes wrapper around the fortran 'subgrid' library.
 """
 
 from __future__ import print_function
+import collections
+import contextlib
 import functools
 import io
 import logging
 import os
 
 import platform
+import shutil
+import tempfile
 import faulthandler
 from numpy.ctypeslib import ndpointer  # nd arrays
 import numpy as np
-import pandas
 
 
 from ctypes import (
     # Types
     c_double, c_int, c_char_p, c_bool, c_char, c_float, c_void_p,
     # Complex types
-    ARRAY, Structure,
+    ARRAY, Array, Structure, sizeof, addressof,
     # Making strings
     create_string_buffer,
     # Pointering
-    POINTER, byref, CFUNCTYPE,
+    POINTER, byref, CFUNCTYPE, memmove,
     # Loading
     cdll)
 
 from python_subgrid import utils
+from python_subgrid.derived import DerivedVariables
+from python_subgrid.events import EventBuffer
+from python_subgrid.grid import GridIndex
+from python_subgrid.instruments import InstrumentedLibrary
+from python_subgrid.instruments import Instruments
+from python_subgrid.logbuffer import LogBuffer
+from python_subgrid.snapshot import Snapshot
 
 try:
     faulthandler.enable()
@@ -45,9 +55,10 @@ CTYPESMAP = {
     'float': c_float,
     'int': c_int
 }
+CTYPESNAMES = dict((value, key) for (key, value) in CTYPESMAP.items())
 TYPEMAP = {
     "bool": "bool",
-    "char": "S",
+    "char": "S1",
     "double": "double",
     "float": "float32",
     "int": "int32"
@@ -97,12 +108,231 @@ def structs2records(structs):
 
 
 def structs2pandas(structs):
-    """convert ctypes structure or structure array to pandas data frame"""
+    """convert ctypes structure or structure array to pandas data frame
+
+    Numpy structured arrays (see :func:`struct_dtype`) are converted per
+    field instead of per row, which is a lot faster.
+    """
+    # Pandas is only needed if you want data frames.
+    import pandas
+    if isinstance(structs, np.ndarray):
+        structs = np.atleast_1d(structs)
+        columns = {}
+        for name in structs.dtype.names:
+            column = structs[name]
+            if column.ndim > 1:
+                # Array fields end up as one array per row.
+                column = list(column)
+            columns[name] = column
+        return pandas.DataFrame(columns, columns=list(structs.dtype.names))
     records = list(structs2records(structs))
     df = pandas.DataFrame.from_records(records)
     return df
 
 
+def struct_dtype(struct):
+    """Return a numpy dtype with the memory layout of a ctypes structure.
+
+    Rank 1 character fields become strings, other rank 1 fields become
+    sub-arrays.
+    """
+    names = []
+    formats = []
+    offsets = []
+    for (name, ctype) in struct._fields_:
+        if issubclass(ctype, Array):
+            typename = CTYPESNAMES[ctype._type_]
+            if typename == 'char':
+                format_ = 'S{}'.format(ctype._length_)
+            else:
+                format_ = (TYPEMAP[typename], (ctype._length_, ))
+        else:
+            format_ = TYPEMAP[CTYPESNAMES[ctype]]
+        names.append(name)
+        formats.append(format_)
+        offsets.append(getattr(struct, name).offset)
+    return np.dtype({'names': names,
+                     'formats': formats,
+                     'offsets': offsets,
+                     'itemsize': sizeof(struct)})
+
+
+class ModelView(np.ndarray):
+    """Read-only array on the memory of the library.
+
+    A view is only valid for the ``generation`` of the wrapper it was made
+    in. Once the model's state changes (an ``update``, a ``changebathy`` and
+    so on), reading from the view (or from slices of it) raises a
+    :class:`python_subgrid.utils.StaleViewError`. Results of calculations
+    with a view and ``.copy()`` are regular numpy arrays.
+
+    Note that ``numpy.asarray(view)`` bypasses the check.
+
+    """
+    _wrapper = None
+    _generation = None
+
+    def __array_finalize__(self, obj):
+        # Slices, reshapes and so on are views, too.
+        self._wrapper = getattr(obj, '_wrapper', None)
+        self._generation = getattr(obj, '_generation', None)
+        self._check()
+
+    def __array_wrap__(self, obj, context=None):
+        self._check()
+        result = np.ndarray.__array_wrap__(self, obj, context).view(np.ndarray)
+        if result.ndim == 0:
+            # Reductions return scalars.
+            return result[()]
+        return result
+
+    def _check(self):
+        if self._wrapper is None:
+            return
+        if self._generation != self._wrapper.generation:
+            msg = "View from generation {} used in generation {}".format(
+                self._generation, self._wrapper.generation)
+            raise utils.StaleViewError(msg)
+
+    @property
+    def stale(self):
+        """Return whether the model changed since the view was made."""
+        return (self._wrapper is not None and
+                self._generation != self._wrapper.generation)
+
+    def __getitem__(self, index):
+        self._check()
+        return np.ndarray.__getitem__(self, index)
+
+    def __iter__(self):
+        self._check()
+        return np.ndarray.__iter__(self)
+
+    def copy(self, order='C'):
+        self._check()
+        return np.array(self, order=order, copy=True, subok=False)
+
+
+def ndarray_at(address, shape, dtype):
+    """Return a numpy array of Fortran ordered memory at ``address``.
+
+    No data is copied, the array shares the memory of the library.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffer_ = (c_char * nbytes).from_address(address)
+    return np.ndarray(shape, dtype=dtype, buffer=buffer_, order='F')
+
+
+class Variable(object):
+    """A variable of the library, bound to its ``get_var`` call.
+
+    The descriptor has the variable's ``name``, ``type``, ``rank``,
+    ``shape``, numpy ``dtype`` (a structured dtype for compound variables),
+    its size in bytes (``nbytes``) and its ``description`` from
+    ``DOCUMENTED_VARIABLES``. Reading goes straight to ``get_var`` with
+    ctypes arguments that are made once. When the model's arrays may have
+    been reallocated (the variable information cache was cleared, see
+    ``SubgridWrapper._var_info``) the descriptor looks the variable up
+    again.
+    """
+
+    def __init__(self, wrapper, name):
+        self.name = name
+        self.description = DOCUMENTED_VARIABLES.get(name)
+        self._wrapper = wrapper
+        self._c_name = create_string_buffer(name)
+        self._bind()
+
+    def _bind(self):
+        wrapper = self._wrapper
+        info = self._info = wrapper._var_info(self.name)
+        self.type = info.type
+        self.rank = info.rank
+        self.shape = tuple(info.shape)
+        self.dtype = np.dtype(info.dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.compound = info.type not in TYPEMAP
+        self._data = info.ctype()
+        self._data_p = byref(self._data)
+        self._library = wrapper.library
+        self._get_var = wrapper.library.get_var
+        self._address = None
+        self._array = None
+
+    def __repr__(self):
+        return "<Variable {} {} {} ({} bytes)>".format(
+            self.name, self.type, self.shape, self.nbytes)
+
+    def array(self):
+        """Return a writable array on the library's memory, like
+        ``SubgridWrapper._array``, or None if there is no data.
+        """
+        wrapper = self._wrapper
+        if (wrapper._var_cache.get(self.name) is not self._info or
+                self._library is not wrapper.library):
+            self._bind()
+        self._get_var(self._c_name, self._data_p)
+        data = self._data
+        if not data:
+            return None
+        if self.compound:
+            address = addressof(data.contents)
+        else:
+            address = data.value
+        if address != self._address:
+            self._array = ndarray_at(address, self.shape, self.dtype)
+            self._address = address
+        return self._array
+
+    def view(self):
+        """Return a read-only :class:`ModelView`, see
+        ``SubgridWrapper.get_nd``.
+        """
+        array = self.array()
+        if array is None:
+            return None
+        return self._wrapper._view(array)
+
+    def read(self, out=None):
+        """Return a copy of the variable or copy it into ``out``.
+
+        Compound variables are numpy structured arrays.
+        """
+        array = self.array()
+        if array is None:
+            return None
+        if out is None:
+            return array.copy(order='F')
+        if out.shape != self.shape or out.dtype != self.dtype:
+            msg = "Variable '{}' has shape {} and dtype {}, out has {} {}"
+            raise ValueError(msg.format(self.name, self.shape, self.dtype,
+                                        out.shape, out.dtype))
+        out[...] = array
+        return out
+
+
+class Variables(collections.OrderedDict):
+    """The :class:`Variable` descriptors by name, see
+    ``SubgridWrapper.variables``.
+    """
+
+    @property
+    def nbytes(self):
+        """Return the size of all variables in bytes."""
+        return sum(variable.nbytes for variable in self.values())
+
+    def summary(self):
+        """Return a pandas data frame of the variables, largest first."""
+        import pandas
+        rows = [(variable.name, variable.type, variable.shape,
+                 variable.nbytes, variable.description)
+                for variable in self.values()]
+        frame = pandas.DataFrame.from_records(
+            rows, columns=['name', 'type', 'shape', 'nbytes', 'description'])
+        return frame.sort_values('nbytes', ascending=False)
+
+
 SHAPEARRAY = ndpointer(dtype='int32',
                        ndim=1,
                        shape=(MAXDIMS,),
@@ -112,36 +342,59 @@ SHAPEARRAY = ndpointer(dtype='int32',
 # If you make changes in FUNCTIONS, run
 # 'bin/generate_functions_documentation' to re-generate the automatic
 # documentation in ./doc/source/fortran_functions.rst.
+# Functions marked with ``'resizes': True`` can (re)allocate the model's
+# arrays, calling them clears the cached variable information. Next to the
+# model (re)loading functions that is ``changebathy`` (``dps`` is rebuilt)
+# and ``discard_structure`` (the structure arrays like ``pumps`` shrink).
+# Adding a discharge point (``discharge``) or removing one
+# (``discard_manhole``) only changes the model's internal discharge
+# administration, none of the variables we read, so they only mutate. Those and the
+# functions marked with ``'mutates': True`` change the model's state, they
+# increase the wrapper's ``generation`` (which invalidates views).
+# Functions marked with ``'deferrable': True`` are buffered while events are
+# deferred (see ``SubgridWrapper.defer_events()``), the other functions that
+# change the model apply the buffered ones first. The calls of the functions
+# marked with ``'changes_grid': True`` (they change the grid or the
+# bathymetry) are logged in ``SubgridWrapper.edits``.
 FUNCTIONS = [
     {
         'name': 'update',
         'argtypes': [POINTER(c_double)],
         'restype': c_int,
+        'mutates': True,
     },
     {
         'name': 'startup',
         'argtypes': [],
         'restype': c_int,
+        'resizes': True,
+        'changes_grid': True,
     },
     {
         'name': 'shutdown',
         'argtypes': [],
         'restype': c_int,
+        'resizes': True,
     },
     {
         'name': 'loadmodel',
         'argtypes': [c_char_p],  # I think this is a pointer to a char_p
         'restype': c_int,
+        'resizes': True,
+        'changes_grid': True,
     },
     {
         'name': 'initmodel',
         'argtypes': [],
         'restype': c_int,
+        'resizes': True,
+        'changes_grid': True,
     },
     {
         'name': 'finalizemodel',
         'argtypes': [],
         'restype': c_int,
+        'resizes': True,
     },
     {
         'name': 'changebathy',
@@ -153,6 +406,9 @@ FUNCTIONS = [
             POINTER(c_int),     # bmode
         ],
         'restype': c_int,
+        'resizes': True,
+        'changes_grid': True,
+        'deferrable': True,
     },
     {
         'name': 'floodfilling',
@@ -161,6 +417,7 @@ FUNCTIONS = [
                      POINTER(c_double),
                      POINTER(c_int)],
         'restype': c_int,
+        'mutates': True,
     },
     {
         'name': 'discharge',
@@ -170,22 +427,28 @@ FUNCTIONS = [
                      POINTER(c_int),
                      POINTER(c_double)],
         'restype': c_int,
+        'mutates': True,
+        'deferrable': True,
     },
     {
         'name': 'discard_manhole',
         'argtypes': [POINTER(c_double),
                      POINTER(c_double)],
         'restype': c_int,
+        'mutates': True,
     },
     {
         'name': 'discard_structure',
         'argtypes': [c_char_p],
         'restype': c_int,
+        'resizes': True,
     },
     {
         'name': 'dropinstantrain',
         'argtypes': [POINTER(c_double)] * 4,
-        'restype': c_int
+        'restype': c_int,
+        'mutates': True,
+        'deferrable': True,
     },
     {
         'name': 'getwaterlevel',
@@ -199,6 +462,64 @@ FUNCTIONS = [
     },
 ]
 
+# The variable information functions are wrapped by hand (see the
+# ``get_var_*`` methods), we only annotate them once after loading.
+VARIABLE_FUNCTIONS = [
+    {
+        'name': 'get_var_rank',
+        'argtypes': [c_char_p, POINTER(c_int)],
+        'restype': None,
+    },
+    {
+        'name': 'get_var_shape',
+        'argtypes': [c_char_p, SHAPEARRAY],
+        'restype': None,
+    },
+    {
+        'name': 'get_var_type',
+        'argtypes': [c_char_p, c_char_p],
+        'restype': None,
+    },
+    {
+        'name': 'get_var',
+        # The second argument is a pointer to a pointer of whatever type
+        # the variable has, so we pass it by reference as a void pointer.
+        'argtypes': [c_char_p, c_void_p],
+        'restype': None,
+    },
+    {
+        'name': 'inq_compound',
+        'argtypes': [c_char_p, POINTER(c_int)],
+        'restype': None,
+    },
+    {
+        'name': 'set_structure_field',
+        'argtypes': [c_char_p,  # variable (pumps)
+                     c_char_p,  # id (pump01)
+                     c_char_p,  # field (capacity)
+                     c_void_p],  # pointer to a pointer to the value
+        'restype': None,
+    },
+    {
+        'name': 'inq_compound_field',
+        'argtypes': [c_char_p,
+                     POINTER(c_int),
+                     c_char_p,
+                     c_char_p,
+                     POINTER(c_int),
+                     SHAPEARRAY],
+        'restype': None,
+    },
+]
+
+# How the FUNCTIONS are called from python, see
+# ``SubgridWrapper._annotate_functions()``.
+CALL_MODES = ('safe', 'fast')
+
+# Cached information about a variable, see ``SubgridWrapper._var_info()``.
+VarInfo = collections.namedtuple(
+    'VarInfo', ['rank', 'shape', 'type', 'dtype', 'ctype'])
+
 DOCUMENTED_VARIABLES = {
     # Purely for documentation purposes. Calling ``.get_nd()`` with a
     # variable warns if the variable isn't documented here.
@@ -211,9 +532,52 @@ DOCUMENTED_VARIABLES = {
     'link_chainage': "along branch distance of the node",
     'link_idx': "link number in nflowlink dimension",
     'nodtype': "type of node {1:'2d',2:'1d',3:'2d boundary',4:'1d boundary'}",
-    'pumps': "pumps"
+    'pumps': "pumps",
+    't1': "current model time",
+    'nFlowElem2d': "number of 2d cells (flow elements)",
+    'FlowElem_xcc': "x of the cell centers",
+    'FlowElem_ycc': "y of the cell centers",
+    'FlowElemContour_x': "x of the four corners of every 2d cell",
+    'FlowElemContour_y': "y of the four corners of every 2d cell",
+    'nFlowElem1d': "number of 1d nodes",
+    'FlowLink_xu': "x of the links (velocity points)",
+    'FlowLink_yu': "y of the links (velocity points)",
+    'x0p': "x of the lower left corner of the pixel grid (dps)",
+    'y0p': "y of the lower left corner of the pixel grid (dps)",
+    'dxp': "width and height of a pixel",
 }
 
+# The variables that ``SubgridWrapper.snapshot()`` saves by default: the
+# state that changes while the model runs.
+STATE_VARIABLES = ['t1', 's1', 'u1', 'pumps']
+
+# The number of calls kept in ``SubgridWrapper.edits``.
+EDIT_LOG_SIZE = 1000
+
+# The wrapper's methods that ``SubgridWrapper.instrument()`` times, next to
+# the library functions and the ``FUNCTIONS``.
+INSTRUMENTED_METHODS = [
+    '_array',
+    '_data_frame',
+    '_var_info',
+    'add_volume',
+    'get_derived',
+    'get_nd',
+    'get_var_rank',
+    'get_var_shape',
+    'get_var_type',
+    'flush_events',
+    'get_water_levels',
+    'inq_compound',
+    'inq_compound_field',
+    'make_compound_ctype',
+    'restore',
+    'run_steps',
+    'run_until',
+    'set_structure_fields',
+    'snapshot',
+]
+
 
 class SubgridWrapper(object):
     """Wrapper around the ctypes-loaded Fortran subgrid library.
@@ -248,18 +612,47 @@ class SubgridWrapper(object):
     MAXSTRLEN = 1024
     MAXDIMS = 6
 
-    def __init__(self, mdu=None):
+    def __init__(self, mdu=None, call_mode='safe', private_library=False):
         """Initialize the class.
 
         The ``mdu`` argument should be the path to a model's ``*.mdu``
         file.
 
+        ``call_mode`` determines how the Fortran functions are called, see
+        :meth:`_annotate_functions`.
+
+        With ``private_library`` the wrapper loads its own copy of the
+        library, so that several wrappers in one process can each have a
+        model, see :meth:`_load_library`.
+
         Nothing much should happen here so that the code remains easy to
         test. Most of the library-related initialization happens in the
         :meth:`start` method.
         """
+        if call_mode not in CALL_MODES:
+            msg = "Unknown call mode {}, use one of {}".format(call_mode,
+                                                               CALL_MODES)
+            raise ValueError(msg)
         self.mdu = mdu
+        self.call_mode = call_mode
+        self.private_library = private_library
         self.original_dir = os.getcwd()
+        # Variable information (rank, shape, type), see :meth:`_var_info`.
+        self._var_cache = {}
+        # Increased whenever the model's state changes, see :class:`ModelView`
+        self.generation = 0
+        # Deferred calls, see :meth:`defer_events`.
+        self.events = None
+        # Call statistics, see :meth:`instrument`.
+        self.instruments = None
+        # Buffered library log messages, see :meth:`buffer_log`.
+        self.log_buffer = None
+        # The last calls that can change the grid or the bathymetry, see
+        # :meth:`_log_edit`.
+        self.edits = collections.deque(maxlen=EDIT_LOG_SIZE)
+        self.edit_count = 0
+        # Cached derived quantities, see :meth:`get_derived`.
+        self.derived = None
 
     def _setlogger(self):
         # we don't expect anything back
@@ -267,7 +660,53 @@ class SubgridWrapper(object):
         # as an argument we need a pointer to a fortran log func...
         self.library.set_mh_c_callback.argtypes = [
             POINTER(fortran_log_functype)]
-        self.library.set_mh_c_callback(byref(fortran_log_func))
+        if self.log_buffer is not None:
+            callback = fortran_log_functype(self.log_buffer)
+        else:
+            callback = fortran_log_func
+        # The library keeps the pointer, so we have to keep the callback.
+        self._log_callback = callback
+        self.library.set_mh_c_callback(byref(callback))
+
+    def buffer_log(self, enabled=True, level=logging.INFO, size=10000,
+                   interval=None):
+        """Buffer the library's log messages of ``level`` and up.
+
+        Lower messages are dropped right in the callback, the others go
+        into a :class:`python_subgrid.logbuffer.LogBuffer` of ``size``
+        messages where identical messages are summarized. The buffer is
+        drained into the logger every ``interval`` seconds by a background
+        thread, or (without ``interval``) after :meth:`run_steps` and
+        :meth:`run_until` and when you call :meth:`flush_log`.
+
+        ``enabled=False`` drains the buffer and logs every message directly
+        again. Returns the buffer's statistics: the messages logged, the
+        messages summarized into them and the messages dropped.
+        """
+        if self.log_buffer is not None:
+            log_buffer, self.log_buffer = self.log_buffer, None
+            log_buffer.stop()
+            if not enabled:
+                if 'library' in self.__dict__:
+                    self._setlogger()
+                return dict(log_buffer.stats)
+        if not enabled:
+            return {}
+        threshold = min(f_level for (f_level, py_level)
+                        in LEVELS_F2PY.items() if py_level >= level)
+        self.log_buffer = LogBuffer(logger, threshold, LEVELS_F2PY, size=size)
+        if interval is not None:
+            self.log_buffer.start(interval)
+        if 'library' in self.__dict__:
+            self._setlogger()
+        return dict(self.log_buffer.stats)
+
+    def flush_log(self):
+        """Log the buffered library messages, return the number of messages.
+        """
+        if self.log_buffer is None:
+            return 0
+        return self.log_buffer.drain()
 
     def _libname(self):
         """Return platform-specific subgridf90 shared library name."""
@@ -316,10 +755,35 @@ class SubgridWrapper(object):
         raise RuntimeError(msg)
 
     def _load_library(self):
-        """Return the fortran library, loaded with """
+        """Return the fortran library, loaded with ctypes.
+
+        The library keeps its model in global variables, so all wrappers in
+        a process normally share one model. With ``private_library`` a copy
+        of the library under a unique name in a temporary directory is
+        loaded instead. The dynamic loader sees a different file, so the
+        copy gets its own globals and its own model. The copy is removed
+        right after loading (that fails silently on Windows, where the
+        temporary directory is left behind).
+
+        Libraries that the library itself depends on (the Fortran runtime,
+        netCDF) stay shared. Every copy costs about the size of the library
+        file in memory, on top of its model. Loading a model changes the
+        process' working directory, so start private wrappers one after the
+        other; their timesteps can run in parallel threads, ctypes releases
+        the GIL during the calls.
+        """
         path = self._library_path()
-        logger.info("Loading library from path {}".format(path))
-        return cdll.LoadLibrary(path)
+        if not self.private_library:
+            logger.info("Loading library from path {}".format(path))
+            return cdll.LoadLibrary(path)
+        directory = tempfile.mkdtemp(prefix='subgrid_library')
+        try:
+            copy = os.path.join(directory, os.path.basename(path))
+            shutil.copy(path, copy)
+            logger.info("Loading a private copy of library {}".format(path))
+            return cdll.LoadLibrary(copy)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
 
     def _annotate_functions(self):
         """Help ctypes by telling it type information about Fortran functions.
@@ -336,12 +800,24 @@ class SubgridWrapper(object):
         On the wrapper.library the functions can be called as ctypes functions.
         On the wrapper the functions can be called with python types.
 
+        In the (default) ``'safe'`` call mode, the wrapper functions check and
+        convert their arguments on every call. In the ``'fast'`` call mode
+        they are generated once per function (see :meth:`_precompile`): they
+        have a fixed number of arguments and reuse their ctypes arguments.
+
         """
-        def wrap(func):
+        def wrap(func, resizes=False, mutates=False, deferrable=False,
+                 changes_grid=False, name=None):
             """Return wrapped function with type conversion and sanity checks.
             """
+            name = name or func.__name__
+
             @functools.wraps(func, assigned=('restype', 'argtypes'))
             def wrapped(*args):
+                if deferrable and self.events is not None:
+                    return self.events.add(name, args)
+                if (resizes or mutates) and self.events:
+                    self.flush_events()
                 if len(args) != len(func.argtypes):
                     logger.warn("{} {} not of same length",
                                 args, func.argtypes)
@@ -356,6 +832,12 @@ class SubgridWrapper(object):
                         typed_arg = argtype(argtype._type_(arg))
                     typed_args.append(typed_arg)
                 result = func(*typed_args)
+                if resizes:
+                    self._var_cache.clear()
+                if changes_grid:
+                    self._log_edit(name, args)
+                if resizes or mutates:
+                    self.generation += 1
                 if hasattr(result, 'contents'):
                     return result.contents
                 else:
@@ -369,9 +851,85 @@ class SubgridWrapper(object):
             # normal python stuff make sure the function properties are copied
             # to the wrapper (normally copy __doc__ etc...)
             # @functools.wraps(api_function,assigned=('restype','argtypes') )
-            f = wrap(api_function)
+            if self.call_mode == 'fast':
+                make_function = self._precompile
+            else:
+                make_function = wrap
+            f = make_function(api_function,
+                              resizes=function.get('resizes', False),
+                              mutates=function.get('mutates', False),
+                              deferrable=function.get('deferrable', False),
+                              changes_grid=function.get('changes_grid',
+                                                        False),
+                              name=function['name'])
             assert hasattr(f, 'argtypes')
+            if self.instruments is not None:
+                f = self.instruments.timed('python', function['name'], f)
             setattr(self, function['name'], f)
+        for function in VARIABLE_FUNCTIONS:
+            api_function = getattr(self.library, function['name'])
+            api_function.argtypes = function['argtypes']
+            api_function.restype = function['restype']
+
+    def _precompile(self, func, resizes=False, mutates=False,
+                    deferrable=False, changes_grid=False, name=None):
+        """Return a fast python function that calls library function ``func``.
+
+        The function has a fixed number of arguments and doesn't check
+        them. The ctypes values for the arguments are allocated once and
+        reused, so the function is not thread-safe. Strings are passed as
+        they are.
+
+        For ``update`` this generates something like::
+
+            def update(arg0):
+                if wrapper.events: wrapper.flush_events()
+                value0.value = arg0
+                result = func(pointer0)
+                wrapper.generation += 1
+                return result
+
+        """
+        name = name or func.__name__
+        namespace = {'func': func, 'wrapper': self}
+        args = []
+        call_args = []
+        lines = []
+        if deferrable:
+            lines.append('if wrapper.events is not None: '
+                         'return wrapper.events.add({!r}, ({}))'.format(
+                             name, ''.join('arg{}, '.format(i) for i in
+                                           range(len(func.argtypes)))))
+        if resizes or mutates:
+            lines.append('if wrapper.events: wrapper.flush_events()')
+        for i, argtype in enumerate(func.argtypes):
+            arg = 'arg{}'.format(i)
+            args.append(arg)
+            if isinstance(argtype._type_, str):
+                # Strings and simple types are converted by ctypes.
+                call_args.append(arg)
+                continue
+            value = argtype._type_()
+            namespace['value{}'.format(i)] = value
+            namespace['pointer{}'.format(i)] = byref(value)
+            lines.append('value{0}.value = {1}'.format(i, arg))
+            call_args.append('pointer{}'.format(i))
+        lines.append('result = func({})'.format(', '.join(call_args)))
+        if resizes:
+            lines.append('wrapper._var_cache.clear()')
+        if changes_grid:
+            lines.append('wrapper._log_edit({!r}, ({}))'.format(
+                name, ''.join(arg + ', ' for arg in args)))
+        if resizes or mutates:
+            lines.append('wrapper.generation += 1')
+        lines.append('return result')
+        source = 'def {}({}):\n'.format(name, ', '.join(args))
+        source += ''.join('    {}\n'.format(line) for line in lines)
+        exec(source, namespace)
+        f = namespace[name]
+        f.argtypes = func.argtypes
+        f.restype = func.restype
+        return f
 
     def _load_model(self):
         os.chdir(os.path.dirname(self.mdu) or '.')
@@ -380,6 +938,9 @@ class SubgridWrapper(object):
             os.path.abspath(os.getcwd())
         )
         logger.info(logmsg)
+        self._var_cache.clear()
+        self._log_edit('loadmodel')
+        self.generation += 1
         exit_code = self.library.loadmodel(self.mdu)
         if exit_code:
             errormsg = "Loading model {mdu} failed with exit code {code}"
@@ -397,6 +958,11 @@ class SubgridWrapper(object):
 
         """
         self.library = self._load_library()
+        if self.instruments is not None:
+            self.library = InstrumentedLibrary(self.library, self.instruments)
+        self._var_cache.clear()
+        self._log_edit('startup')
+        self.generation += 1
         self._setlogger()
         self._annotate_functions()
         self.library.startup()  # Fortran init function.
@@ -416,6 +982,10 @@ class SubgridWrapper(object):
             self.library.finalizemodel()
         logger.info('library shutdown...')
         self.library.shutdown()  # Fortran cleanup function.
+        # The model's memory is freed: views are stale from now on.
+        self._var_cache.clear()
+        self.generation += 1
+        self.flush_log()
         # while utils.isloaded(self._library_path()):
         #     logger.info('dlclose...')
         #     utils.dlclose(self.library)
@@ -434,7 +1004,6 @@ class SubgridWrapper(object):
         """
         name = create_string_buffer(name)
         type_ = create_string_buffer(self.MAXSTRLEN)
-        self.library.get_var_type.argtypes = [c_char_p, c_char_p]
         self.library.get_var_type(name, type_)
         return type_.value
 
@@ -443,31 +1012,21 @@ class SubgridWrapper(object):
         Return the number of fields and size (not yet) of a compound type.
         """
         name = create_string_buffer(name)
-        self.library.inq_compound.argtypes = [c_char_p, POINTER(c_int)]
-        self.library.inq_compound.restype = None
         nfields = c_int()
         self.library.inq_compound(name, byref(nfields))
         return nfields.value
 
     def inq_compound_field(self, name, index):
-        """TODO"""
+        """
+        Return the name, type, rank and shape of field ``index`` of a
+        compound type.
+        """
         typename = create_string_buffer(name)
         index = c_int(index+1)
         fieldname = create_string_buffer(self.MAXSTRLEN)
         fieldtype = create_string_buffer(self.MAXSTRLEN)
         rank = c_int()
-        arraytype = ndpointer(dtype='int32',
-                              ndim=1,
-                              shape=(self.MAXDIMS, ),
-                              flags='F')
         shape = np.empty((self.MAXDIMS, ), dtype='int32', order='fortran')
-        self.library.inq_compound_field.argtypes = [c_char_p,
-                                                    POINTER(c_int),
-                                                    c_char_p,
-                                                    c_char_p,
-                                                    POINTER(c_int),
-                                                    arraytype]
-        self.library.inq_compound_field.restype = None
         self.library.inq_compound_field(typename,
                                         byref(index),
                                         fieldname,
@@ -516,11 +1075,9 @@ class SubgridWrapper(object):
     def get_var_rank(self, name):
         """
         Return array rank or 0 for scalar.
-        """,
+        """
         name = create_string_buffer(name)
         rank = c_int()
-        self.library.get_var_rank.argtypes = [c_char_p, POINTER(c_int)]
-        self.library.get_var_rank.restype = None
         self.library.get_var_rank(name, byref(rank))
         return rank.value
 
@@ -530,17 +1087,77 @@ class SubgridWrapper(object):
         """
         rank = self.get_var_rank(name)
         name = create_string_buffer(name)
-        arraytype = ndpointer(dtype='int32',
-                              ndim=1,
-                              shape=(self.MAXDIMS, ),
-                              flags='F')
         shape = np.empty((self.MAXDIMS, ), dtype='int32', order='fortran')
-        self.library.get_var_shape.argtypes = [c_char_p, arraytype]
         self.library.get_var_shape(name, shape)
         return tuple(shape[:rank])
 
-    def get_nd(self, name):
-        """Return an nd array from subgrid library"""
+    def _var_info(self, name):
+        """Return the (cached) rank, shape and type information of a variable.
+
+        Looking up the information takes several calls into the library, so
+        we keep it around until a function that can resize the model's arrays
+        is called (see the ``resizes`` flag in ``FUNCTIONS``).
+
+        Raises a :class:`python_subgrid.utils.UnknownVariableError` for
+        names the library doesn't know: they have no type, or rank 0 and a
+        type that isn't numeric. Those aren't looked up as compound types,
+        ``inq_compound`` isn't safe for them.
+        """
+        try:
+            return self._var_cache[name]
+        except KeyError:
+            pass
+        rank = self.get_var_rank(name)
+        type_ = self.get_var_type(name)
+        if not type_ or (type_ not in TYPEMAP and not rank):
+            msg = "The library has no variable '{}' (type '{}', rank {})"
+            raise utils.UnknownVariableError(msg.format(name, type_, rank))
+        shape = self.get_var_shape(name)
+        if type_ in TYPEMAP:
+            dtype = np.dtype(TYPEMAP[type_])
+            ctype = ndpointer(dtype=dtype,
+                              ndim=rank,
+                              shape=shape[::-1],
+                              flags='F')
+        else:
+            ctype = self.make_compound_ctype(name)
+            # Pointer to the structure or to an array of structures.
+            struct = ctype._type_
+            if issubclass(struct, Array):
+                struct = struct._type_
+            dtype = struct_dtype(struct)
+        info = VarInfo(rank=rank, shape=shape, type=type_,
+                       dtype=dtype, ctype=ctype)
+        self._var_cache[name] = info
+        return info
+
+    def _clear_var_cache(self):
+        """Forget the variable information, see :meth:`_var_info`."""
+        self._var_cache.clear()
+
+    def _log_edit(self, name, args=None):
+        """Log a call that can change the grid or the bathymetry (see the
+        ``changes_grid`` flag in ``FUNCTIONS``).
+
+        ``edits`` has the last ``EDIT_LOG_SIZE`` of them as ``(name, args)``
+        tuples, ``edit_count`` counts all of them. Caches of what is derived
+        from the grid (like :class:`python_subgrid.render.DepthRenderer`)
+        compare the count with the one they saw, to update only what the
+        new edits (often only ``changebathy`` calls) changed.
+        """
+        self.edits.append((name, args))
+        self.edit_count += 1
+
+    def _view(self, array):
+        """Return ``array`` as a read-only view for the current generation."""
+        view = array.view(ModelView)
+        view.flags.writeable = False
+        view._wrapper = self
+        view._generation = self.generation
+        return view
+
+    def _check_documented(self, name):
+        """Raise a ``NotDocumentedError`` for undocumented variables."""
         if not name in DOCUMENTED_VARIABLES:
             # Enforcing documentation is really the only way to
             # ensure, well, documentation. Irritating, yes, but it
@@ -549,103 +1166,524 @@ class SubgridWrapper(object):
             msg = "Requesting variable '{}', but it isn't documented.".format(
                 name)
             raise utils.NotDocumentedError(msg)
-        # How many dimensions.
-        rank = self.get_var_rank(name)
-        # The shape array is fixed size
-        shape = np.empty((MAXDIMS, ), dtype='int32', order='fortran')
-        shape = self.get_var_shape(name)
-        # there should be nothing here...
-        assert sum(shape[rank:]) == 0
-        # variable type name
-        type_ = self.get_var_type(name)
 
-        is_numpytype = type_ in TYPEMAP
+    def _array(self, name):
+        """Return a writable array on the library's memory for ``name``.
 
-        if is_numpytype:
-            # Store the data in this type
-            arraytype = ndpointer(dtype=TYPEMAP[type_],
-                                  ndim=rank,
-                                  shape=shape[::-1],
-                                  flags='F')
-        else:
-            arraytype = self.make_compound_ctype(name)
+        ``None`` is returned if the library has no data for the variable (or
+        doesn't know it).
+        """
+        try:
+            info = self._var_info(name)
+        except utils.UnknownVariableError:
+            return None
         # Create a pointer to the array type
-        data = arraytype()
+        data = info.ctype()
         # The functions get_var_type/_shape/_rank are already wrapped with
         # python function converter, get_var isn't.
         c_name = create_string_buffer(name)
-        get_var = self.library.get_var
-        get_var.argtypes = [c_char_p, POINTER(arraytype)]
-        get_var.restype = None
         # Get the array
-        get_var(c_name, byref(data))
+        self.library.get_var(c_name, byref(data))
         if not data:
             logger.info("NULL pointer returned")
             return None
-
-        if is_numpytype:
-            array = np.asarray(data)
-            # Not sure why we need this....
-            array = np.reshape(array.ravel(), shape, order='F')
+        if info.type in TYPEMAP:
+            address = data.value
         else:
-            array = structs2pandas(data.contents)
-        return array
-    def set_structure_field(self, name, id, field, value):
-        {
-        'name': 'set_structure_field',
-            'argtypes': [
-                c_char_p,           # variable (pumps)
-                c_char_p,           # id (pump01)
-                c_char_p,           # field (capacity)
-                c_void_p            # pointer to value
-            ],
-        'restype': c_int,
-        }
-        # This only works for 1d
-        rank = self.get_var_rank(name)
-        assert rank == 1
-        # The shape array is fixed size
-        shape = np.empty((MAXDIMS, ), dtype='int32', order='fortran')
-        shape = self.get_var_shape(name)
-        # there should be nothing here...
-        assert sum(shape[rank:]) == 0
+            address = addressof(data.contents)
+        return ndarray_at(address, info.shape, info.dtype)
 
+    @property
+    def variables(self):
+        """Return the :class:`Variables` the library has data for.
 
-        # look up the type name
-        typename = self.get_var_type(name)
-        assert typename not in TYPEMAP
-        nfields = self.inq_compound(typename)
-        # for all the fields look up the type, rank and shape
-        fields = {}
-        for i in range(nfields):
-            (fieldname, fieldtype,
-             fieldrank, fieldshape) = self.inq_compound_field(typename, i)
-            assert fieldrank <= 1
-            fieldctype = CTYPESMAP[fieldtype]
-            if fieldrank == 1:
-                fieldctype = fieldctype*fieldshape[0]
-            fields[fieldname] = fieldctype
+        The descriptors are made once per model (they are cached like the
+        variable information, see :meth:`_var_info`)::
 
+            s1 = subgrid.variables['s1']
+            s1.read(out=levels)
+            s1.view()
+            subgrid.variables.summary()
 
-        T = fields[field]       # type (c_double)
-        T_p = POINTER(T)        # void pointer, as used in the model
+        The library can't list its variables, so these are the
+        ``DOCUMENTED_VARIABLES`` that it knows and that have data.
+        """
+        key = ('variables', )
+        try:
+            return self._var_cache[key]
+        except KeyError:
+            pass
+        variables = Variables()
+        for name in sorted(DOCUMENTED_VARIABLES):
+            try:
+                variable = Variable(self, name)
+            except utils.UnknownVariableError:
+                continue
+            if variable.array() is not None:
+                variables[name] = variable
+        self._var_cache[key] = variables
+        return variables
+
+    def get_nd(self, name, view=False, out=None):
+        """Return an nd array from subgrid library
+
+        By default you get a copy of the data. With ``out`` the data is
+        copied into that (preallocated) array instead, its shape and dtype
+        have to match the variable.
+
+        With ``view=True`` you get a read-only :class:`ModelView` on the
+        library's memory without any copying. The view raises a
+        :class:`python_subgrid.utils.StaleViewError` when it is used after the
+        model changed (``update``, ``changebathy``, ``initmodel`` and so on).
+
+        Compound variables (like ``pumps``) are numpy structured arrays (see
+        :func:`struct_dtype`) in view mode and with ``out``. Otherwise they
+        are returned as a pandas data frame.
+
+        The rank, shape and type of the variable are looked up once and
+        cached until the model's arrays can have been resized.
+        """
+        self._check_documented(name)
+        info = self._var_info(name)
+        if out is not None and (out.shape != info.shape or
+                                out.dtype != info.dtype):
+            msg = "Variable '{}' has shape {} and dtype {}, out has {} {}"
+            raise ValueError(msg.format(name, info.shape, info.dtype,
+                                        out.shape, out.dtype))
+        array = self._array(name)
+        if array is None:
+            return None
+        if view:
+            return self._view(array)
+        if self.instruments is not None:
+            self.instruments.count_bytes(name, array.nbytes,
+                                         allocated=out is None)
+        if out is not None:
+            out[...] = array
+            return out
+        if info.type not in TYPEMAP:
+            return self._data_frame(array)
+        return array.copy(order='F')
+
+    def get_derived(self, name, view=False, out=None):
+        """Return derived quantity ``name``, like ``depth`` or ``volume``.
+
+        The quantities are listed in
+        :data:`python_subgrid.derived.DERIVED_VARIABLES`. They are computed
+        on first use and cached until the variables they depend on change,
+        see :class:`python_subgrid.derived.DerivedVariables`. ``view`` and
+        ``out`` work as with :meth:`get_nd`, a view is on the cached value.
+        """
+        value = self._derived_variables().get(name)
+        if view:
+            return self._view(value)
+        if out is not None:
+            if out.shape != value.shape or out.dtype != value.dtype:
+                msg = ("Derived variable '{}' has shape {} and dtype {}, out "
+                       "has {} {}")
+                raise ValueError(msg.format(name, value.shape, value.dtype,
+                                            out.shape, out.dtype))
+            out[...] = value
+            return out
+        return value.copy()
+
+    def _derived_variables(self):
+        """Return the :class:`python_subgrid.derived.DerivedVariables`,
+        made on first use.
+        """
+        if self.derived is None:
+            self.derived = DerivedVariables(self)
+        return self.derived
+
+    def add_volume(self, volume):
+        """Add ``volume`` (m3 per 2d cell) to the water of the 2d cells,
+        return the cells that got water and their new water levels.
+
+        The new level of a cell is the level at which its pixels hold the
+        water they had plus ``volume`` (see
+        :class:`python_subgrid.derived.Storage`), it is written to ``s1`` in
+        the library's memory. Cells without pixels with bathymetry can't
+        hold water and get none. The water is instantaneous and the
+        library's water balance doesn't see it, use ``dropinstantrain`` for
+        water that should count.
+
+        No array is reallocated, so the variable information is kept, views
+        and the derived quantities of the state are invalidated.
+        """
+        storage = self._derived_variables().get('_storage')
+        s1 = self._array('s1')
+        added = np.take(volume, storage.cells)
+        filled = added > 0
+        cells = storage.cells[filled]
+        levels = storage.level(storage.volume(s1) + added)[filled]
+        s1[cells] = levels
+        self.generation += 1
+        return cells, levels
+
+    def _data_frame(self, array):
+        """Return a pandas data frame with a copy of structured ``array``."""
+        return structs2pandas(array.copy())
+
+    def grid_index(self):
+        """Return the (cached) :class:`python_subgrid.grid.GridIndex`.
+
+        The index answers spatial queries (cells at points, cells in a box
+        or polygon, nearest links) without calls into the library. It only
+        changes with the grid, so it is cached with the variable information
+        (see :meth:`_var_info`) under a key that can't be a variable name.
+        """
+        key = ('grid_index', )
+        try:
+            return self._var_cache[key]
+        except KeyError:
+            pass
+        contour_x = self._array('FlowElemContour_x')
+        contour_y = self._array('FlowElemContour_y')
+        if contour_x is None or contour_y is None:
+            contour_x = contour_y = np.empty((4, 0))
+        link_x = self._array('FlowLink_xu')
+        link_y = self._array('FlowLink_yu')
+        if link_x is None or link_y is None:
+            link_x = link_y = np.empty(0)
+        index = self._var_cache[key] = GridIndex(contour_x, contour_y,
+                                                 link_x, link_y)
+        return index
+
+    def get_water_levels(self, xs, ys):
+        """Return the water levels (``s1``) at many points as an array.
+
+        The points' cells are looked up in an index of the grid (see
+        :meth:`grid_index`) and the levels are read from ``s1`` in one go.
+        Only points that the index can't place (outside the 2d cells, for
+        instance) go through the library's ``getwaterlevel`` one by one.
+        """
+        xs = np.asarray(xs, dtype='f8')
+        ys = np.asarray(ys, dtype='f8')
+        cells = self.grid_index().cells_at(xs, ys)
+        levels = np.empty(xs.shape, dtype='f8')
+        resolved = cells >= 0
+        if resolved.any():
+            levels[resolved] = self._array('s1')[cells[resolved]]
+        level = c_double()
+        level_p = byref(level)
+        getwaterlevel = self.library.getwaterlevel
+        for k in zip(*np.nonzero(~resolved)):
+            getwaterlevel(byref(c_double(xs[k])), byref(c_double(ys[k])),
+                          level_p)
+            levels[k] = level.value
+        return levels
+
+    def run_steps(self, n, dt=-1, every=1, variables=(), callback=None):
+        """Do ``n`` timesteps, return the number of timesteps done.
+
+        See :meth:`run_until` for the other arguments.
+        """
+        return self._run(n, None, dt, every, variables, callback)
 
-        set_structure_field = self.library.set_structure_field
-        set_structure_field.argtypes = [c_char_p, c_char_p, c_char_p, POINTER(T_p)]
-        set_structure_field.restype = None
-        # So the value is a void pointer by reference....
-        # Create a value wrapped in a c_double_p
+    def run_until(self, t_end, dt=-1, every=1, variables=(), callback=None):
+        """Do timesteps until the model time reaches ``t_end``.
 
-        # wrap it up in the first pointer
-        c_value = T_p(T(value))
+        ``dt`` is passed to ``update`` (``-1`` uses the model's timestep).
+        The model time is read from the model's ``t1`` variable.
 
+        Every ``every`` timesteps, the ``variables`` are copied into
+        buffers that are allocated once, up front, and
+        ``callback(step, t, buffers)`` is called with the number of steps
+        done so far, the model time and a dictionary with per variable its
+        buffer. The buffers are reused, so copy what you want to keep. The
+        timesteps in between only call the library's ``update``. A variable
+        without data or an ``every`` below 1 raises a ``ValueError`` before
+        the first timestep.
 
-        c_name = create_string_buffer(name)
-        c_id = create_string_buffer(id)
-        c_field = create_string_buffer(field)
-        # Pass the void_p by reference...
-        set_structure_field(c_name, c_id, c_field, byref(c_value))
+        Returns the number of timesteps done.
+        """
+        return self._run(None, t_end, dt, every, variables, callback)
 
+    def _run(self, n, t_end, dt, every, variables, callback):
+        """Run the timestep loop for :meth:`run_steps` and :meth:`run_until`.
+        """
+        if every < 1:
+            raise ValueError("every must be at least 1, not {}".format(every))
+        # Updates don't resize the arrays, so we can keep pointing at them.
+        sources = {}
+        for name in variables:
+            self._check_documented(name)
+            sources[name] = self._array(name)
+            if sources[name] is None:
+                raise ValueError("Variable '{}' has no data".format(name))
+        buffers = dict((name, np.empty_like(source))
+                       for (name, source) in sources.items())
+        time = self._array('t1')
+        if time is None and t_end is not None:
+            raise RuntimeError("The model time (t1) is not available")
+        if self.events:
+            self.flush_events()
+        update = self.library.update
+        c_dt = c_double(dt)
+        dt_p = byref(c_dt)
+        step = 0
+        countdown = every
+        try:
+            while ((n is None or step < n) and
+                   (t_end is None or time[()] < t_end)):
+                exit_code = update(dt_p)
+                step += 1
+                if exit_code:
+                    msg = "Update {} failed with exit code {}"
+                    raise RuntimeError(msg.format(step, exit_code))
+                countdown -= 1
+                if countdown:
+                    continue
+                countdown = every
+                self.generation += 1
+                for name, source in sources.items():
+                    buffers[name][...] = source
+                if callback is not None:
+                    t = time[()] if time is not None else None
+                    callback(step, t, buffers)
+                    if self.events:
+                        # Apply what the callback did, before the update.
+                        self.flush_events()
+        finally:
+            self.generation += 1
+            if self.log_buffer is not None and self.log_buffer.thread is None:
+                self.log_buffer.drain()
+        return step
+
+    def defer_events(self, enabled=True):
+        """Buffer the interactive edits until the model changes otherwise.
+
+        While enabled, calls of the functions marked ``'deferrable'`` in
+        ``FUNCTIONS`` (``dropinstantrain``, ``discharge`` and
+        ``changebathy``) are collected and merged in an
+        :class:`python_subgrid.events.EventBuffer` and return 0 right away.
+        They are applied right before the next call that changes the model
+        (normally ``update``) or when you call :meth:`flush_events`. Note
+        that ``get_nd`` doesn't apply them.
+
+        ``enabled=False`` applies what is buffered and stops deferring.
+        Returns the buffer's statistics (calls received and calls saved per
+        function), see :meth:`python_subgrid.events.EventBuffer.stats`.
+        """
+        if enabled:
+            if self.events is None:
+                self.events = EventBuffer()
+            return self.events.stats()
+        if self.events is None:
+            return EventBuffer().stats()
+        self.flush_events()
+        events, self.events = self.events, None
+        return events.stats()
+
+    def flush_events(self):
+        """Apply the deferred calls, return the number of library calls."""
+        events = self.events
+        if not events:
+            return 0
+        calls = events.pop()
+        # The calls have to go straight into the library now.
+        self.events = None
+        try:
+            for name, args in calls:
+                getattr(self, name)(*args)
+        finally:
+            self.events = events
+        return len(calls)
+
+    def instrument(self, enabled=True, trace=False):
+        """Count and time the calls into the library and the wrapper.
+
+        While enabled, every library function, the ``FUNCTIONS`` and the
+        ``INSTRUMENTED_METHODS`` record their calls in an
+        :class:`python_subgrid.instruments.Instruments` (with a trace of all
+        calls if you pass ``trace``) and ``get_nd`` counts the bytes it
+        copies. When disabled nothing is wrapped, so there is no overhead.
+
+        ``enabled=False`` stops instrumenting. Returns the statistics, see
+        :meth:`stats`.
+        """
+        if enabled:
+            if self.instruments is None:
+                self.instruments = Instruments(trace=trace)
+                self._install_instruments()
+            return self.instruments.stats()
+        if self.instruments is None:
+            return Instruments().stats()
+        instruments, self.instruments = self.instruments, None
+        self._uninstall_instruments()
+        return instruments.stats()
+
+    def _install_instruments(self):
+        """Put timers around the library and the methods."""
+        if 'library' in self.__dict__:
+            self.library = InstrumentedLibrary(self.library, self.instruments)
+            self._annotate_functions()
+        for name in INSTRUMENTED_METHODS:
+            setattr(self, name, self.instruments.timed(
+                'python', name, getattr(self, name)))
+
+    def _uninstall_instruments(self):
+        """Remove the timers of :meth:`_install_instruments`."""
+        for name in INSTRUMENTED_METHODS:
+            del self.__dict__[name]
+        if isinstance(self.__dict__.get('library'), InstrumentedLibrary):
+            self.library = self.library.library
+            self._annotate_functions()
+
+    def stats(self):
+        """Return the call statistics, empty if not instrumented.
+
+        See :meth:`python_subgrid.instruments.Instruments.stats`.
+        """
+        if self.instruments is None:
+            return Instruments().stats()
+        return self.instruments.stats()
+
+    @contextlib.contextmanager
+    def measure(self, trace=False):
+        """Instrument the calls in a ``with`` block, yield the instruments.
+
+        Instrumentation that was already enabled is paused for the block.
+        """
+        previous = self.instruments
+        if previous is not None:
+            self.instrument(False)
+        self.instrument(trace=trace)
+        instruments = self.instruments
+        try:
+            yield instruments
+        finally:
+            self.instrument(False)
+            if previous is not None:
+                self.instruments = previous
+                self._install_instruments()
+
+    def snapshot(self, variables=STATE_VARIABLES, path=None):
+        """Return a :class:`python_subgrid.snapshot.Snapshot` of the model.
+
+        The ``variables`` (by default the ``STATE_VARIABLES``) are copied
+        byte for byte into one buffer, in memory or in file ``path``.
+        Variables the library has no data for are left out. Deferred events
+        are applied first. ``changebathy`` also updates tables that are
+        derived from ``dps``, so a snapshot of ``dps`` can only be restored
+        if the bathymetry hasn't been changed in between.
+        """
+        self.flush_events()
+        arrays = []
+        for name in variables:
+            self._check_documented(name)
+            array = self._array(name)
+            if array is None:
+                continue
+            info = self._var_info(name)
+            arrays.append((name, array, info))
+        snapshot = Snapshot.empty([(item[0], item[2].shape, item[2].dtype)
+                                   for item in arrays],
+                                  path=path)
+        address = snapshot.buffer.ctypes.data
+        offsets = [item[1] for item in snapshot.layout]
+        for (name, array, info), offset in zip(arrays, offsets):
+            memmove(address + offset, array.ctypes.data, array.nbytes)
+        snapshot.flush()
+        return snapshot
+
+    def restore(self, snapshot):
+        """Copy the variables of ``snapshot`` back into the model.
+
+        ``snapshot`` is a :class:`python_subgrid.snapshot.Snapshot` or the
+        path of one. The model's arrays must have the snapshot's shapes,
+        the snapshot has to come from the same model.
+        """
+        if not isinstance(snapshot, Snapshot):
+            snapshot = Snapshot.open(snapshot)
+        self.flush_events()
+        targets = []
+        for name, offset, shape, dtype in snapshot.layout:
+            info = self._var_info(name)
+            if info.shape != shape or info.dtype != dtype:
+                msg = ("Variable '{}' has shape {} and dtype {}, the "
+                       "snapshot has {} {}")
+                raise ValueError(msg.format(name, info.shape, info.dtype,
+                                            shape, dtype))
+            array = self._array(name)
+            if array is None:
+                raise ValueError("Variable '{}' has no data".format(name))
+            targets.append((array, offset))
+        address = snapshot.buffer.ctypes.data
+        for array, offset in targets:
+            memmove(array.ctypes.data, address + offset, array.nbytes)
+        if 'dps' in snapshot:
+            self._log_edit('restore')
+        self.generation += 1
+
+    def _structure_fields(self, name):
+        """Return the ctypes type per field of compound array ``name``."""
+        info = self._var_info(name)
+        # This only works for 1d
+        assert info.rank == 1
+        assert info.type not in TYPEMAP
+        # Pointer to an array of structures.
+        struct = info.ctype._type_._type_
+        return dict(struct._fields_)
+
+    def set_structure_field(self, name, id, field, value):
+        """Set ``field`` of structure ``id`` (like a pump) to ``value``.
+
+        This goes through the library's ``set_structure_field``. Use
+        :meth:`set_structure_fields` to change many structures at once.
+        """
+        self.set_structure_fields(name, [id], {field: [value]}, direct=False)
+
+    def set_structure_fields(self, name, ids, values, direct=True):
+        """Set fields of many structures in compound array ``name`` at once.
+
+        ``ids`` is a sequence of structure ids, ``values`` a dictionary with
+        per field name a sequence of values (or a single value for all ids),
+        for instance::
+
+            subgrid.set_structure_fields('pumps', ['pump01', 'pump02'],
+                                         {'capacity': [10.0, 20.0]})
+
+        With ``direct`` (the default) the values are written straight into
+        the structured array in the library's memory. Without it, or when
+        the structures have no ``id`` field, the library's
+        ``set_structure_field`` is called per structure and field, with the
+        field types looked up only once.
+        """
+        fieldtypes = self._structure_fields(name)
+        ids = list(ids)
+        structs = None
+        if direct and 'id' in fieldtypes:
+            structs = self._array(name)
+        if structs is not None:
+            rows = dict((id_.strip(), row)
+                        for (row, id_) in enumerate(structs['id']))
+            try:
+                index = [rows[id_] for id_ in ids]
+            except KeyError as e:
+                msg = "Unknown structure {} in '{}'".format(e, name)
+                raise ValueError(msg)
+            for field, fieldvalues in values.items():
+                structs[field][index] = fieldvalues
+            self.generation += 1
+            return
+
+        set_structure_field = self.library.set_structure_field
+        c_name = create_string_buffer(name)
+        for field, fieldvalues in values.items():
+            if np.isscalar(fieldvalues):
+                fieldvalues = [fieldvalues] * len(ids)
+            T = fieldtypes[field]  # type (c_double)
+            value = T()
+            # So the value is a void pointer by reference....
+            # wrap it up in the first pointer
+            c_value = POINTER(T)(value)
+            c_value_p = byref(c_value)
+            c_field = create_string_buffer(field)
+            for id_, fieldvalue in zip(ids, fieldvalues):
+                value.value = fieldvalue
+                set_structure_field(c_name, id_, c_field, c_value_p)
+        self.generation += 1
 
     def __enter__(self):
         """Return the decorated instance upon entering the ``with`` block.
@@ -42,5 +42,6 @@ setup(name='python-subgrid',
           'console_scripts': [
               '{0} = python_subgrid.utils:{0}'.format(
                   'generate_functions_documentation'),
+              'benchmark_subgrid = python_subgrid.benchmarks:main',
           ]},
 )